@@ -7,10 +7,24 @@ import ast
 import logging
 import argparse
 import contextlib
+import copy
+import functools
+import heapq
+import io
 import json
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import struct
 import sys
+import tempfile
+import threading
+import weakref
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import IntEnum
 from pathlib import Path
 from hashlib import sha256
@@ -28,6 +42,8 @@ if 'NO_LOCAL_GGUF' not in os.environ:
     sys.path.insert(1, str(Path(__file__).parent / 'gguf-py'))
 import gguf
 
+from convert_profile import StageProfiler
+
 logger = logging.getLogger("hf-to-gguf")
 
 
@@ -45,6 +61,14 @@ class SentencePieceTokenTypes(IntEnum):
 AnyModel = TypeVar("AnyModel", bound="type[Model]")
 
 
+# one of the files written from a single pass over the model tensors
+@dataclass
+class ModelOutput:
+    ftype: gguf.LlamaFileType
+    fname_out: Path
+    gguf_writer: gguf.GGUFWriter
+
+
 class Model:
     _model_classes: dict[str, type[Model]] = {}
 
@@ -62,6 +86,7 @@ class Model:
     tensor_map: gguf.TensorNameMap
     tensor_names: set[str] | None
     gguf_writer: gguf.GGUFWriter
+    outputs: list[ModelOutput]
     model_name: str | None
     metadata_override: Path | None
     dir_model_card: Path
@@ -72,7 +97,11 @@ class Model:
     def __init__(self, dir_model: Path, ftype: gguf.LlamaFileType, fname_out: Path, is_big_endian: bool = False,
                  use_temp_file: bool = False, eager: bool = False,
                  metadata_override: Path | None = None, model_name: str | None = None,
-                 split_max_tensors: int = 0, split_max_size: int = 0, dry_run: bool = False, small_first_shard: bool = False):
+                 split_max_tensors: int = 0, split_max_size: int = 0, dry_run: bool = False, small_first_shard: bool = False,
+                 threads: int = 1, max_tensors_in_flight: int = 0, stream: bool = False,
+                 cache_dir: Path | None = None, cache_max_size: int = 0, quantize_threads: int = 1,
+                 extra_ftypes: Sequence[gguf.LlamaFileType] = (), profiler: StageProfiler | None = None,
+                 parallel_split: bool = False, max_memory: int = 0, resume: bool = False):
         if type(self) is Model:
             raise TypeError(f"{type(self).__name__!r} should not be directly instantiated")
 
@@ -87,28 +116,61 @@ class Model:
         self.is_safetensors = len(self.part_names) > 0
         if not self.is_safetensors:
             self.part_names = Model.get_model_part_names(self.dir_model, "pytorch_model", ".bin")
-        self.hparams = Model.load_hparams(self.dir_model)
+        self.hparams = self.load_hparams(self.dir_model)
         self.block_count = self.find_hparam(["n_layers", "num_hidden_layers", "n_layer", "num_layers"])
-        self.tensor_map = gguf.get_tensor_name_map(self.model_arch, self.block_count)
+        self.tensor_map = tensor_name_map(self.model_arch, self.block_count)
         self.tensor_names = None
         self.metadata_override = metadata_override
         self.model_name = model_name
         self.dir_model_card = dir_model  # overridden in convert_lora_to_gguf.py
+        # buffers which don't fit are spilled next to the output rather than in the temp dir, which can be in RAM
+        self.memory_budget = MemoryBudget(max_memory, spill_dir=fname_out if fname_out.is_dir() else fname_out.parent)
+        self.quant_pool: TensorQuantizePool | None = None
+        if stream:
+            if use_temp_file:
+                raise ValueError("Streaming conversion can't be used with a temp file")
+            self.quant_pool = TensorStreamPipeline(threads, max_tensors_in_flight, self.memory_budget)
+        elif threads > 1:
+            self.quant_pool = TensorQuantizePool(threads, max_tensors_in_flight, self.memory_budget)
+        self.quant_cache = QuantCache(cache_dir, cache_max_size) if cache_dir is not None else None
+        # also used without a cache directory, to only extract the vocab once when writing multiple outputs
+        self.vocab_cache = VocabCache(cache_dir / "vocab" if cache_dir is not None else None)
+        self.threads = threads
+        self.quantize_threads = quantize_threads
+        self.profiler = profiler
+        self.parallel_split = parallel_split
+        self.resume = resume
+
+        if len(extra_ftypes) > 0 and use_temp_file:
+            raise ValueError("Writing multiple outputs can't be done with a temp file")
 
         # Apply heuristics to figure out typical tensor encoding based on first layer tensor encoding type
-        if self.ftype == gguf.LlamaFileType.GUESSED:
+        if gguf.LlamaFileType.GUESSED in (self.ftype, *extra_ftypes):
             # NOTE: can't use field "torch_dtype" in config.json, because some finetunes lie.
             _, first_tensor = next(self.get_tensors())
             if first_tensor.dtype == torch.float16:
                 logger.info(f"choosing --outtype f16 from first tensor type ({first_tensor.dtype})")
-                self.ftype = gguf.LlamaFileType.MOSTLY_F16
+                guessed_ftype = gguf.LlamaFileType.MOSTLY_F16
             else:
                 logger.info(f"choosing --outtype bf16 from first tensor type ({first_tensor.dtype})")
-                self.ftype = gguf.LlamaFileType.MOSTLY_BF16
+                guessed_ftype = gguf.LlamaFileType.MOSTLY_BF16
+            if self.ftype == gguf.LlamaFileType.GUESSED:
+                self.ftype = guessed_ftype
+            extra_ftypes = [guessed_ftype if ftype == gguf.LlamaFileType.GUESSED else ftype for ftype in extra_ftypes]
+            # the outputs would have the same file name
+            if len(set((self.ftype, *extra_ftypes))) != 1 + len(extra_ftypes):
+                raise ValueError(f"--outtype auto resolves to {guessed_ftype.name}, which is already one of the outtypes")
 
         # Configure GGUF Writer
-        self.gguf_writer = gguf.GGUFWriter(path=None, arch=gguf.MODEL_ARCH_NAMES[self.model_arch], endianess=self.endianess, use_temp_file=self.use_temp_file,
-                                           split_max_tensors=split_max_tensors, split_max_size=split_max_size, dry_run=dry_run, small_first_shard=small_first_shard)
+        def new_gguf_writer() -> gguf.GGUFWriter:
+            return gguf.GGUFWriter(path=None, arch=gguf.MODEL_ARCH_NAMES[self.model_arch], endianess=self.endianess, use_temp_file=self.use_temp_file,
+                                   split_max_tensors=split_max_tensors, split_max_size=split_max_size, dry_run=dry_run, small_first_shard=small_first_shard)
+
+        self.gguf_writer = new_gguf_writer()
+
+        # the tensors are read and transformed once, then quantized separately for each output
+        self.outputs = [ModelOutput(self.ftype, self.fname_out, self.gguf_writer)]
+        self.outputs += [ModelOutput(ftype, self.fname_out, new_gguf_writer()) for ftype in extra_ftypes]
 
     @classmethod
     def __init_subclass__(cls):
@@ -152,8 +214,7 @@ class Model:
             logger.info(f"gguf: loading model part '{part_name}'")
             ctx: ContextManager[Any]
             if self.is_safetensors:
-                from safetensors import safe_open
-                ctx = cast(ContextManager[Any], safe_open(self.dir_model / part_name, framework="pt", device="cpu"))
+                ctx = contextlib.nullcontext(SafetensorsFile(self.dir_model / part_name, self.profiler))
             else:
                 ctx = contextlib.nullcontext(torch.load(str(self.dir_model / part_name), map_location="cpu", mmap=True, weights_only=True))
 
@@ -163,10 +224,9 @@ class Model:
                 for name in model_part.keys():
                     if self.is_safetensors:
                         if self.lazy:
-                            data = model_part.get_slice(name)
-                            data = LazyTorchTensor.from_safetensors_slice(data)
+                            data = LazyTorchTensor.from_safetensors_file(model_part, name)
                         else:
-                            data = model_part.get_tensor(name)
+                            data = LazyTorchTensor.load_from_safetensors_file(model_part, name)
                     else:
                         data = model_part[name]
                         if self.lazy:
@@ -269,6 +329,96 @@ class Model:
 
         return False
 
+    def tensor_qtype(self, ftype: gguf.LlamaFileType, name: str, new_name: str, bid: int | None, n_dims: int) -> gguf.GGMLQuantizationType:
+        data_qtype: gguf.GGMLQuantizationType | bool = self.tensor_force_quant(name, new_name, bid, n_dims)
+
+        # Most of the codebase that takes in 1D tensors or norms only handles F32 tensors
+        if n_dims <= 1 or new_name.endswith("_norm.weight"):
+            data_qtype = gguf.GGMLQuantizationType.F32
+
+        # Conditions should closely match those in llama_model_quantize_internal in llama.cpp
+        # Some tensor types are always in float32
+        if data_qtype is False and (
+            any(
+                self.match_model_tensor_name(new_name, key, bid)
+                for key in (
+                    gguf.MODEL_TENSOR.FFN_GATE_INP,
+                    gguf.MODEL_TENSOR.POS_EMBD,
+                    gguf.MODEL_TENSOR.TOKEN_TYPES,
+                    gguf.MODEL_TENSOR.SSM_CONV1D,
+                    gguf.MODEL_TENSOR.TIME_MIX_FIRST,
+                    gguf.MODEL_TENSOR.TIME_MIX_W1,
+                    gguf.MODEL_TENSOR.TIME_MIX_W2,
+                    gguf.MODEL_TENSOR.TIME_MIX_DECAY_W1,
+                    gguf.MODEL_TENSOR.TIME_MIX_DECAY_W2,
+                )
+            )
+            or not new_name.endswith(".weight")
+        ):
+            data_qtype = gguf.GGMLQuantizationType.F32
+
+        if data_qtype is False and any(
+            self.match_model_tensor_name(new_name, key, bid)
+            for key in (
+                gguf.MODEL_TENSOR.TOKEN_EMBD,
+                gguf.MODEL_TENSOR.OUTPUT,
+            )
+        ):
+            if ftype in (
+                gguf.LlamaFileType.MOSTLY_TQ1_0,
+                gguf.LlamaFileType.MOSTLY_TQ2_0,
+            ):
+                # TODO: use Q4_K and Q6_K
+                data_qtype = gguf.GGMLQuantizationType.F16
+
+        # No override (data_qtype is False), or wants to be quantized (data_qtype is True)
+        if isinstance(data_qtype, bool):
+            if ftype == gguf.LlamaFileType.ALL_F32:
+                data_qtype = gguf.GGMLQuantizationType.F32
+            elif ftype == gguf.LlamaFileType.MOSTLY_F16:
+                data_qtype = gguf.GGMLQuantizationType.F16
+            elif ftype == gguf.LlamaFileType.MOSTLY_BF16:
+                data_qtype = gguf.GGMLQuantizationType.BF16
+            elif ftype == gguf.LlamaFileType.MOSTLY_Q8_0:
+                data_qtype = gguf.GGMLQuantizationType.Q8_0
+            elif ftype == gguf.LlamaFileType.MOSTLY_TQ1_0:
+                data_qtype = gguf.GGMLQuantizationType.TQ1_0
+            elif ftype == gguf.LlamaFileType.MOSTLY_TQ2_0:
+                data_qtype = gguf.GGMLQuantizationType.TQ2_0
+            else:
+                raise ValueError(f"Unknown file type: {ftype.name}")
+
+        return data_qtype
+
+    def quantize(self, data: np.ndarray, qtype: gguf.GGMLQuantizationType,
+                 quantize_fn: Callable[[np.ndarray, gguf.GGMLQuantizationType], np.ndarray] = gguf.quants.quantize) -> np.ndarray:
+        if self.quant_pool is not None:
+            return self.quant_pool.submit(data, qtype, quantize_fn)
+        return quantize_fn(data, qtype)
+
+    # times a stage of the conversion, when profiling
+    def profile(self, stage: str, tensor: str | None = None, nbytes: int = 0) -> ContextManager[None]:
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(stage, tensor, nbytes)
+
+    # Lazy tensors are evaluated wherever their data is first needed (usually while writing),
+    # so their evaluation is timed in a lazy node of its own.
+    def profile_lazy(self, data: np.ndarray, stage: str, tensor: str, nbytes: int = 0) -> np.ndarray:
+        if self.profiler is None or not isinstance(data, gguf.LazyNumpyTensor):
+            return data
+        pending = [data]
+
+        def evaluate() -> np.ndarray:
+            with self.profile(stage, tensor, nbytes):
+                return gguf.LazyNumpyTensor.to_eager(pending.pop())
+
+        return cast(np.ndarray, new_lazy(
+            gguf.LazyNumpyTensor,
+            gguf.LazyNumpyTensor.meta_with_dtype_and_shape(data.dtype, data.shape),
+            evaluate,
+        ))
+
     # some models need extra generated tensors (like rope_freqs)
     def generate_extra_tensors(self) -> Iterable[tuple[str, Tensor]]:
         return ()
@@ -276,16 +426,29 @@ class Model:
     def prepare_tensors(self):
         max_name_len = max(len(s) for _, s in self.tensor_map.mapping.values()) + len(".weight,")
 
-        for name, data_torch in chain(self.generate_extra_tensors(), self.get_tensors()):
+        # The reads of the safetensors files are timed by SafetensorsFile.read_numpy.
+        # In lazy mode, modify_tensors and the quantization only build the graph,
+        # so they are timed when the graph is evaluated (see profile_lazy), excluding the nested reads.
+        tensors: Iterable[tuple[str, Tensor]] = chain(self.generate_extra_tensors(), self.get_tensors())
+
+        # the writer byteswaps the tensors in-place, so they can't be written twice on big endian
+        dedup = TensorDedup(self.memory_budget) if not self.is_big_endian else None
+
+        for name, data_torch in tensors:
             # we don't need these
             if name.endswith((".attention.masked_bias", ".attention.bias", ".rotary_emb.inv_freq")):
                 continue
 
             old_dtype = data_torch.dtype
+            source_data = LazyTorchTensor.numpy_source(data_torch)
+            source_file = data_torch._source if isinstance(data_torch, LazyTorchTensor) else None
+            if dedup is not None:
+                dedup.next_source()
 
             # convert any unsupported data types to float32
             if data_torch.dtype not in (torch.float16, torch.float32):
                 data_torch = data_torch.to(torch.float32)
+            unmodified_torch = data_torch
 
             # use the first number-like part of the tensor name as the block id
             bid = None
@@ -294,88 +457,116 @@ class Model:
                     bid = int(part)
                     break
 
-            for new_name, data_torch in (self.modify_tensors(data_torch, name, bid)):
-                data = data_torch.squeeze().numpy()
+            modified_tensors = self.modify_tensors(data_torch, name, bid)
+            if self.profiler is not None and not self.lazy:
+                modified_tensors = self.profiler.iterate("modify_tensors", modified_tensors, lambda _: name, lambda t: tensor_nbytes(t[1]))
+
+            for new_name, data_torch in modified_tensors:
+                same_as = None
+                if dedup is not None:
+                    with self.profile("dedup", new_name):
+                        same_as = dedup.find(new_name, data_torch, source_file if data_torch is unmodified_torch else None)
+                    if same_as is not None:
+                        logger.info(f"{new_name}: same data as {same_as}, reusing its conversion")
+
+                # raw bfloat16 bits are converted directly to the target type, without a float32 upcast
+                is_raw_bf16 = False
+                if data_torch is unmodified_torch and source_data is not None and source_data.dtype in (np.float16, np.float32, np.uint16):
+                    # the tensor is used as-is, so there is no need to go through torch
+                    data = source_data.squeeze()
+                    if len(data.shape) == 0:
+                        data = source_data
+                    is_raw_bf16 = data.dtype == np.uint16
+                else:
+                    data = data_torch.squeeze().numpy()
+
+                    # if data ends up empty, it means data_torch was a scalar tensor -> restore
+                    if len(data.shape) == 0:
+                        data = data_torch.numpy()
 
-                # if data ends up empty, it means data_torch was a scalar tensor -> restore
-                if len(data.shape) == 0:
-                    data = data_torch.numpy()
+                data_nbytes = math.prod(data.shape) * np.dtype(data.dtype).itemsize
+                data = self.profile_lazy(data, "modify_tensors", new_name, data_nbytes)
 
                 n_dims = len(data.shape)
-                data_qtype: gguf.GGMLQuantizationType | bool = self.tensor_force_quant(name, new_name, bid, n_dims)
-
-                # Most of the codebase that takes in 1D tensors or norms only handles F32 tensors
-                if n_dims <= 1 or new_name.endswith("_norm.weight"):
-                    data_qtype = gguf.GGMLQuantizationType.F32
-
-                # Conditions should closely match those in llama_model_quantize_internal in llama.cpp
-                # Some tensor types are always in float32
-                if data_qtype is False and (
-                    any(
-                        self.match_model_tensor_name(new_name, key, bid)
-                        for key in (
-                            gguf.MODEL_TENSOR.FFN_GATE_INP,
-                            gguf.MODEL_TENSOR.POS_EMBD,
-                            gguf.MODEL_TENSOR.TOKEN_TYPES,
-                            gguf.MODEL_TENSOR.SSM_CONV1D,
-                            gguf.MODEL_TENSOR.TIME_MIX_FIRST,
-                            gguf.MODEL_TENSOR.TIME_MIX_W1,
-                            gguf.MODEL_TENSOR.TIME_MIX_W2,
-                            gguf.MODEL_TENSOR.TIME_MIX_DECAY_W1,
-                            gguf.MODEL_TENSOR.TIME_MIX_DECAY_W2,
-                        )
-                    )
-                    or not new_name.endswith(".weight")
-                ):
-                    data_qtype = gguf.GGMLQuantizationType.F32
-
-                if data_qtype is False and any(
-                    self.match_model_tensor_name(new_name, key, bid)
-                    for key in (
-                        gguf.MODEL_TENSOR.TOKEN_EMBD,
-                        gguf.MODEL_TENSOR.OUTPUT,
-                    )
-                ):
-                    if self.ftype in (
-                        gguf.LlamaFileType.MOSTLY_TQ1_0,
-                        gguf.LlamaFileType.MOSTLY_TQ2_0,
-                    ):
-                        # TODO: use Q4_K and Q6_K
-                        data_qtype = gguf.GGMLQuantizationType.F16
-
-                # No override (data_qtype is False), or wants to be quantized (data_qtype is True)
-                if isinstance(data_qtype, bool):
-                    if self.ftype == gguf.LlamaFileType.ALL_F32:
-                        data_qtype = gguf.GGMLQuantizationType.F32
-                    elif self.ftype == gguf.LlamaFileType.MOSTLY_F16:
-                        data_qtype = gguf.GGMLQuantizationType.F16
-                    elif self.ftype == gguf.LlamaFileType.MOSTLY_BF16:
-                        data_qtype = gguf.GGMLQuantizationType.BF16
-                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q8_0:
-                        data_qtype = gguf.GGMLQuantizationType.Q8_0
-                    elif self.ftype == gguf.LlamaFileType.MOSTLY_TQ1_0:
-                        data_qtype = gguf.GGMLQuantizationType.TQ1_0
-                    elif self.ftype == gguf.LlamaFileType.MOSTLY_TQ2_0:
-                        data_qtype = gguf.GGMLQuantizationType.TQ2_0
+                data_qtypes: list[gguf.GGMLQuantizationType] = []
+                shape: Sequence[int] = data.shape
+
+                quantize_fn = quantize_bf16 if is_raw_bf16 else quantize_tensor
+                if self.quantize_threads > 1:
+                    quantize_fn = functools.partial(quantize_fn, n_threads=self.quantize_threads)
+                if self.quant_cache is not None:
+                    quantize_fn = functools.partial(self.quant_cache.quantize, quantize_fn=quantize_fn, name=new_name)
+
+                # each output gets the same transformed tensor, with its own quantization
+                for i, output in enumerate(self.outputs):
+                    data_qtype = self.tensor_qtype(output.ftype, name, new_name, bid, n_dims)
+                    reused = dedup.reuse(same_as, i, data_qtype, data_nbytes) if dedup is not None else None
+                    if reused is not None:
+                        data_qtype, output_data = reused
                     else:
-                        raise ValueError(f"Unknown file type: {self.ftype.name}")
+                        requested_qtype = data_qtype
+                        with self.profile("quantize", new_name, data_nbytes) if not self.lazy else contextlib.nullcontext():
+                            try:
+                                output_data = self.quantize(data, data_qtype, quantize_fn)
+                            except gguf.QuantError as e:
+                                logger.warning("%s, %s", e, "falling back to F16")
+                                data_qtype = gguf.GGMLQuantizationType.F16
+                                output_data = self.quantize(data, data_qtype, quantize_fn)
+                        output_data = self.profile_lazy(output_data, "quantize", new_name, data_nbytes)
 
-                try:
-                    data = gguf.quants.quantize(data, data_qtype)
-                except gguf.QuantError as e:
-                    logger.warning("%s, %s", e, "falling back to F16")
-                    data_qtype = gguf.GGMLQuantizationType.F16
-                    data = gguf.quants.quantize(data, data_qtype)
+                        if output_data is data and self.is_big_endian and len(self.outputs) > 1:
+                            # the writer byteswaps in-place, which must not affect the other outputs
+                            output_data = output_data.copy()
+
+                        if dedup is not None:
+                            dedup.store(new_name, i, requested_qtype, data_qtype, output_data)
 
-                shape = gguf.quant_shape_from_byte_shape(data.shape, data_qtype) if data.dtype == np.uint8 else data.shape
+                    shape = gguf.quant_shape_from_byte_shape(output_data.shape, data_qtype) if output_data.dtype == np.uint8 else output_data.shape
+                    data_qtypes.append(data_qtype)
+
+                    output.gguf_writer.add_tensor(new_name, output_data, raw_dtype=data_qtype)
 
                 # reverse shape to make it similar to the internal ggml dimension order
                 shape_str = f"{{{', '.join(str(n) for n in reversed(shape))}}}"
 
                 # n_dims is implicit in the shape
-                logger.info(f"{f'%-{max_name_len}s' % f'{new_name},'} {old_dtype} --> {data_qtype.name}, shape = {shape_str}")
+                logger.info(f"{f'%-{max_name_len}s' % f'{new_name},'} {old_dtype} --> {', '.join(qtype.name for qtype in data_qtypes)}, shape = {shape_str}")
+
+        if dedup is not None and dedup.n_reused > 0:
+            logger.info(f"Found {dedup.n_reused} duplicated tensors, "
+                        f"{gguf.GGUFWriter.format_n_bytes_to_str(dedup.nbytes_saved)} of tensor data were not converted and quantized again")
+
+        if self._experts is not None:
+            # flatten `list[dict[str, ExpertStack]]` into `list[str]`
+            experts = [f"{wid} ({stack.n_added}/{stack.n_experts})" for d in self._experts for wid, stack in d.items()]
+            if len(experts) > 0:
+                raise ValueError(f"Unprocessed experts: {experts}")
 
-                self.gguf_writer.add_tensor(new_name, data, raw_dtype=data_qtype)
+    # MoE experts of each block, by weight id, waiting for the rest of their stack
+    _experts: list[dict[str, ExpertStack]] | None = None
+
+    # Copies each expert tensor into its slot of the merged 3d tensor as soon as it arrives.
+    # Once every expert of the block has been seen for a weight id, its merged tensor is returned as a (wid, tensor) pair,
+    # so the merged tensors of a block come in the order their stacks complete, not in the order of `wids`.
+    # `pattern` must fully match the names of the expert tensors, with the expert id and the weight id as groups.
+    def merge_experts(self, name: str, data_torch: Tensor, bid: int, n_experts: int, pattern: str, wids: Sequence[str]) -> list[tuple[str, Tensor]]:
+        match = re.fullmatch(pattern, name)
+        if match is None or match.group(2) not in wids:
+            raise ValueError(f"Can not map expert tensor {name!r}")
+        xid, wid = int(match.group(1)), match.group(2)
+
+        if self._experts is None:
+            self._experts = [{} for _ in range(self.block_count)]
+
+        experts = self._experts[bid]
+        if wid not in experts:
+            experts[wid] = ExpertStack(n_experts, self.memory_budget)
+        experts[wid].add(xid, data_torch, name)
+
+        # checkpoints are usually sorted by name, so the weight ids of a block don't complete in the order of `wids`
+        if not experts[wid].is_complete():
+            return []
+        return [(wid, experts.pop(wid).stack())]
 
     def set_type(self):
         self.gguf_writer.add_type(gguf.GGUFType.MODEL)
@@ -424,24 +615,68 @@ class Model:
         self.set_gguf_parameters()
 
         logger.info("Set model tokenizer")
-        self.set_vocab()
+        self.vocab_cache.set_vocab(self)
 
         logger.info("Set model quantization version")
         self.gguf_writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
 
+    # the metadata methods use self.ftype, self.fname_out and self.gguf_writer
+    def select_output(self, output: ModelOutput):
+        self.ftype = output.ftype
+        self.fname_out = output.fname_out
+        self.gguf_writer = output.gguf_writer
+
     def write(self):
         self.prepare_tensors()
-        self.prepare_metadata(vocab_only=False)
-        self.gguf_writer.write_header_to_file(path=self.fname_out)
-        self.gguf_writer.write_kv_data_to_file()
-        self.gguf_writer.write_tensors_to_file(progress=True)
-        self.gguf_writer.close()
+        for output in self.outputs:
+            self.select_output(output)
+            with self.profile("metadata"):
+                self.prepare_metadata(vocab_only=False)
+            output.fname_out = self.fname_out
+        self.select_output(self.outputs[0])
+
+        # the lazy tensors are evaluated while writing, in their own stages
+        nbytes = sum(ti.nbytes for output in self.outputs for shard in output.gguf_writer.tensors for ti in shard.values())
+        journals: list[list[ShardJournal]] | None = None
+        with self.profile("write", nbytes=nbytes):
+            if self.resume:
+                journals = [ShardJournal.prepare(output.gguf_writer, output.fname_out) for output in self.outputs]
+            if self.parallel_split and any(len(output.gguf_writer.tensors) > 1 for output in self.outputs):
+                for output in self.outputs:
+                    output.gguf_writer.write_header_to_file(path=output.fname_out)
+                    output.gguf_writer.write_kv_data_to_file()
+                write_shards_in_parallel([output.gguf_writer for output in self.outputs], self.memory_budget, progress=True, journals=journals)
+            elif len(self.outputs) == 1 and journals is None:
+                self.gguf_writer.write_header_to_file(path=self.fname_out)
+                self.gguf_writer.write_kv_data_to_file()
+                self.gguf_writer.write_tensors_to_file(progress=True)
+            else:
+                for output in self.outputs:
+                    output.gguf_writer.write_header_to_file(path=output.fname_out)
+                    output.gguf_writer.write_kv_data_to_file()
+                write_tensors_to_files([output.gguf_writer for output in self.outputs], progress=True, journals=journals)
+        for output in self.outputs:
+            output.gguf_writer.close()
+        if journals is not None:
+            # the conversion is done, there is nothing left to resume
+            for journal in chain.from_iterable(journals):
+                journal.close(remove=True)
+        if self.quant_pool is not None:
+            self.quant_pool.close()
+        if self.quant_cache is not None:
+            self.quant_cache.evict()
+        if self.memory_budget.max_bytes > 0:
+            budget = self.memory_budget
+            logger.info(f"Peak memory of the materialized tensors: {gguf.GGUFWriter.format_n_bytes_to_str(budget.peak)} "
+                        f"(--max-memory {gguf.GGUFWriter.format_n_bytes_to_str(budget.max_bytes)}), "
+                        f"spilled to disk: {gguf.GGUFWriter.format_n_bytes_to_str(budget.spilled)}")
 
     def write_vocab(self):
         if len(self.gguf_writer.tensors) != 1:
             raise ValueError('Splitting the vocabulary is not supported')
 
-        self.prepare_metadata(vocab_only=True)
+        with self.profile("metadata"):
+            self.prepare_metadata(vocab_only=True)
         self.gguf_writer.write_header_to_file(path=self.fname_out)
         self.gguf_writer.write_kv_data_to_file()
         self.gguf_writer.close()
@@ -535,17 +770,13 @@ class Model:
 
         return tokens, toktypes, tokpre
 
-    # NOTE: this function is generated by convert_hf_to_gguf_update.py
-    #       do not modify it manually!
-    # ref:  https://github.com/ggerganov/llama.cpp/pull/6920
-    # Marker: Start get_vocab_base_pre
     def get_vocab_base_pre(self, tokenizer) -> str:
         # encoding this string and hashing the resulting tokens would (hopefully) give us a unique identifier that
         # is specific for the BPE pre-tokenizer used by the model
         # we will use this unique identifier to write a "tokenizer.ggml.pre" entry in the GGUF file which we can
         # use in llama.cpp to implement the same pre-tokenizer
 
-        chktxt = '\n \n\n \n\n\n \t \t\t \t\n  \n   \n    \n     \n🚀 (normal) 😶\u200d🌫️ (multiple emojis concatenated) ✅ 🦙🦙 3 33 333 3333 33333 333333 3333333 33333333 3.3 3..3 3...3 កាន់តែពិសេសអាច😁 ?我想在apple工作1314151天～ ------======= нещо на Български \'\'\'\'\'\'```````""""......!!!!!!?????? I\'ve been \'told he\'s there, \'RE you sure? \'M not sure I\'ll make it, \'D you like some tea? We\'Ve a\'lL'
+        chktxt, pre_tokenizers = load_pre_tokenizers()
 
         chktok = tokenizer.encode(chktxt)
         chkhsh = sha256(str(chktok).encode()).hexdigest()
@@ -553,109 +784,12 @@ class Model:
         logger.debug(f"chktok: {chktok}")
         logger.debug(f"chkhsh: {chkhsh}")
 
-        res = None
-
         # NOTE: if you get an error here, you need to update the convert_hf_to_gguf_update.py script
         #       or pull the latest version of the model from Huggingface
         #       don't edit the hashes manually!
-        if chkhsh == "0ef9807a4087ebef797fc749390439009c3b9eda9ad1a097abbe738f486c01e5":
-            # ref: https://huggingface.co/meta-llama/Meta-Llama-3-8B
-            res = "llama-bpe"
-        if chkhsh == "049ecf7629871e3041641907f3de7c733e4dbfdc736f57d882ba0b0845599754":
-            # ref: https://huggingface.co/deepseek-ai/deepseek-llm-7b-base
-            res = "deepseek-llm"
-        if chkhsh == "347715f544604f9118bb75ed199f68779f423cabb20db6de6f31b908d04d7821":
-            # ref: https://huggingface.co/deepseek-ai/deepseek-coder-6.7b-base
-            res = "deepseek-coder"
-        if chkhsh == "8aeee3860c56296a157a1fe2fad249ec40aa59b1bb5709f4ade11c4e6fe652ed":
-            # ref: https://huggingface.co/tiiuae/falcon-7b
-            res = "falcon"
-        if chkhsh == "0876d13b50744004aa9aeae05e7b0647eac9d801b5ba4668afc01e709c15e19f":
-            # ref: https://huggingface.co/BAAI/bge-small-en-v1.5
-            res = "bert-bge"
-        if chkhsh == "b6dc8df998e1cfbdc4eac8243701a65afe638679230920b50d6f17d81c098166":
-            # ref: https://huggingface.co/mosaicml/mpt-7b
-            res = "mpt"
-        if chkhsh == "35d91631860c815f952d711435f48d356ebac988362536bed955d43bfa436e34":
-            # ref: https://huggingface.co/bigcode/starcoder2-3b
-            res = "starcoder"
-        if chkhsh == "3ce83efda5659b07b1ad37ca97ca5797ea4285d9b9ab0dc679e4a720c9da7454":
-            # ref: https://huggingface.co/openai-community/gpt2
-            res = "gpt-2"
-        if chkhsh == "32d85c31273f8019248f2559fed492d929ea28b17e51d81d3bb36fff23ca72b3":
-            # ref: https://huggingface.co/stabilityai/stablelm-2-zephyr-1_6b
-            res = "stablelm2"
-        if chkhsh == "6221ad2852e85ce96f791f476e0b390cf9b474c9e3d1362f53a24a06dc8220ff":
-            # ref: https://huggingface.co/smallcloudai/Refact-1_6-base
-            res = "refact"
-        if chkhsh == "9c2227e4dd922002fb81bde4fc02b0483ca4f12911410dee2255e4987644e3f8":
-            # ref: https://huggingface.co/CohereForAI/c4ai-command-r-v01
-            res = "command-r"
-        if chkhsh == "e636dc30a262dcc0d8c323492e32ae2b70728f4df7dfe9737d9f920a282b8aea":
-            # ref: https://huggingface.co/Qwen/Qwen1.5-7B
-            res = "qwen2"
-        if chkhsh == "b6dc8df998e1cfbdc4eac8243701a65afe638679230920b50d6f17d81c098166":
-            # ref: https://huggingface.co/allenai/OLMo-1.7-7B-hf
-            res = "olmo"
-        if chkhsh == "a8594e3edff7c29c003940395316294b2c623e09894deebbc65f33f1515df79e":
-            # ref: https://huggingface.co/databricks/dbrx-base
-            res = "dbrx"
-        if chkhsh == "c7699093ba4255a91e702aa38a596aa81669f3525dae06c2953267dde580f448":
-            # ref: https://huggingface.co/jinaai/jina-reranker-v1-tiny-en
-            res = "jina-v1-en"
-        if chkhsh == "0876d13b50744004aa9aeae05e7b0647eac9d801b5ba4668afc01e709c15e19f":
-            # ref: https://huggingface.co/jinaai/jina-embeddings-v2-base-en
-            res = "jina-v2-en"
-        if chkhsh == "171aeeedd6fb548d418a7461d053f11b6f1f1fc9b387bd66640d28a4b9f5c643":
-            # ref: https://huggingface.co/jinaai/jina-embeddings-v2-base-es
-            res = "jina-v2-es"
-        if chkhsh == "27949a2493fc4a9f53f5b9b029c82689cfbe5d3a1929bb25e043089e28466de6":
-            # ref: https://huggingface.co/jinaai/jina-embeddings-v2-base-de
-            res = "jina-v2-de"
-        if chkhsh == "c136ed14d01c2745d4f60a9596ae66800e2b61fa45643e72436041855ad4089d":
-            # ref: https://huggingface.co/abacusai/Smaug-Llama-3-70B-Instruct
-            res = "smaug-bpe"
-        if chkhsh == "c7ea5862a53e4272c035c8238367063e2b270d51faa48c0f09e9d5b54746c360":
-            # ref: https://huggingface.co/LumiOpen/Poro-34B-chat
-            res = "poro-chat"
-        if chkhsh == "7967bfa498ade6b757b064f31e964dddbb80f8f9a4d68d4ba7998fcf281c531a":
-            # ref: https://huggingface.co/jinaai/jina-embeddings-v2-base-code
-            res = "jina-v2-code"
-        if chkhsh == "b6e8e1518dc4305be2fe39c313ed643381c4da5db34a98f6a04c093f8afbe99b":
-            # ref: https://huggingface.co/THUDM/glm-4-9b-chat
-            res = "chatglm-bpe"
-        if chkhsh == "7fc505bd3104ca1083b150b17d088b59534ede9bde81f0dd2090967d7fe52cee":
-            # ref: https://huggingface.co/LumiOpen/Viking-7B
-            res = "viking"
-        if chkhsh == "b53802fb28e26d645c3a310b34bfe07da813026ec7c7716883404d5e0f8b1901":
-            # ref: https://huggingface.co/core42/jais-13b
-            res = "jais"
-        if chkhsh == "7b3e7548e4308f52a76e8229e4e6cc831195d0d1df43aed21ac6c93da05fec5f":
-            # ref: https://huggingface.co/WisdomShell/CodeShell-7B
-            res = "codeshell"
-        if chkhsh == "63b97e4253352e6f357cc59ea5b583e3a680eaeaf2632188c2b952de2588485e":
-            # ref: https://huggingface.co/mistralai/Mistral-Nemo-Base-2407
-            res = "tekken"
-        if chkhsh == "855059429035d75a914d1eda9f10a876752e281a054a7a3d421ef0533e5b6249":
-            # ref: https://huggingface.co/HuggingFaceTB/SmolLM-135M
-            res = "smollm"
-        if chkhsh == "3c30d3ad1d6b64202cd222813e7736c2db6e1bd6d67197090fc1211fbc612ae7":
-            # ref: https://huggingface.co/bigscience/bloom
-            res = "bloom"
-        if chkhsh == "bc01ce58980e1db43859146dc51b1758b3b88729b217a74792e9f8d43e479d21":
-            # ref: https://huggingface.co/TurkuNLP/gpt3-finnish-small
-            res = "gpt3-finnish"
-        if chkhsh == "4e2b24cc4770243d65a2c9ec19770a72f08cffc161adbb73fcbb6b7dd45a0aae":
-            # ref: https://huggingface.co/LGAI-EXAONE/EXAONE-3.0-7.8B-Instruct
-            res = "exaone"
-        if chkhsh == "fcace8b9cac38ce847670c970cd5892031a753a1ef381abd1d9af00f713da085":
-            # ref: https://huggingface.co/microsoft/phi-2
-            res = "phi-2"
-        if chkhsh == "60824e3c0d9401f89943cbb2fff727f0e2d4c545ba4df2d6e4f09a6db0f5b450":
-            # ref: https://huggingface.co/facebook/chameleon-7b
-            res = "chameleon"
-
-        if res is None:
+        pre_tokenizer = pre_tokenizers.get(chkhsh)
+
+        if pre_tokenizer is None:
             logger.warning("\n")
             logger.warning("**************************************************************************************")
             logger.warning("** WARNING: The BPE pre-tokenizer was not recognized!")
@@ -668,13 +802,14 @@ class Model:
             logger.warning(f"** chkhsh:  {chkhsh}")
             logger.warning("**************************************************************************************")
             logger.warning("\n")
-            raise NotImplementedError("BPE pre-tokenizer was not recognized - update get_vocab_base_pre()")
+            raise NotImplementedError(f"BPE pre-tokenizer was not recognized - update {PRE_TOKENIZERS_PATH.name}")
+
+        res = pre_tokenizer["name"]
 
-        logger.debug(f"tokenizer.ggml.pre: {repr(res)}")
+        logger.debug(f"tokenizer.ggml.pre: {repr(res)} (ref: {pre_tokenizer['repo']})")
         logger.debug(f"chkhsh: {chkhsh}")
 
         return res
-        # Marker: End get_vocab_base_pre
 
     def _set_vocab_gpt2(self) -> None:
         tokens, toktypes, tokpre = self.get_vocab_base()
@@ -702,11 +837,12 @@ class Model:
         merges = []
         vocab = {}
         mergeable_ranks = tokenizer.mergeable_ranks
+        token_merges = bpe_merges(mergeable_ranks, self.threads)
         for token, rank in mergeable_ranks.items():
             vocab[QwenModel.token_bytes_to_string(token)] = rank
             if len(token) == 1:
                 continue
-            merged = QwenModel.bpe(mergeable_ranks, token, max_rank=rank)
+            merged = token_merges[token]
             assert len(merged) == 2
             merges.append(' '.join(map(QwenModel.token_bytes_to_string, merged)))
 
@@ -753,40 +889,16 @@ class Model:
         special_vocab.add_to_gguf(self.gguf_writer)
 
     def _create_vocab_sentencepiece(self):
-        from sentencepiece import SentencePieceProcessor
-
         tokenizer_path = self.dir_model / 'tokenizer.model'
 
         if not tokenizer_path.is_file():
             raise FileNotFoundError(f"File not found: {tokenizer_path}")
 
-        tokenizer = SentencePieceProcessor()
-        tokenizer.LoadFromFile(str(tokenizer_path))
-
-        vocab_size = self.hparams.get('vocab_size', tokenizer.vocab_size())
-
-        tokens: list[bytes] = [f"[PAD{i}]".encode("utf-8") for i in range(vocab_size)]
-        scores: list[float] = [-10000.0] * vocab_size
-        toktypes: list[int] = [SentencePieceTokenTypes.UNUSED] * vocab_size
+        sentencepiece_model = SentencePieceModel.load(tokenizer_path)
 
-        for token_id in range(tokenizer.vocab_size()):
-            piece = tokenizer.IdToPiece(token_id)
-            text = piece.encode("utf-8")
-            score = tokenizer.GetScore(token_id)
-
-            toktype = SentencePieceTokenTypes.NORMAL
-            if tokenizer.IsUnknown(token_id):
-                toktype = SentencePieceTokenTypes.UNKNOWN
-            elif tokenizer.IsControl(token_id):
-                toktype = SentencePieceTokenTypes.CONTROL
-            elif tokenizer.IsUnused(token_id):
-                toktype = SentencePieceTokenTypes.UNUSED
-            elif tokenizer.IsByte(token_id):
-                toktype = SentencePieceTokenTypes.BYTE
+        vocab_size = self.hparams.get('vocab_size', sentencepiece_model.vocab_size)
 
-            tokens[token_id] = text
-            scores[token_id] = score
-            toktypes[token_id] = toktype
+        tokens, scores, toktypes = sentencepiece_model.vocab(vocab_size)
 
         added_tokens_file = self.dir_model / 'added_tokens.json'
         if added_tokens_file.is_file():
@@ -1573,8 +1685,6 @@ class LlamaModel(Model):
                 .swapaxes(1, 2)
                 .reshape(weights.shape))
 
-    _experts: list[dict[str, Tensor]] | None = None
-
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         n_head = self.hparams["num_attention_heads"]
         n_kv_head = self.hparams.get("num_key_value_heads")
@@ -1590,33 +1700,10 @@ class LlamaModel(Model):
 
             assert bid is not None
 
-            if self._experts is None:
-                self._experts = [{} for _ in range(self.block_count)]
-
-            self._experts[bid][name] = data_torch
-
-            if len(self._experts[bid]) >= n_experts * 3:
-                tensors: list[tuple[str, Tensor]] = []
-
-                # merge the experts into a single 3d tensor
-                for wid in ["w1", "w2", "w3"]:
-                    datas: list[Tensor] = []
-
-                    for xid in range(n_experts):
-                        ename = f"model.layers.{bid}.block_sparse_moe.experts.{xid}.{wid}.weight"
-                        datas.append(self._experts[bid][ename])
-                        del self._experts[bid][ename]
-
-                    data_torch = torch.stack(datas, dim=0)
-
-                    merged_name = f"layers.{bid}.feed_forward.experts.{wid}.weight"
-
-                    new_name = self.map_tensor_name(merged_name)
-
-                    tensors.append((new_name, data_torch))
-                return tensors
-            else:
-                return []
+            return [
+                (self.map_tensor_name(f"layers.{bid}.feed_forward.experts.{wid}.weight"), data_torch)
+                for wid, data_torch in self.merge_experts(name, data_torch, bid, n_experts, r"model\.layers\.\d+\.block_sparse_moe\.experts\.(\d+)\.(\w+)\.weight", ["w1", "w2", "w3"])
+            ]
 
         return [(self.map_tensor_name(name), data_torch)]
 
@@ -1649,15 +1736,6 @@ class LlamaModel(Model):
 
                 yield (self.format_tensor_name(gguf.MODEL_TENSOR.ROPE_FREQS), torch.tensor(rope_factors, dtype=torch.float32))
 
-    def prepare_tensors(self):
-        super().prepare_tensors()
-
-        if self._experts is not None:
-            # flatten `list[dict[str, Tensor]]` into `list[str]`
-            experts = [k for d in self._experts for k in d.keys()]
-            if len(experts) > 0:
-                raise ValueError(f"Unprocessed experts: {experts}")
-
 
 @Model.register("BitnetForCausalLM")
 class BitnetModel(Model):
@@ -1713,8 +1791,6 @@ class GrokModel(Model):
     def set_gguf_parameters(self):
         super().set_gguf_parameters()
 
-    _experts: list[dict[str, Tensor]] | None = None
-
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         # process the experts separately
         if name.find(".moe.") != -1:
@@ -1722,33 +1798,10 @@ class GrokModel(Model):
 
             assert bid is not None
 
-            if self._experts is None:
-                self._experts = [{} for _ in range(self.block_count)]
-
-            self._experts[bid][name] = data_torch
-
-            if len(self._experts[bid]) >= n_experts * 3:
-                tensors: list[tuple[str, Tensor]] = []
-
-                # merge the experts into a single 3d tensor
-                for wid in ["linear", "linear_1", "linear_v"]:
-                    datas: list[Tensor] = []
-
-                    for xid in range(n_experts):
-                        ename = f"transformer.decoder_layer.{bid}.moe.{xid}.{wid}.weight"
-                        datas.append(self._experts[bid][ename])
-                        del self._experts[bid][ename]
-
-                    data_torch = torch.stack(datas, dim=0)
-
-                    merged_name = f"transformer.decoder_layer.{bid}.moe.{wid}.weight"
-
-                    new_name = self.map_tensor_name(merged_name)
-
-                    tensors.append((new_name, data_torch))
-                return tensors
-            else:
-                return []
+            return [
+                (self.map_tensor_name(f"transformer.decoder_layer.{bid}.moe.{wid}.weight"), data_torch)
+                for wid, data_torch in self.merge_experts(name, data_torch, bid, n_experts, r"transformer\.decoder_layer\.\d+\.moe\.(\d+)\.(\w+)\.weight", ["linear", "linear_1", "linear_v"])
+            ]
 
         return [(self.map_tensor_name(name), data_torch)]
 
@@ -1925,26 +1978,12 @@ class QwenModel(Model):
 
     @staticmethod
     def token_bytes_to_string(b):
-        from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
-        byte_encoder = bytes_to_unicode()
-        return ''.join([byte_encoder[ord(char)] for char in b.decode('latin-1')])
+        byte_encoder = gpt2_byte_encoder()
+        return ''.join([byte_encoder[c] for c in b])
 
     @staticmethod
     def bpe(mergeable_ranks: dict[bytes, int], token: bytes, max_rank: int | None = None) -> list[bytes]:
-        parts = [bytes([b]) for b in token]
-        while True:
-            min_idx = None
-            min_rank = None
-            for i, pair in enumerate(zip(parts[:-1], parts[1:])):
-                rank = mergeable_ranks.get(pair[0] + pair[1])
-                if rank is not None and (min_rank is None or rank < min_rank):
-                    min_idx = i
-                    min_rank = rank
-            if min_rank is None or (max_rank is not None and min_rank >= max_rank):
-                break
-            assert min_idx is not None
-            parts = parts[:min_idx] + [parts[min_idx] + parts[min_idx + 1]] + parts[min_idx + 2:]
-        return parts
+        return bpe_merge(mergeable_ranks, token, max_rank)
 
     def set_vocab(self):
         self._set_vocab_qwen()
@@ -1987,53 +2026,19 @@ class Qwen2MoeModel(Model):
             self.gguf_writer.add_expert_shared_feed_forward_length(shared_expert_intermediate_size)
             logger.info(f"gguf: expert shared feed forward length = {shared_expert_intermediate_size}")
 
-    _experts: list[dict[str, Tensor]] | None = None
-
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         # process the experts separately
         if name.find("experts") != -1:
             n_experts = self.hparams["num_experts"]
             assert bid is not None
 
-            if self._experts is None:
-                self._experts = [{} for _ in range(self.block_count)]
-
-            self._experts[bid][name] = data_torch
-
-            if len(self._experts[bid]) >= n_experts * 3:
-                tensors: list[tuple[str, Tensor]] = []
-
-                # merge the experts into a single 3d tensor
-                for w_name in ["down_proj", "gate_proj", "up_proj"]:
-                    datas: list[Tensor] = []
-
-                    for xid in range(n_experts):
-                        ename = f"model.layers.{bid}.mlp.experts.{xid}.{w_name}.weight"
-                        datas.append(self._experts[bid][ename])
-                        del self._experts[bid][ename]
-
-                    data_torch = torch.stack(datas, dim=0)
-
-                    merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
-
-                    new_name = self.map_tensor_name(merged_name)
-
-                    tensors.append((new_name, data_torch))
-                return tensors
-            else:
-                return []
+            return [
+                (self.map_tensor_name(f"model.layers.{bid}.mlp.experts.{wid}.weight"), data_torch)
+                for wid, data_torch in self.merge_experts(name, data_torch, bid, n_experts, r"model\.layers\.\d+\.mlp\.experts\.(\d+)\.(\w+)\.weight", ["down_proj", "gate_proj", "up_proj"])
+            ]
 
         return [(self.map_tensor_name(name), data_torch)]
 
-    def prepare_tensors(self):
-        super().prepare_tensors()
-
-        if self._experts is not None:
-            # flatten `list[dict[str, Tensor]]` into `list[str]`
-            experts = [k for d in self._experts for k in d.keys()]
-            if len(experts) > 0:
-                raise ValueError(f"Unprocessed experts: {experts}")
-
 
 @Model.register("GPT2LMHeadModel")
 class GPT2Model(Model):
@@ -2100,41 +2105,16 @@ class Phi3MiniModel(Model):
     model_arch = gguf.MODEL_ARCH.PHI3
 
     def set_vocab(self):
-        from sentencepiece import SentencePieceProcessor
-
         tokenizer_path = self.dir_model / 'tokenizer.model'
 
         if not tokenizer_path.is_file():
             raise ValueError(f'Error: Missing {tokenizer_path}')
 
-        tokenizer = SentencePieceProcessor()
-        tokenizer.LoadFromFile(str(tokenizer_path))
-
-        vocab_size = self.hparams.get('vocab_size', tokenizer.vocab_size())
-
-        tokens: list[bytes] = [f"[PAD{i}]".encode("utf-8") for i in range(vocab_size)]
-        scores: list[float] = [-10000.0] * vocab_size
-        toktypes: list[int] = [SentencePieceTokenTypes.UNUSED] * vocab_size
-
-        for token_id in range(tokenizer.vocab_size()):
-
-            piece = tokenizer.IdToPiece(token_id)
-            text = piece.encode("utf-8")
-            score = tokenizer.GetScore(token_id)
+        sentencepiece_model = SentencePieceModel.load(tokenizer_path)
 
-            toktype = SentencePieceTokenTypes.NORMAL
-            if tokenizer.IsUnknown(token_id):
-                toktype = SentencePieceTokenTypes.UNKNOWN
-            elif tokenizer.IsControl(token_id):
-                toktype = SentencePieceTokenTypes.CONTROL
-            elif tokenizer.IsUnused(token_id):
-                toktype = SentencePieceTokenTypes.UNUSED
-            elif tokenizer.IsByte(token_id):
-                toktype = SentencePieceTokenTypes.BYTE
+        vocab_size = self.hparams.get('vocab_size', sentencepiece_model.vocab_size)
 
-            tokens[token_id] = text
-            scores[token_id] = score
-            toktypes[token_id] = toktype
+        tokens, scores, toktypes = sentencepiece_model.vocab(vocab_size)
 
         added_tokens_file = self.dir_model / 'added_tokens.json'
         if added_tokens_file.is_file():
@@ -2351,54 +2331,31 @@ class InternLM2Model(Model):
         # Copy from _set_vocab_sentencepiece, The only difference is that we will treat the character
         # \x00 specially and convert it into an emoji character to prevent it from being mistakenly
         # recognized as an empty string in C++.
-        from sentencepiece import SentencePieceProcessor
-        from sentencepiece import sentencepiece_model_pb2 as model
-
         tokenizer_path = self.dir_model / 'tokenizer.model'
 
-        tokens: list[bytes] = []
-        scores: list[float] = []
-        toktypes: list[int] = []
-
         if not tokenizer_path.is_file():
             logger.error(f'Error: Missing {tokenizer_path}')
             sys.exit(1)
 
-        sentencepiece_model = model.ModelProto()  # pyright: ignore[reportAttributeAccessIssue]
-        sentencepiece_model.ParseFromString(open(tokenizer_path, "rb").read())
-        add_prefix = sentencepiece_model.normalizer_spec.add_dummy_prefix
+        sentencepiece_model = SentencePieceModel.load(tokenizer_path)
+        add_prefix = sentencepiece_model.add_dummy_prefix
 
-        tokenizer = SentencePieceProcessor()
-        tokenizer.LoadFromFile(str(tokenizer_path))
+        vocab_size = self.hparams.get('vocab_size', sentencepiece_model.vocab_size)
+        if vocab_size > sentencepiece_model.vocab_size:
+            raise ValueError(f"vocab_size {vocab_size} is larger than the {sentencepiece_model.vocab_size} pieces of {tokenizer_path}")
 
-        vocab_size = self.hparams.get('vocab_size', tokenizer.vocab_size())
+        tokens, scores, toktypes = sentencepiece_model.vocab()
+        del tokens[vocab_size:], scores[vocab_size:], toktypes[vocab_size:]
 
-        for token_id in range(vocab_size):
-            piece = tokenizer.IdToPiece(token_id)
-            text = piece.encode("utf-8")
-            score = tokenizer.GetScore(token_id)
+        for token_id, text in enumerate(tokens):
             if text == b"\x00":
                 # (TODO): fixme
                 # Hack here and replace the \x00 characters.
                 logger.warning(f"InternLM2 convert token '{text}' to '🐉'!")
-                text = "🐉".encode("utf-8")
-
-            toktype = SentencePieceTokenTypes.NORMAL
-            if tokenizer.IsUnknown(token_id):
-                toktype = SentencePieceTokenTypes.UNKNOWN
-            elif tokenizer.IsControl(token_id):
-                toktype = SentencePieceTokenTypes.CONTROL
-            elif tokenizer.IsUnused(token_id):
-                toktype = SentencePieceTokenTypes.UNUSED
-            elif tokenizer.IsByte(token_id):
-                toktype = SentencePieceTokenTypes.BYTE
+                tokens[token_id] = "🐉".encode("utf-8")
             # take care of ununsed raw token
-            if piece.startswith('[UNUSED'):
-                toktype = SentencePieceTokenTypes.UNUSED
-
-            tokens.append(text)
-            scores.append(score)
-            toktypes.append(toktype)
+            elif text.startswith(b'[UNUSED'):
+                toktypes[token_id] = SentencePieceTokenTypes.UNUSED
 
         added_tokens_file = self.dir_model / 'added_tokens.json'
         if added_tokens_file.is_file():
@@ -2633,51 +2590,20 @@ class XLMRobertaModel(BertModel):
             self._position_offset = None
 
     def set_vocab(self):
-        # to avoid TypeError: Descriptors cannot be created directly
-        # exception when importing sentencepiece_model_pb2
-        os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
-        from sentencepiece import SentencePieceProcessor
-        from sentencepiece import sentencepiece_model_pb2 as model
-
         tokenizer_path = self.dir_model / 'sentencepiece.bpe.model'
         if not tokenizer_path.is_file():
             raise FileNotFoundError(f"File not found: {tokenizer_path}")
 
-        sentencepiece_model = model.ModelProto()  # pyright: ignore[reportAttributeAccessIssue]
-        sentencepiece_model.ParseFromString(open(tokenizer_path, "rb").read())
-        assert sentencepiece_model.trainer_spec.model_type == 1  # UNIGRAM
-
-        add_prefix = sentencepiece_model.normalizer_spec.add_dummy_prefix
-        remove_whitespaces = sentencepiece_model.normalizer_spec.remove_extra_whitespaces
-        precompiled_charsmap = sentencepiece_model.normalizer_spec.precompiled_charsmap
-
-        tokenizer = SentencePieceProcessor()
-        tokenizer.LoadFromFile(str(tokenizer_path))
+        sentencepiece_model = SentencePieceModel.load(tokenizer_path)
+        assert sentencepiece_model.model_type == 1  # UNIGRAM
 
-        vocab_size = self.hparams.get('vocab_size', tokenizer.vocab_size())
-
-        tokens: list[bytes] = [f"[PAD{i}]".encode("utf-8") for i in range(vocab_size)]
-        scores: list[float] = [-10000.0] * vocab_size
-        toktypes: list[int] = [SentencePieceTokenTypes.UNUSED] * vocab_size
-
-        for token_id in range(tokenizer.vocab_size()):
-            piece = tokenizer.IdToPiece(token_id)
-            text = piece.encode("utf-8")
-            score = tokenizer.GetScore(token_id)
+        add_prefix = sentencepiece_model.add_dummy_prefix
+        remove_whitespaces = sentencepiece_model.remove_extra_whitespaces
+        precompiled_charsmap = sentencepiece_model.precompiled_charsmap
 
-            toktype = SentencePieceTokenTypes.NORMAL
-            if tokenizer.IsUnknown(token_id):
-                toktype = SentencePieceTokenTypes.UNKNOWN
-            elif tokenizer.IsControl(token_id):
-                toktype = SentencePieceTokenTypes.CONTROL
-            elif tokenizer.IsUnused(token_id):
-                toktype = SentencePieceTokenTypes.UNUSED
-            elif tokenizer.IsByte(token_id):
-                toktype = SentencePieceTokenTypes.BYTE
+        vocab_size = self.hparams.get('vocab_size', sentencepiece_model.vocab_size)
 
-            tokens[token_id] = text
-            scores[token_id] = score
-            toktypes[token_id] = toktype
+        tokens, scores, toktypes = sentencepiece_model.vocab(vocab_size)
 
         if vocab_size > len(tokens):
             pad_count = vocab_size - len(tokens)
@@ -3043,8 +2969,6 @@ class OlmoeModel(Model):
         if (n_experts := self.hparams.get("num_experts")) is not None:
             self.gguf_writer.add_expert_count(n_experts)
 
-    _experts: list[dict[str, Tensor]] | None = None
-
     # Copied from: Qwen2MoeModel
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         # process the experts separately
@@ -3052,46 +2976,13 @@ class OlmoeModel(Model):
             n_experts = self.hparams["num_experts"]
             assert bid is not None
 
-            if self._experts is None:
-                self._experts = [{} for _ in range(self.block_count)]
-
-            self._experts[bid][name] = data_torch
-
-            if len(self._experts[bid]) >= n_experts * 3:
-                tensors: list[tuple[str, Tensor]] = []
-
-                # merge the experts into a single 3d tensor
-                for w_name in ["down_proj", "gate_proj", "up_proj"]:
-                    datas: list[Tensor] = []
-
-                    for xid in range(n_experts):
-                        ename = f"model.layers.{bid}.mlp.experts.{xid}.{w_name}.weight"
-                        datas.append(self._experts[bid][ename])
-                        del self._experts[bid][ename]
-
-                    data_torch = torch.stack(datas, dim=0)
-
-                    merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
-
-                    new_name = self.map_tensor_name(merged_name)
-
-                    tensors.append((new_name, data_torch))
-                return tensors
-            else:
-                return []
+            return [
+                (self.map_tensor_name(f"model.layers.{bid}.mlp.experts.{wid}.weight"), data_torch)
+                for wid, data_torch in self.merge_experts(name, data_torch, bid, n_experts, r"model\.layers\.\d+\.mlp\.experts\.(\d+)\.(\w+)\.weight", ["down_proj", "gate_proj", "up_proj"])
+            ]
 
         return [(self.map_tensor_name(name), data_torch)]
 
-    # Copied from: Qwen2MoeModel
-    def prepare_tensors(self):
-        super().prepare_tensors()
-
-        if self._experts is not None:
-            # flatten `list[dict[str, Tensor]]` into `list[str]`
-            experts = [k for d in self._experts for k in d.keys()]
-            if len(experts) > 0:
-                raise ValueError(f"Unprocessed experts: {experts}")
-
 
 @Model.register("JinaBertModel", "JinaBertForMaskedLM")
 class JinaBertV2Model(BertModel):
@@ -3223,8 +3114,6 @@ class ArcticModel(Model):
         # The reason for using a custom implementation here is that the
         # snowflake-arctic-instruct model redefined tokens 31998 and 31999 from
         # tokenizer.model and used them as BOS and EOS instead of adding new tokens.
-        from sentencepiece import SentencePieceProcessor
-
         tokenizer_path = self.dir_model / 'tokenizer.model'
 
         if not tokenizer_path.is_file():
@@ -3232,34 +3121,11 @@ class ArcticModel(Model):
             sys.exit(1)
 
         # Read the whole vocabulary from the tokenizer.model file
-        tokenizer = SentencePieceProcessor()
-        tokenizer.LoadFromFile(str(tokenizer_path))
-
-        vocab_size = self.hparams.get('vocab_size', tokenizer.vocab_size())
-
-        tokens: list[bytes] = [f"[PAD{i}]".encode("utf-8") for i in range(vocab_size)]
-        scores: list[float] = [-10000.0] * vocab_size
-        toktypes: list[int] = [SentencePieceTokenTypes.UNUSED] * vocab_size
-
-        for token_id in range(tokenizer.vocab_size()):
+        sentencepiece_model = SentencePieceModel.load(tokenizer_path)
 
-            piece = tokenizer.IdToPiece(token_id)
-            text = piece.encode("utf-8")
-            score = tokenizer.GetScore(token_id)
+        vocab_size = self.hparams.get('vocab_size', sentencepiece_model.vocab_size)
 
-            toktype = SentencePieceTokenTypes.NORMAL
-            if tokenizer.IsUnknown(token_id):
-                toktype = SentencePieceTokenTypes.UNKNOWN
-            elif tokenizer.IsControl(token_id):
-                toktype = SentencePieceTokenTypes.CONTROL
-            elif tokenizer.IsUnused(token_id):
-                toktype = SentencePieceTokenTypes.UNUSED
-            elif tokenizer.IsByte(token_id):
-                toktype = SentencePieceTokenTypes.BYTE
-
-            tokens[token_id] = text
-            scores[token_id] = score
-            toktypes[token_id] = toktype
+        tokens, scores, toktypes = sentencepiece_model.vocab(vocab_size)
 
         # Use the added_tokens_decoder field from tokeniser_config.json as the source
         # of information about added/redefined tokens and modify them accordingly.
@@ -3309,8 +3175,6 @@ class ArcticModel(Model):
         self.gguf_writer.add_vocab_size(hparams["vocab_size"])
         self.gguf_writer.add_rope_dimension_count(hparams["hidden_size"] // hparams["num_attention_heads"])
 
-    _experts: list[dict[str, Tensor]] | None = None
-
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         n_head = self.hparams["num_attention_heads"]
         n_kv_head = self.hparams.get("num_key_value_heads")
@@ -3326,45 +3190,13 @@ class ArcticModel(Model):
 
             assert bid is not None
 
-            if self._experts is None:
-                self._experts = [{} for _ in range(self.block_count)]
-
-            self._experts[bid][name] = data_torch
-
-            if len(self._experts[bid]) >= n_experts * 3:
-                tensors: list[tuple[str, Tensor]] = []
-
-                # merge the experts into a single 3d tensor
-                for wid in ["w1", "w2", "w3"]:
-                    datas: list[Tensor] = []
-
-                    for xid in range(n_experts):
-                        ename = f"model.layers.{bid}.block_sparse_moe.experts.{xid}.{wid}.weight"
-                        datas.append(self._experts[bid][ename])
-                        del self._experts[bid][ename]
-
-                    data_torch = torch.stack(datas, dim=0)
-
-                    merged_name = f"layers.{bid}.feed_forward.experts.{wid}.weight"
-
-                    new_name = self.map_tensor_name(merged_name)
-
-                    tensors.append((new_name, data_torch))
-                return tensors
-            else:
-                return []
+            return [
+                (self.map_tensor_name(f"layers.{bid}.feed_forward.experts.{wid}.weight"), data_torch)
+                for wid, data_torch in self.merge_experts(name, data_torch, bid, n_experts, r"model\.layers\.\d+\.block_sparse_moe\.experts\.(\d+)\.(\w+)\.weight", ["w1", "w2", "w3"])
+            ]
 
         return [(self.map_tensor_name(name), data_torch)]
 
-    def prepare_tensors(self):
-        super().prepare_tensors()
-
-        if self._experts is not None:
-            # flatten `list[dict[str, Tensor]]` into `list[str]`
-            experts = [k for d in self._experts for k in d.keys()]
-            if len(experts) > 0:
-                raise ValueError(f"Unprocessed experts: {experts}")
-
 
 @Model.register("DeepseekV2ForCausalLM")
 class DeepseekV2Model(Model):
@@ -3397,53 +3229,19 @@ class DeepseekV2Model(Model):
                 self.gguf_writer.add_rope_scaling_orig_ctx_len(self.hparams["rope_scaling"]["original_max_position_embeddings"])
                 self.gguf_writer.add_rope_scaling_yarn_log_mul(0.1 * hparams["rope_scaling"]["mscale_all_dim"])
 
-    _experts: list[dict[str, Tensor]] | None = None
-
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         # process the experts separately
         if name.find("mlp.experts") != -1:
             n_experts = self.hparams["n_routed_experts"]
             assert bid is not None
 
-            if self._experts is None:
-                self._experts = [{} for _ in range(self.block_count)]
-
-            self._experts[bid][name] = data_torch
-
-            if len(self._experts[bid]) >= n_experts * 3:
-                tensors: list[tuple[str, Tensor]] = []
-
-                # merge the experts into a single 3d tensor
-                for w_name in ["down_proj", "gate_proj", "up_proj"]:
-                    datas: list[Tensor] = []
-
-                    for xid in range(n_experts):
-                        ename = f"model.layers.{bid}.mlp.experts.{xid}.{w_name}.weight"
-                        datas.append(self._experts[bid][ename])
-                        del self._experts[bid][ename]
-
-                    data_torch = torch.stack(datas, dim=0)
-
-                    merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
-
-                    new_name = self.map_tensor_name(merged_name)
-
-                    tensors.append((new_name, data_torch))
-                return tensors
-            else:
-                return []
+            return [
+                (self.map_tensor_name(f"model.layers.{bid}.mlp.experts.{wid}.weight"), data_torch)
+                for wid, data_torch in self.merge_experts(name, data_torch, bid, n_experts, r"model\.layers\.\d+\.mlp\.experts\.(\d+)\.(\w+)\.weight", ["down_proj", "gate_proj", "up_proj"])
+            ]
 
         return [(self.map_tensor_name(name), data_torch)]
 
-    def prepare_tensors(self):
-        super().prepare_tensors()
-
-        if self._experts is not None:
-            # flatten `list[dict[str, Tensor]]` into `list[str]`
-            experts = [k for d in self._experts for k in d.keys()]
-            if len(experts) > 0:
-                raise ValueError(f"Unprocessed experts: {experts}")
-
 
 @Model.register("T5WithLMHeadModel")
 @Model.register("T5ForConditionalGeneration")
@@ -3457,12 +3255,6 @@ class T5Model(Model):
         self.shared_token_embeddings_found = False
 
     def set_vocab(self):
-        # to avoid TypeError: Descriptors cannot be created directly
-        # exception when importing sentencepiece_model_pb2
-        os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
-        from sentencepiece import SentencePieceProcessor
-        from sentencepiece import sentencepiece_model_pb2 as model
-
         tokenizer_path = self.dir_model / 'tokenizer.model'
 
         # many older models use spiece.model tokenizer model filename
@@ -3472,48 +3264,23 @@ class T5Model(Model):
         if not tokenizer_path.is_file():
             raise FileNotFoundError(f"File not found: {tokenizer_path}")
 
-        sentencepiece_model = model.ModelProto()  # pyright: ignore[reportAttributeAccessIssue]
-        sentencepiece_model.ParseFromString(open(tokenizer_path, "rb").read())
+        sentencepiece_model = SentencePieceModel.load(tokenizer_path)
 
         # some models like Pile-T5 family use BPE tokenizer instead of Unigram
-        if sentencepiece_model.trainer_spec.model_type == 2:  # BPE
+        if sentencepiece_model.model_type == 2:  # BPE
             # assure the tokenizer model file name is correct
             assert tokenizer_path.name == 'tokenizer.model'
             return self._set_vocab_sentencepiece()
         else:
-            assert sentencepiece_model.trainer_spec.model_type == 1  # UNIGRAM
-
-        add_prefix = sentencepiece_model.normalizer_spec.add_dummy_prefix
-        remove_whitespaces = sentencepiece_model.normalizer_spec.remove_extra_whitespaces
-        precompiled_charsmap = sentencepiece_model.normalizer_spec.precompiled_charsmap
-
-        tokenizer = SentencePieceProcessor()
-        tokenizer.LoadFromFile(str(tokenizer_path))
+            assert sentencepiece_model.model_type == 1  # UNIGRAM
 
-        vocab_size = self.hparams.get('vocab_size', tokenizer.vocab_size())
-
-        tokens: list[bytes] = [f"[PAD{i}]".encode("utf-8") for i in range(vocab_size)]
-        scores: list[float] = [-10000.0] * vocab_size
-        toktypes: list[int] = [SentencePieceTokenTypes.UNUSED] * vocab_size
-
-        for token_id in range(tokenizer.vocab_size()):
-            piece = tokenizer.IdToPiece(token_id)
-            text = piece.encode("utf-8")
-            score = tokenizer.GetScore(token_id)
+        add_prefix = sentencepiece_model.add_dummy_prefix
+        remove_whitespaces = sentencepiece_model.remove_extra_whitespaces
+        precompiled_charsmap = sentencepiece_model.precompiled_charsmap
 
-            toktype = SentencePieceTokenTypes.NORMAL
-            if tokenizer.IsUnknown(token_id):
-                toktype = SentencePieceTokenTypes.UNKNOWN
-            elif tokenizer.IsControl(token_id):
-                toktype = SentencePieceTokenTypes.CONTROL
-            elif tokenizer.IsUnused(token_id):
-                toktype = SentencePieceTokenTypes.UNUSED
-            elif tokenizer.IsByte(token_id):
-                toktype = SentencePieceTokenTypes.BYTE
+        vocab_size = self.hparams.get('vocab_size', sentencepiece_model.vocab_size)
 
-            tokens[token_id] = text
-            scores[token_id] = score
-            toktypes[token_id] = toktype
+        tokens, scores, toktypes = sentencepiece_model.vocab(vocab_size)
 
         added_tokens_file = self.dir_model / 'added_tokens.json'
         if added_tokens_file.is_file():
@@ -3597,12 +3364,6 @@ class T5EncoderModel(Model):
         self.shared_token_embeddings_found = False
 
     def set_vocab(self):
-        # to avoid TypeError: Descriptors cannot be created directly
-        # exception when importing sentencepiece_model_pb2
-        os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
-        from sentencepiece import SentencePieceProcessor
-        from sentencepiece import sentencepiece_model_pb2 as model
-
         tokenizer_path = self.dir_model / 'tokenizer.model'
 
         # many older models use spiece.model tokenizer model filename
@@ -3612,48 +3373,23 @@ class T5EncoderModel(Model):
         if not tokenizer_path.is_file():
             raise FileNotFoundError(f"File not found: {tokenizer_path}")
 
-        sentencepiece_model = model.ModelProto()  # pyright: ignore[reportAttributeAccessIssue]
-        sentencepiece_model.ParseFromString(open(tokenizer_path, "rb").read())
+        sentencepiece_model = SentencePieceModel.load(tokenizer_path)
 
         # some models like Pile-T5 family use BPE tokenizer instead of Unigram
-        if sentencepiece_model.trainer_spec.model_type == 2:  # BPE
+        if sentencepiece_model.model_type == 2:  # BPE
             # assure the tokenizer model file name is correct
             assert tokenizer_path.name == 'tokenizer.model'
             return self._set_vocab_sentencepiece()
         else:
-            assert sentencepiece_model.trainer_spec.model_type == 1  # UNIGRAM
+            assert sentencepiece_model.model_type == 1  # UNIGRAM
 
-        add_prefix = sentencepiece_model.normalizer_spec.add_dummy_prefix
-        remove_whitespaces = sentencepiece_model.normalizer_spec.remove_extra_whitespaces
-        precompiled_charsmap = sentencepiece_model.normalizer_spec.precompiled_charsmap
+        add_prefix = sentencepiece_model.add_dummy_prefix
+        remove_whitespaces = sentencepiece_model.remove_extra_whitespaces
+        precompiled_charsmap = sentencepiece_model.precompiled_charsmap
 
-        tokenizer = SentencePieceProcessor()
-        tokenizer.LoadFromFile(str(tokenizer_path))
-
-        vocab_size = self.hparams.get('vocab_size', tokenizer.vocab_size())
-
-        tokens: list[bytes] = [f"[PAD{i}]".encode("utf-8") for i in range(vocab_size)]
-        scores: list[float] = [-10000.0] * vocab_size
-        toktypes: list[int] = [SentencePieceTokenTypes.UNUSED] * vocab_size
-
-        for token_id in range(tokenizer.vocab_size()):
-            piece = tokenizer.IdToPiece(token_id)
-            text = piece.encode("utf-8")
-            score = tokenizer.GetScore(token_id)
-
-            toktype = SentencePieceTokenTypes.NORMAL
-            if tokenizer.IsUnknown(token_id):
-                toktype = SentencePieceTokenTypes.UNKNOWN
-            elif tokenizer.IsControl(token_id):
-                toktype = SentencePieceTokenTypes.CONTROL
-            elif tokenizer.IsUnused(token_id):
-                toktype = SentencePieceTokenTypes.UNUSED
-            elif tokenizer.IsByte(token_id):
-                toktype = SentencePieceTokenTypes.BYTE
+        vocab_size = self.hparams.get('vocab_size', sentencepiece_model.vocab_size)
 
-            tokens[token_id] = text
-            scores[token_id] = score
-            toktypes[token_id] = toktype
+        tokens, scores, toktypes = sentencepiece_model.vocab(vocab_size)
 
         added_tokens_file = self.dir_model / 'added_tokens.json'
         if added_tokens_file.is_file():
@@ -3800,9 +3536,14 @@ class JaisModel(Model):
         new_name = self.map_tensor_name(name)
 
         if new_name == self.format_tensor_name(gguf.MODEL_TENSOR.TOKEN_EMBD):
-            tensors.append((new_name, data_torch * self.embeddings_scale))
+            embd = data_torch * self.embeddings_scale
+            tensors.append((new_name, embd))
             if self.output_is_wte:
-                tensors.append((self.format_tensor_name(gguf.MODEL_TENSOR.OUTPUT), data_torch * self.width_scale))
+                # the same tensor is only converted once when the scales are the same,
+                # except on big endian, where the writer byteswaps it in-place and it can't be written twice
+                same = self.width_scale == self.embeddings_scale and not self.is_big_endian
+                output = embd if same else data_torch * self.width_scale
+                tensors.append((self.format_tensor_name(gguf.MODEL_TENSOR.OUTPUT), output))
         elif new_name == self.format_tensor_name(gguf.MODEL_TENSOR.OUTPUT):
             assert not self.output_is_wte
             tensors.append((new_name, data_torch * self.width_scale))
@@ -3813,7 +3554,8 @@ class JaisModel(Model):
 
     def prepare_tensors(self):
         super().prepare_tensors()
-        self.gguf_writer.add_max_alibi_bias(self.max_alibi_bias)
+        for output in self.outputs:
+            output.gguf_writer.add_max_alibi_bias(self.max_alibi_bias)
 
 
 @Model.register("ChatGLMModel", "ChatGLMForConditionalGeneration")
@@ -3889,26 +3631,12 @@ class ChatGLMModel(Model):
 
     @staticmethod
     def token_bytes_to_string(b):
-        from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
-        byte_encoder = bytes_to_unicode()
-        return ''.join([byte_encoder[ord(char)] for char in b.decode('latin-1')])
+        byte_encoder = gpt2_byte_encoder()
+        return ''.join([byte_encoder[c] for c in b])
 
     @staticmethod
     def bpe(mergeable_ranks: dict[bytes, int], token: bytes, max_rank: int | None = None) -> list[bytes]:
-        parts = [bytes([b]) for b in token]
-        while True:
-            min_idx = None
-            min_rank = None
-            for i, pair in enumerate(zip(parts[:-1], parts[1:])):
-                rank = mergeable_ranks.get(pair[0] + pair[1])
-                if rank is not None and (min_rank is None or rank < min_rank):
-                    min_idx = i
-                    min_rank = rank
-            if min_rank is None or (max_rank is not None and min_rank >= max_rank):
-                break
-            assert min_idx is not None
-            parts = parts[:min_idx] + [parts[min_idx] + parts[min_idx + 1]] + parts[min_idx + 2:]
-        return parts
+        return bpe_merge(mergeable_ranks, token, max_rank)
 
     def set_vocab(self):
         if "THUDM/chatglm3-6b" in self.hparams.get("_name_or_path", ""):
@@ -3930,11 +3658,12 @@ class ChatGLMModel(Model):
         merges = []
         vocab = {}
         mergeable_ranks = tokenizer.mergeable_ranks
+        token_merges = bpe_merges(mergeable_ranks, self.threads)
         for token, rank in mergeable_ranks.items():
             vocab[ChatGLMModel.token_bytes_to_string(token)] = rank
             if len(token) == 1:
                 continue
-            merged = ChatGLMModel.bpe(mergeable_ranks, token, max_rank=rank)
+            merged = token_merges[token]
             assert len(merged) >= 2 and len(merged) <= 7
             merges.append(' '.join(map(ChatGLMModel.token_bytes_to_string, merged)))
 
@@ -4212,6 +3941,354 @@ class ChameleonModel(Model):
 ###### CONVERSION LOGIC ######
 
 
+# The hashes of the tokens of chktxt for the known BPE pre-tokenizers, with where they come from.
+# NOTE: this file is generated by convert_hf_to_gguf_update.py
+#       do not modify it manually!
+# ref:  https://github.com/ggerganov/llama.cpp/pull/6920
+PRE_TOKENIZERS_PATH = Path(__file__).parent / "convert_hf_to_gguf_pre_tokenizers.json"
+
+
+@functools.lru_cache(maxsize=1)
+def load_pre_tokenizers() -> tuple[str, dict[str, dict[str, Any]]]:
+    with open(PRE_TOKENIZERS_PATH, "r", encoding="utf-8") as f:
+        registry = json.load(f)
+    # when models share a hash, the last one wins
+    return registry["chktxt"], {model["chkhsh"]: model for model in registry["models"]}
+
+
+# the maps are only read, so they can be shared by all the models converted in the same process
+@functools.lru_cache(maxsize=None)
+def tensor_name_map(arch: gguf.MODEL_ARCH, n_blocks: int) -> gguf.TensorNameMap:
+    return gguf.get_tensor_name_map(arch, n_blocks)
+
+
+@functools.lru_cache(maxsize=1)
+def gpt2_byte_encoder() -> dict[int, str]:
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+    return bytes_to_unicode()
+
+
+# Rebuilds how a token of a tiktoken-style vocab is split by its merges:
+# the adjacent parts with the lowest ranked merge (the leftmost one on ties) are merged until none ranks below max_rank.
+# The parts are kept as a linked list over the byte offsets of the token and the possible merges in a heap,
+# so that each merge only looks at its new neighbours instead of rescanning the whole token.
+def bpe_merge(mergeable_ranks: dict[bytes, int], token: bytes, max_rank: int | None = None) -> list[bytes]:
+    n = len(token)
+    # offset of the next part for each part start (-1 once merged into the previous part), and of the previous part
+    nxt = list(range(1, n + 1))
+    prv = list(range(-1, n - 1))
+    heap: list[tuple[int, int, int, int]] = []
+
+    def push_merge(i: int):
+        j = nxt[i]
+        if j < n:
+            k = nxt[j]
+            rank = mergeable_ranks.get(token[i:k])
+            if rank is not None and (max_rank is None or rank < max_rank):
+                heapq.heappush(heap, (rank, i, j, k))
+
+    for i in range(n - 1):
+        push_merge(i)
+
+    while heap:
+        _, i, j, k = heapq.heappop(heap)
+        # skip merges of parts which have changed since they were pushed
+        if nxt[i] != j or nxt[j] != k:
+            continue
+        nxt[i] = k
+        nxt[j] = -1
+        if k < n:
+            prv[k] = i
+        push_merge(i)
+        if prv[i] >= 0:
+            push_merge(prv[i])
+
+    parts: list[bytes] = []
+    i = 0
+    while i < n:
+        parts.append(token[i:nxt[i]])
+        i = nxt[i]
+    return parts
+
+
+_bpe_worker_ranks: dict[bytes, int] = {}
+
+
+def _bpe_worker_init(mergeable_ranks: dict[bytes, int]):
+    global _bpe_worker_ranks
+    _bpe_worker_ranks = mergeable_ranks
+
+
+def _bpe_worker_merges(tokens: list[tuple[bytes, int]]) -> list[list[bytes]]:
+    return [bpe_merge(_bpe_worker_ranks, token, max_rank=rank) for token, rank in tokens]
+
+
+# merges of all the multi-byte tokens of a vocab, each limited to the merges ranked before the token itself
+def bpe_merges(mergeable_ranks: dict[bytes, int], n_workers: int = 1, chunk_size: int = 16384) -> dict[bytes, list[bytes]]:
+    tokens = [(token, rank) for token, rank in mergeable_ranks.items() if len(token) > 1]
+    if n_workers <= 1 or len(tokens) <= chunk_size:
+        return {token: bpe_merge(mergeable_ranks, token, max_rank=rank) for token, rank in tokens}
+
+    chunks = [tokens[i:i + chunk_size] for i in range(0, len(tokens), chunk_size)]
+    # fork is not safe with the threads torch may have started
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_bpe_worker_init, initargs=(dict(mergeable_ranks),)) as executor:
+        merged = [parts for chunk_merges in executor.map(_bpe_worker_merges, chunks) for parts in chunk_merges]
+    return {token: parts for (token, _), parts in zip(tokens, merged)}
+
+
+def _pb_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _pb_skip(buf: bytes, pos: int, wire_type: int) -> int:
+    if wire_type == 0:
+        return _pb_varint(buf, pos)[1]
+    if wire_type == 1:
+        return pos + 8
+    if wire_type == 2:
+        length, pos = _pb_varint(buf, pos)
+        return pos + length
+    if wire_type == 5:
+        return pos + 4
+    raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+
+
+# the fields of a message as {field number: last value}, with the start and end of length-delimited values
+def _pb_fields(buf: bytes, start: int, end: int) -> dict[int, Any]:
+    fields: dict[int, Any] = {}
+    pos = start
+    while pos < end:
+        key, pos = _pb_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            fields[field], pos = _pb_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _pb_varint(buf, pos)
+            fields[field] = (pos, pos + length)
+            pos += length
+        elif wire_type == 5:
+            fields[field] = buf[pos:pos + 4]
+            pos += 4
+        else:
+            pos = _pb_skip(buf, pos, wire_type)
+    return fields
+
+
+# The vocab and normalizer settings of a sentencepiece model (tokenizer.model), read directly from its protobuf encoding,
+# instead of querying a SentencePieceProcessor for each token (and without needing the protobuf package).
+# The pieces are concatenated in a single buffer, and their scores and types are in numpy arrays.
+# ref: https://github.com/google/sentencepiece/blob/master/src/sentencepiece_model.proto
+@dataclass
+class SentencePieceModel:
+    pieces: bytes
+    # start of each piece in `pieces`, followed by the end of the last one
+    offsets: np.ndarray
+    scores: np.ndarray
+    # the ModelProto.SentencePiece.Type of each piece (same values as SentencePieceTokenTypes)
+    types: np.ndarray
+    # TrainerSpec.model_type (1: UNIGRAM, 2: BPE, 3: WORD, 4: CHAR)
+    model_type: int = 1
+    add_dummy_prefix: bool = True
+    remove_extra_whitespaces: bool = True
+    precompiled_charsmap: bytes = b""
+
+    # ModelProto field numbers
+    _PIECES = 1
+    _TRAINER_SPEC = 2
+    _NORMALIZER_SPEC = 3
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.scores)
+
+    @classmethod
+    def load(cls, path: Path) -> SentencePieceModel:
+        buf = path.read_bytes()
+        starts: list[int] = []
+        ends: list[int] = []
+        specs: dict[int, tuple[int, int]] = {}
+        pos = 0
+        while pos < len(buf):
+            if buf[pos] == 0x0a:
+                # a piece (field 1, length-delimited), nearly the whole file
+                length = buf[pos + 1]
+                if length < 0x80:
+                    start = pos + 2
+                else:
+                    length, start = _pb_varint(buf, pos + 1)
+                pos = start + length
+                starts.append(start)
+                ends.append(pos)
+                continue
+            key, pos = _pb_varint(buf, pos)
+            field, wire_type = key >> 3, key & 7
+            if wire_type == 2 and field in (cls._TRAINER_SPEC, cls._NORMALIZER_SPEC):
+                length, start = _pb_varint(buf, pos)
+                pos = start + length
+                specs[field] = (start, pos)
+            else:
+                pos = _pb_skip(buf, pos, wire_type)
+        if pos != len(buf):
+            raise ValueError(f"Truncated sentencepiece model {str(path)!r}")
+
+        pieces, offsets, scores, types = cls._parse_pieces(buf, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+        model = cls(pieces=pieces, offsets=offsets, scores=scores, types=types)
+
+        if cls._TRAINER_SPEC in specs:
+            trainer_spec = _pb_fields(buf, *specs[cls._TRAINER_SPEC])
+            model.model_type = trainer_spec.get(3, model.model_type)
+        if cls._NORMALIZER_SPEC in specs:
+            normalizer_spec = _pb_fields(buf, *specs[cls._NORMALIZER_SPEC])
+            if 2 in normalizer_spec:
+                model.precompiled_charsmap = buf[slice(*normalizer_spec[2])]
+            model.add_dummy_prefix = bool(normalizer_spec.get(3, model.add_dummy_prefix))
+            model.remove_extra_whitespaces = bool(normalizer_spec.get(4, model.remove_extra_whitespaces))
+        return model
+
+    # The pieces are nearly always encoded as their piece (field 1), score (field 2) and optional type (field 3), in that order,
+    # with a piece shorter than 128 bytes. Those are decoded all at once with numpy, and the others one by one.
+    @staticmethod
+    def _parse_pieces(buf: bytes, starts: np.ndarray, ends: np.ndarray) -> tuple[bytes, np.ndarray, np.ndarray, np.ndarray]:
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        last = len(buf) - 1
+        piece_len = raw[np.minimum(starts + 1, last)].astype(np.int64)
+        piece_start = starts + 2
+        score_key = piece_start + piece_len
+        has_type = ends == score_key + 7
+        fast = ((ends - starts >= 7) & (raw[np.minimum(starts, last)] == 0x0a) & (piece_len < 0x80)
+                & (raw[np.minimum(score_key, last)] == 0x15)
+                & ((ends == score_key + 5) | (has_type & (raw[np.minimum(score_key + 5, last)] == 0x18) & (raw[np.minimum(ends - 1, last)] < 0x80))))
+
+        piece_end = score_key.copy()
+        scores = np.zeros(len(starts), dtype=np.float32)
+        types = np.full(len(starts), SentencePieceTokenTypes.NORMAL, dtype=np.int32)
+        if fast.all():
+            scores[:] = raw[(score_key + 1)[:, None] + np.arange(4)].reshape(-1).view("<f4")
+        else:
+            scores[fast] = raw[(score_key[fast] + 1)[:, None] + np.arange(4)].reshape(-1).view("<f4")
+        types[has_type & fast] = raw[ends[has_type & fast] - 1]
+
+        for i in np.flatnonzero(~fast).tolist():
+            fields = _pb_fields(buf, int(starts[i]), int(ends[i]))
+            piece_start[i], piece_end[i] = fields.get(1, (0, 0))
+            if 2 in fields:
+                scores[i] = struct.unpack("<f", fields[2])[0]
+            types[i] = fields.get(3, SentencePieceTokenTypes.NORMAL)
+
+        # gather all the pieces into a single buffer
+        lengths = piece_end - piece_start
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        index = np.repeat(piece_start - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return raw[index].tobytes(), offsets, scores, types
+
+    def piece(self, token_id: int) -> bytes:
+        return self.pieces[self.offsets[token_id]:self.offsets[token_id + 1]]
+
+    # The tokens, scores and token types of the pieces, padded up to vocab_size (like the loops this replaces did
+    # with SentencePieceProcessor). The token types are the ones the processor reports: user-defined pieces are normal.
+    def vocab(self, vocab_size: int | None = None) -> tuple[list[bytes], list[float], list[int]]:
+        offsets = self.offsets.tolist()
+        tokens = [self.pieces[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        scores: list[float] = self.scores.tolist()
+        type_map = np.array([
+            SentencePieceTokenTypes.NORMAL,
+            SentencePieceTokenTypes.NORMAL,
+            SentencePieceTokenTypes.UNKNOWN,
+            SentencePieceTokenTypes.CONTROL,
+            SentencePieceTokenTypes.NORMAL,  # USER_DEFINED
+            SentencePieceTokenTypes.UNUSED,
+            SentencePieceTokenTypes.BYTE,
+        ], dtype=np.int32)
+        toktypes: list[int] = type_map[np.where((self.types >= 0) & (self.types < len(type_map)), self.types, 0)].tolist()
+
+        if vocab_size is not None and vocab_size > len(tokens):
+            pad_range = range(len(tokens), vocab_size)
+            tokens += [f"[PAD{i}]".encode("utf-8") for i in pad_range]
+            scores += [-10000.0] * len(pad_range)
+            toktypes += [SentencePieceTokenTypes.UNUSED] * len(pad_range)
+        return tokens, scores, toktypes
+
+
+# memory-mapped safetensors file, with tensors exposed as numpy views into the mapping
+# ref: https://github.com/huggingface/safetensors#format
+class SafetensorsFile:
+    path: Path
+    metadata: dict[str, str]
+    tensors: dict[str, dict[str, Any]]
+
+    # types numpy doesn't have are viewed as unsigned integers of the same size
+    _dtype_map: dict[str, type] = {
+        "F64": np.float64,
+        "F32": np.float32,
+        "BF16": np.uint16,
+        "F16": np.float16,
+        "I64": np.int64,
+        "I32": np.int32,
+        "I16": np.int16,
+        "U8": np.uint8,
+        "I8": np.int8,
+        "BOOL": np.bool_,
+        "F8_E4M3": np.uint8,
+        "F8_E5M2": np.uint8,
+    }
+
+    def __init__(self, path: Path, profiler: StageProfiler | None = None):
+        self.path = path
+        self.profiler = profiler
+        # copy-on-write, so that the views are writable without ever modifying the file
+        self._data = np.memmap(path, dtype=np.uint8, mode="c")
+        header_len = int(self._data[:8].view("<u8")[0])
+        header: dict[str, Any] = json.loads(bytes(self._data[8:8 + header_len]))
+        self.metadata = header.pop("__metadata__", None) or {}
+        self.tensors = header
+        self._data_start = 8 + header_len
+
+    def keys(self) -> Iterable[str]:
+        return self.tensors.keys()
+
+    def get_dtype(self, name: str) -> str:
+        return self.tensors[name]["dtype"]
+
+    def get_shape(self, name: str) -> tuple[int, ...]:
+        return tuple(self.tensors[name]["shape"])
+
+    def get_numpy(self, name: str) -> np.ndarray:
+        info = self.tensors[name]
+        start, end = info["data_offsets"]
+        dtype = np.dtype(self._dtype_map[info["dtype"]]).newbyteorder("<")
+        data = self._data[self._data_start + start:self._data_start + end]
+        return data.view(dtype).reshape(tuple(info["shape"]))
+
+    # The data of a tensor to convert.
+    # When profiling, the pages of the mapping are read here in a "read" stage, instead of wherever they are first used.
+    def read_numpy(self, name: str) -> np.ndarray:
+        data = self.get_numpy(name)
+        if self.profiler is not None:
+            with self.profiler.stage("read", name, data.nbytes):
+                # reading a byte of each page is enough
+                data.reshape(-1).view(np.uint8)[::mmap.PAGESIZE].sum()
+        return data
+
+
+AnyLazy = TypeVar("AnyLazy", bound=gguf.LazyBase)
+
+
+# a lazy tensor computed with func(*args, **kwargs) once its args are evaluated
+# (gguf.LazyBase annotates its func as taking a single argument)
+def new_lazy(cls: type[AnyLazy], meta: Any, func: Callable[..., Any], args: tuple[Any, ...] = (), kwargs: dict[str, Any] | None = None) -> AnyLazy:
+    return cls(meta=meta, args=args, kwargs=kwargs, func=func)
+
+
 # tree of lazy tensors
 class LazyTorchTensor(gguf.LazyBase):
     _tensor_type = torch.Tensor
@@ -4265,6 +4342,48 @@ class LazyTorchTensor(gguf.LazyBase):
         lazy = cls(meta=cls.meta_with_dtype_and_shape(dtype, shape), args=(st_slice,), func=lambda s: s[:])
         return cast(torch.Tensor, lazy)
 
+    # zero-copy, the resulting tensor shares memory with the mapped file
+    @classmethod
+    def load_from_safetensors_file(cls, st_file: SafetensorsFile, name: str) -> Tensor:
+        dtype = cls._dtype_str_map[st_file.get_dtype(name)]
+        data = st_file.read_numpy(name)
+        if data.dtype == np.uint16:
+            # torch has limited support for uint16
+            data = data.view(np.int16)
+        tensor = torch.from_numpy(data)
+        return tensor if tensor.dtype == dtype else tensor.view(dtype)
+
+    @classmethod
+    def from_safetensors_file(cls, st_file: SafetensorsFile, name: str) -> Tensor:
+        dtype = cls._dtype_str_map[st_file.get_dtype(name)]
+        shape = st_file.get_shape(name)
+        lazy = new_lazy(cls, cls.meta_with_dtype_and_shape(dtype, shape), cls.load_from_safetensors_file, (st_file, name))
+        lazy._source = (st_file, name)
+        return cast(torch.Tensor, lazy)
+
+    # where the tensor comes from, when it was read as-is from a safetensors file
+    _source: tuple[SafetensorsFile, str] | None = None
+
+    # the data of a tensor as stored in the model file, without going through torch (when possible)
+    @classmethod
+    def numpy_source(cls, t: Tensor) -> np.ndarray | None:
+        if isinstance(t, LazyTorchTensor):
+            if t._source is None:
+                return None
+            st_file, name = t._source
+            data = st_file.get_numpy(name)  # only a view, nothing is read yet
+            return cast(np.ndarray, gguf.LazyNumpyTensor(
+                meta=gguf.LazyNumpyTensor.meta_with_dtype_and_shape(data.dtype, data.shape),
+                args=(st_file, name),
+                func=SafetensorsFile.read_numpy,
+            ))
+        if isinstance(t, torch.Tensor) and t.dtype in cls._dtype_map:
+            return t.numpy()
+        if isinstance(t, torch.Tensor) and t.dtype == torch.bfloat16:
+            # same representation as SafetensorsFile.get_numpy
+            return t.view(torch.int16).numpy().view(np.uint16)
+        return None
+
     @classmethod
     def __torch_function__(cls, func, types, args=(), kwargs=None):
         del types  # unused
@@ -4278,6 +4397,1163 @@ class LazyTorchTensor(gguf.LazyBase):
         return cls._wrap_fn(func)(*args, **kwargs)
 
 
+# merged 3d tensor of the experts of a MoE block for a single weight id, filled one expert at a time
+class ExpertStack:
+    def __init__(self, n_experts: int, budget: MemoryBudget | None = None):
+        self.n_experts = n_experts
+        self.budget = budget
+        self.n_added = 0
+        self._experts: list[Tensor | None] = [None] * n_experts
+        self._seen = [False] * n_experts
+        # eager tensors are copied into a preallocated buffer, so that they can be freed right away
+        self._data: Tensor | None = None
+
+    def add(self, xid: int, data_torch: Tensor, name: str):
+        if not 0 <= xid < self.n_experts:
+            raise ValueError(f"Expert id out of range ({xid} >= {self.n_experts}) for {name!r}")
+        if self._seen[xid]:
+            raise ValueError(f"Duplicated expert tensor {name!r}")
+        self._seen[xid] = True
+        self.n_added += 1
+
+        if type(data_torch) is torch.Tensor:
+            if self._data is None:
+                self._data = self._empty((self.n_experts, *data_torch.shape), data_torch.dtype)
+            self._data[xid].copy_(data_torch)
+        else:
+            self._experts[xid] = data_torch
+
+    def is_complete(self) -> bool:
+        return self.n_added == self.n_experts
+
+    def _empty(self, shape: Sequence[int], dtype: torch.dtype) -> Tensor:
+        if self.budget is None:
+            return torch.empty(shape, dtype=dtype)
+        return self.budget.empty(shape, dtype)
+
+    def stack(self) -> Tensor:
+        assert self.is_complete()
+        if self._data is not None:
+            return self._data
+        experts = cast("list[Tensor]", self._experts)
+        if all(isinstance(e, LazyTorchTensor) for e in experts):
+            first = cast(LazyTorchTensor, experts[0])
+            meta = LazyTorchTensor.meta_with_dtype_and_shape(first.dtype, (self.n_experts, *first.shape))
+            return cast(torch.Tensor, new_lazy(LazyTorchTensor, meta, self._stack_lazy))
+        # e.g. LoraTorchTensor, which knows how to stack itself
+        return torch.stack(experts, dim=0)
+
+    # evaluates the experts one by one directly into the merged tensor,
+    # instead of materializing all of them before a torch.stack
+    def _stack_lazy(self) -> Tensor:
+        data: Tensor | None = None
+        for xid in range(self.n_experts):
+            expert = LazyTorchTensor.to_eager(self._experts[xid])
+            self._experts[xid] = None
+            if data is None:
+                data = self._empty((self.n_experts, *expert.shape), expert.dtype)
+            data[xid].copy_(expert)
+            del expert
+        assert data is not None
+        return data
+
+
+# Finds the tensors written more than once, so that they are converted and quantized only once.
+# A tensor is the same as an earlier one when modify_tensors returns the same tensor object for both names
+# (e.g. tied embeddings written as both token_embd and output), or when both are used as-is from the model files
+# and have identical data (e.g. a lm_head.weight saved as a copy of embed_tokens.weight).
+# To find the latter without hashing every tensor, only the tensors with the same shape, type and sampled bytes
+# as an earlier one are hashed completely, from their memory-mapped files.
+class TensorDedup:
+    sample_size: int = 4096
+    hash_chunk_size: int = 1 << 24
+
+    n_reused: int
+    nbytes_saved: int
+
+    def __init__(self, budget: MemoryBudget | None = None):
+        self.n_reused = 0
+        self.nbytes_saved = 0
+        # the tensors returned by modify_tensors for the current source tensor, by id (only kept until the next one)
+        self._current: dict[int, tuple[Tensor, str]] = {}
+        # the tensors used as-is from the model files, by type, shape and hash of sampled bytes
+        self._by_sample: dict[tuple[str, tuple[int, ...], str], list[tuple[SafetensorsFile, str, str]]] = {}
+        self._digests: dict[tuple[int, str], str] = {}
+        # the quantized tensors, by name, output index and requested type.
+        # Lazy tensors stay cached in them once evaluated, so they must not be kept after prepare_tensors.
+        self._results: dict[tuple[str, int, gguf.GGMLQuantizationType], tuple[gguf.GGMLQuantizationType, np.ndarray]] = {}
+        # a reused lazy result stays cached from the write of its first name to the write of its last one,
+        # so it is held in the memory budget until then (and already before its first write, to keep it simple)
+        self.budget = budget
+        self._held: set[int] = set()
+
+    def next_source(self):
+        self._current = {}
+
+    def _sample_hash(self, data: np.ndarray) -> str:
+        raw = data.reshape(-1).view(np.uint8)
+        n = self.sample_size
+        if raw.nbytes <= 3 * n:
+            return sha256(raw.tobytes()).hexdigest()
+        h = sha256()
+        for start in (0, (raw.nbytes - n) // 2, raw.nbytes - n):
+            h.update(raw[start:start + n].tobytes())
+        return h.hexdigest()
+
+    def _digest(self, st_file: SafetensorsFile, name: str) -> str:
+        key = (id(st_file), name)
+        digest = self._digests.get(key)
+        if digest is None:
+            raw = st_file.get_numpy(name).reshape(-1).view(np.uint8)
+            h = sha256()
+            for start in range(0, raw.nbytes, self.hash_chunk_size):
+                h.update(raw[start:start + self.hash_chunk_size].data)
+            digest = self._digests[key] = h.hexdigest()
+        return digest
+
+    # the name of an earlier tensor with the same data, if any.
+    # `source` is the safetensors file and name of the tensor when modify_tensors returned it unmodified.
+    def find(self, name: str, data_torch: Tensor, source: tuple[SafetensorsFile, str] | None) -> str | None:
+        same = self._current.get(id(data_torch))
+        if same is None:
+            self._current[id(data_torch)] = (data_torch, name)
+            if source is None:
+                return None
+            st_file, source_name = source
+            data = st_file.get_numpy(source_name)  # only a view, nothing is read yet
+            candidates = self._by_sample.setdefault((data.dtype.str, data.shape, self._sample_hash(data)), [])
+            for other_file, other_source_name, other_name in candidates:
+                if self._digest(other_file, other_source_name) == self._digest(st_file, source_name):
+                    same = (data_torch, other_name)
+                    break
+            else:
+                candidates.append((st_file, source_name, name))
+                return None
+        self.n_reused += 1
+        return same[1]
+
+    def reuse(self, same_as: str | None, index: int, qtype: gguf.GGMLQuantizationType, nbytes: int) -> tuple[gguf.GGMLQuantizationType, np.ndarray] | None:
+        if same_as is None:
+            return None
+        result = self._results.get((same_as, index, qtype))
+        if result is not None:
+            self.nbytes_saved += nbytes
+            data = result[1]
+            if self.budget is not None and isinstance(data, gguf.LazyNumpyTensor) and id(data) not in self._held:
+                self._held.add(id(data))
+                self.budget.hold(data, math.prod(data.shape) * data.dtype.itemsize)
+        return result
+
+    def store(self, name: str, index: int, qtype: gguf.GGMLQuantizationType, result_qtype: gguf.GGMLQuantizationType, data: np.ndarray):
+        self._results[(name, index, qtype)] = (result_qtype, data)
+
+
+def tensor_nbytes(t: Tensor) -> int:
+    # LoRA tensors (in convert_lora_to_gguf.py) only hold their A and B tensors, not the product they stand for
+    get_lora_A_B = getattr(t, "get_lora_A_B", None)
+    if get_lora_A_B is not None:
+        return sum(tensor_nbytes(x) for x in get_lora_A_B())
+    # also works with lazy tensors
+    return math.prod(t.shape) * torch.empty((), dtype=t.dtype, device="meta").element_size()
+
+
+# numpy has no bfloat16 type, so bfloat16 tensors are handled as their raw bits (in uint16 arrays)
+
+def bf16_to_f16(bits: np.ndarray) -> np.ndarray:
+    # this rounds exactly like a float32 to float16 cast does, but without the float32 upcast
+    shape = bits.shape
+    bits = np.ascontiguousarray(bits).reshape(-1)
+    out = np.empty_like(bits)
+    # chunked, to keep the temporaries small
+    chunk_size = 1 << 20
+    for i in range(0, bits.size, chunk_size):
+        b = bits[i:i + chunk_size]
+        sign = b & 0x8000
+        exp = (b >> 7) & 0xff
+        man = b & 0x7f
+        # float16 normals can hold the 7 bits of the mantissa exactly
+        res = ((exp - 112) << 10) | (man << 3)
+        # float16 subnormals, rounded to nearest even
+        full = np.where(exp == 0, man, man | 0x80)
+        sub_exp = exp.astype(np.int16)
+        lshift = np.clip(sub_exp - 110, 0, 2).astype(np.uint16)
+        rshift = np.clip(110 - sub_exp, 0, 9).astype(np.uint16)
+        sub = (full << lshift) >> rshift
+        rem = full & ((np.uint16(1) << rshift) - 1)
+        half = (np.uint16(1) << rshift) >> 1
+        sub += (rem > half) | ((rem == half) & (rshift > 0) & ((sub & 1) == 1))
+        res = np.where(exp <= 112, sub, res)
+        # overflow to inf, then inf and nan (the nan payload is kept, like numpy does)
+        res = np.where(exp >= 143, 0x7c00, res)
+        res = np.where(exp == 255, 0x7c00 | (man << 3), res)
+        out[i:i + chunk_size] = sign | res
+    return out.view(np.float16).reshape(shape)
+
+
+def bf16_quiet_nan(bits: np.ndarray) -> np.ndarray:
+    # same as what gguf.quants does when converting float32 to bfloat16
+    shape = bits.shape
+    bits = np.ascontiguousarray(bits).reshape(-1)
+    out = np.empty_like(bits)
+    chunk_size = 1 << 20
+    for i in range(0, bits.size, chunk_size):
+        b = bits[i:i + chunk_size]
+        out[i:i + chunk_size] = np.where((b & 0x7fff) > 0x7f80, b | 0x40, b)
+    return out.reshape(shape)
+
+
+def bf16_to_f32(bits: np.ndarray) -> np.ndarray:
+    return (bits.astype(np.uint32) << 16).view(np.float32)
+
+
+def quantize_bf16(data: np.ndarray, qtype: gguf.GGMLQuantizationType, n_threads: int = 1) -> np.ndarray:
+    if isinstance(data, gguf.LazyNumpyTensor):
+        # the result has the same meta as when quantizing the float32 values (this doesn't evaluate anything)
+        meta = gguf.quants.quantize(data.astype(np.float32), qtype)
+        return cast(np.ndarray, new_lazy(
+            gguf.LazyNumpyTensor,
+            gguf.LazyNumpyTensor.meta_with_dtype_and_shape(meta.dtype, meta.shape),
+            quantize_bf16,
+            args=(data, qtype, n_threads),
+        ))
+    if qtype == gguf.GGMLQuantizationType.BF16:
+        data = bf16_quiet_nan(data)
+        return data.view(np.uint8).reshape((*data.shape[:-1], data.shape[-1] * 2))
+    if qtype == gguf.GGMLQuantizationType.F16:
+        return bf16_to_f16(data)
+    return quantize_tensor(data, qtype, n_threads)
+
+
+# Writes the tensors of multiple outputs having the same tensors (possibly with different types),
+# one tensor at a time across all the outputs, so that a source tensor is only needed once for all of them.
+# The headers and KV data of the writers must have already been written.
+# With journals (see ShardJournal), the tensors already written by a previous run are skipped.
+def write_tensors_to_files(writers: Sequence[gguf.GGUFWriter], progress: bool = False, journals: Sequence[Sequence[ShardJournal]] | None = None):
+    tensors: list[list[tuple[gguf.GGUFWriter, Any, str, Any, ShardJournal | None]]] = []
+    for i, writer in enumerate(writers):
+        writer.write_ti_data_to_file()
+        assert writer.fout is not None
+        for fout in writer.fout:
+            writer.write_padding(fout, fout.tell())
+        writer_journals = ShardJournal.open_all(writer, journals[i]) if journals is not None else [None] * len(writer.fout)
+        tensors.append([(writer, fout, name, ti, journal) for fout, shard, journal in zip(writer.fout, writer.tensors, writer_journals) for name, ti in shard.items()])
+
+    assert len(set(len(t) for t in tensors)) == 1, "all outputs must have the same tensors"
+
+    bar = None
+    if progress:
+        from tqdm import tqdm
+
+        total_bytes = sum(ti.nbytes for t in tensors for _, _, _, ti, _ in t)
+        bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
+
+    for same_tensors in zip(*tensors):
+        for writer, fout, name, ti, journal in same_tensors:
+            assert ti.tensor is not None  # can only iterate once over the tensors
+            assert ti.tensor.nbytes == ti.nbytes
+            if journal is None:
+                ti.tensor.tofile(fout)
+                writer.write_padding(fout, ti.nbytes)
+            elif name in journal.pending:
+                journal.write(writer, fout, name, gguf.LazyNumpyTensor.to_eager(ti.tensor))
+            ti.tensor = None
+            if bar is not None:
+                bar.update(ti.nbytes)
+
+    if bar is not None:
+        bar.close()
+    for writer in writers:
+        writer.state = gguf.WriterState.WEIGHTS
+
+
+# Accounts for the bytes of the tensors materialized while converting, shared by everything producing them.
+# Producers (the shard writer threads, the read stage of the streaming pipeline and the look-ahead of the quantization pool)
+# wait or hold back while the tensors in flight fill the budget, but a tensor bigger than the budget can still go through alone.
+# Buffers which can't wait (like the merged experts) are spilled to a temporary file when they don't fit, as a last resort.
+class MemoryBudget:
+    max_bytes: int
+    # bytes of the tensors between acquire() and release()
+    in_use: int
+    # bytes of the buffers allocated with empty(), until they are garbage collected
+    scratch: int
+    peak: int
+    spilled: int
+
+    def __init__(self, max_bytes: int = 0, spill_dir: Path | None = None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.in_use = 0
+        self.scratch = 0
+        self.peak = 0
+        self.spilled = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, nbytes: int) -> bool:
+        return self.max_bytes <= 0 or self.in_use + self.scratch + nbytes <= self.max_bytes
+
+    def _add(self, nbytes: int):
+        self.in_use += nbytes
+        self.peak = max(self.peak, self.in_use + self.scratch)
+
+    def acquire(self, nbytes: int):
+        with self._cond:
+            # waiting only makes sense while some tensors in flight will be released
+            while self.in_use > 0 and not self._fits(nbytes):
+                self._cond.wait()
+            self._add(nbytes)
+
+    def try_acquire(self, nbytes: int) -> bool:
+        with self._cond:
+            if not self._fits(nbytes):
+                return False
+            self._add(nbytes)
+            return True
+
+    # for the tensors which are needed right away, whether they fit or not
+    def reserve(self, nbytes: int):
+        with self._cond:
+            self._add(nbytes)
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self.in_use -= nbytes
+            self._cond.notify_all()
+
+    # for the data kept by `owner` outside of acquire() and release(), until it is garbage collected
+    # (e.g. a lazy result written under two names, which stays cached from its first write to its last)
+    def hold(self, owner: Any, nbytes: int):
+        with self._cond:
+            self.scratch += nbytes
+            self.peak = max(self.peak, self.in_use + self.scratch)
+        weakref.finalize(owner, self._release_scratch, nbytes)
+
+    def _release_scratch(self, nbytes: int):
+        with self._cond:
+            self.scratch -= nbytes
+            self._cond.notify_all()
+
+    def empty(self, shape: Sequence[int], dtype: torch.dtype) -> Tensor:
+        nbytes = math.prod(shape) * torch.empty((), dtype=dtype, device="meta").element_size()
+        with self._cond:
+            fits = nbytes == 0 or self._fits(nbytes)
+            if fits:
+                self.scratch += nbytes
+                self.peak = max(self.peak, self.in_use + self.scratch)
+        if fits:
+            data = torch.empty(shape, dtype=dtype)
+            weakref.finalize(data, self._release_scratch, nbytes)
+            return data
+
+        fd, path = tempfile.mkstemp(prefix="gguf-spill-", suffix=".bin", dir=self.spill_dir)
+        try:
+            os.ftruncate(fd, nbytes)
+        finally:
+            os.close(fd)
+        data = torch.from_file(path, shared=True, size=math.prod(shape), dtype=dtype).view(*shape)
+        try:
+            # the mapping stays valid without its file
+            os.remove(path)
+        except OSError:
+            # except on Windows, where it can only be removed once unused
+            weakref.finalize(data, remove_quietly, path)
+        with self._cond:
+            self.spilled += nbytes
+        logger.debug(f"spilled a {gguf.GGUFWriter.format_n_bytes_to_str(nbytes)} buffer to {path}")
+        return data
+
+
+def remove_quietly(path: str):
+    with contextlib.suppress(OSError):
+        os.remove(path)
+
+
+# Writes all the shards of the outputs at once, with one thread per shard.
+# The shard plan (which tensors go in which file, and at which offset) is already fixed by the tensor infos,
+# so each shard can be filled independently, and the result is identical to writing them one after the other.
+# Only the evaluation of lazy tensors is serialized, because lazy tensors can share their sources
+# (e.g. fused tensors split in modify_tensors, or the same tensor quantized for each output),
+# and they can't be evaluated from multiple threads at once.
+# The tensors evaluated and not yet written are accounted for in the memory budget, across all the shards.
+# The headers and KV data of the writers must have already been written.
+# With journals (see ShardJournal), the tensors already written by a previous run are skipped.
+def write_shards_in_parallel(writers: Sequence[gguf.GGUFWriter], budget: MemoryBudget, progress: bool = False,
+                             journals: Sequence[Sequence[ShardJournal]] | None = None):
+    shards: list[tuple[gguf.GGUFWriter, Any, list[tuple[str, Any]], ShardJournal | None]] = []
+    for i, writer in enumerate(writers):
+        writer.write_ti_data_to_file()
+        assert writer.fout is not None
+        for fout in writer.fout:
+            writer.write_padding(fout, fout.tell())
+        writer_journals = ShardJournal.open_all(writer, journals[i]) if journals is not None else [None] * len(writer.fout)
+        for fout, shard, journal in zip(writer.fout, writer.tensors, writer_journals):
+            shards.append((writer, fout, list(shard.items()), journal))
+
+    bar = None
+    if progress:
+        from tqdm import tqdm
+
+        total_bytes = sum(ti.nbytes for _, _, tensors, _ in shards for _, ti in tensors)
+        bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
+
+    eval_lock = threading.Lock()
+    bar_lock = threading.Lock()
+    errors: list[BaseException] = []
+
+    def write_shard(writer: gguf.GGUFWriter, fout: Any, tensors: list[tuple[str, Any]], journal: ShardJournal | None):
+        try:
+            for name, ti in tensors:
+                if errors:
+                    return
+                assert ti.tensor is not None  # can only iterate once over the tensors
+                if journal is not None and name not in journal.pending:
+                    ti.tensor = None
+                else:
+                    budget.acquire(ti.nbytes)
+                    try:
+                        with eval_lock:
+                            data = gguf.LazyNumpyTensor.to_eager(ti.tensor)
+                        ti.tensor = None
+                        assert data.nbytes == ti.nbytes
+                        if journal is not None:
+                            journal.write(writer, fout, name, data)
+                        else:
+                            data.tofile(fout)
+                            writer.write_padding(fout, ti.nbytes)
+                        del data
+                    finally:
+                        budget.release(ti.nbytes)
+                if bar is not None:
+                    with bar_lock:
+                        bar.update(ti.nbytes)
+            fout.flush()
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write_shard, args=shard, name=f"gguf-shard-{i}", daemon=True) for i, shard in enumerate(shards)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if bar is not None:
+        bar.close()
+    if errors:
+        raise errors[0]
+    for writer in writers:
+        writer.state = gguf.WriterState.WEIGHTS
+
+
+def file_region_sha256(f: Any, offset: int, nbytes: int, chunk_size: int = 1 << 24) -> str:
+    h = sha256()
+    f.seek(offset)
+    while nbytes > 0:
+        chunk = f.read(min(nbytes, chunk_size))
+        if len(chunk) == 0:
+            break
+        h.update(chunk)
+        nbytes -= len(chunk)
+    return h.hexdigest()
+
+
+# Journal of the tensors written to a shard (in <shard>.journal), so that an interrupted conversion can be resumed
+# without converting and writing the same tensors again. The journal is removed once the conversion is done.
+# The first line identifies the metadata of the shard (header, KV data and tensor infos), which also fixes the offset of each tensor.
+# Each other line records a tensor (name, offset, size and sha256) whose data was synced to disk before the line was written.
+class ShardJournal:
+    # bump when the journal format changes
+    version: int = 1
+
+    path: Path
+    journal_path: Path
+    # the tensors still to write, with their offset in the shard
+    pending: dict[str, int]
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.journal_path = path.with_name(f"{path.name}.journal")
+        self.pending = {}
+        self._journal: Any = None
+
+    # Instead of GGUFWriter.open_output_file, which truncates the shards, the metadata of the writer
+    # is written to memory, to be compared with the shards written by a previous run in open().
+    @staticmethod
+    def prepare(writer: gguf.GGUFWriter, path: Path) -> list[ShardJournal]:
+        writer.path = path
+        filenames = writer.print_plan()
+        writer.fout = [cast(Any, io.BytesIO()) for _ in filenames]
+        writer.state = gguf.WriterState.EMPTY
+        return [ShardJournal(filename) for filename in filenames]
+
+    @staticmethod
+    def open_all(writer: gguf.GGUFWriter, journals: Sequence[ShardJournal]) -> list[ShardJournal]:
+        for i, journal in enumerate(journals):
+            journal.open(writer, i)
+        return list(journals)
+
+    def _previous_entries(self, meta: dict[str, Any]) -> list[dict[str, Any]]:
+        if not self.path.is_file():
+            return []
+        if not self.journal_path.is_file():
+            # the journals are removed once a conversion is done
+            logger.warning(f"{self.path}: exists but has no journal, so it was either completely written by a previous conversion "
+                           "or not written with --resume: writing it again from scratch")
+            return []
+        entries: list[dict[str, Any]] = []
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line can be incomplete when the previous run was interrupted while writing it
+                    break
+        if len(entries) == 0 or entries[0] != meta:
+            logger.warning(f"{self.path}: the metadata changed since the previous conversion: writing it again from scratch")
+            return []
+        return entries[1:]
+
+    # Replaces the metadata of the shard written to memory by prepare() with the file the tensors are written to.
+    # The tensors of a previous run are kept when the metadata is unchanged and their data on disk is intact,
+    # and a shard with all its tensors kept is not opened for writing at all.
+    def open(self, writer: gguf.GGUFWriter, index: int):
+        assert writer.fout is not None
+        prefix = cast(io.BytesIO, writer.fout[index]).getvalue()
+        meta = {"version": self.version, "data_offset": len(prefix), "sha256": sha256(prefix).hexdigest()}
+
+        plan: dict[str, tuple[int, int]] = {}
+        offset = len(prefix)
+        for name, ti in writer.tensors[index].items():
+            plan[name] = (offset, ti.nbytes)
+            offset += gguf.GGUFWriter.ggml_pad(ti.nbytes, writer.data_alignment)
+
+        kept: list[dict[str, Any]] = []
+        entries = self._previous_entries(meta)
+        if len(entries) > 0:
+            with open(self.path, "rb") as f:
+                if file_region_sha256(f, 0, len(prefix)) == meta["sha256"]:
+                    kept = [e for e in entries if plan.get(e["name"]) == (e["offset"], e["nbytes"])
+                            and file_region_sha256(f, e["offset"], e["nbytes"]) == e["sha256"]]
+        done = {e["name"] for e in kept}
+        self.pending = {name: offset for name, (offset, _) in plan.items() if name not in done}
+
+        if len(self.pending) == 0:
+            logger.info(f"{self.path}: all {len(plan)} tensors were already written, skipping")
+        elif len(done) > 0:
+            logger.info(f"{self.path}: resuming, {len(done)} of {len(plan)} tensors were already written")
+            writer.fout[index] = cast(Any, open(self.path, "r+b"))
+        else:
+            fout = open(self.path, "wb")
+            fout.write(prefix)
+            writer.fout[index] = cast(Any, fout)
+
+        # start the journal over with only the tensors which were kept
+        tmp_path = self.journal_path.with_name(f"{self.journal_path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in (meta, *kept):
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def write(self, writer: gguf.GGUFWriter, fout: Any, name: str, data: np.ndarray):
+        offset = self.pending.pop(name)
+        fout.seek(offset)
+        data.tofile(fout)
+        writer.write_padding(fout, data.nbytes)
+        digest = sha256(np.ascontiguousarray(data).reshape(-1).view(np.uint8).data).hexdigest()
+        # the journal must never mention data which could still be lost
+        fout.flush()
+        os.fsync(fout.fileno())
+        self._journal.write(json.dumps({"name": name, "offset": offset, "nbytes": data.nbytes, "sha256": digest}) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def close(self, remove: bool = False):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if remove and self.journal_path.exists():
+            self.journal_path.unlink()
+
+
+# estimated size of each cache directory, and the bytes written since it was last measured, in this process
+_quant_cache_usage: dict[Path, list[int]] = {}
+_quant_cache_lock = threading.Lock()
+
+
+# on-disk cache of converted tensors, keyed by the hash of their name, type and data before quantization,
+# so that the tensors shared by many conversions (e.g. fine-tunes of the same base model) are only quantized once
+class QuantCache:
+    # bump when the same input would not give the same cached data anymore
+    version: int = 1
+
+    # types which are only a conversion of the data, and aren't worth hashing and writing to disk
+    uncached_qtypes = (
+        gguf.GGMLQuantizationType.F32,
+        gguf.GGMLQuantizationType.F16,
+        gguf.GGMLQuantizationType.BF16,
+    )
+
+    cache_dir: Path
+    max_size: int
+
+    def __init__(self, cache_dir: Path, max_size: int = 0):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def key(self, name: str, data: np.ndarray, qtype: gguf.GGMLQuantizationType) -> str:
+        h = sha256(json.dumps([self.version, name, list(data.shape), data.dtype.str, qtype.name]).encode())
+        h.update(np.ascontiguousarray(data).reshape(-1).view(np.uint8).data)
+        return h.hexdigest()
+
+    # can be sent to worker processes through functools.partial, the cache only holds its settings
+    def quantize(self, data: np.ndarray, qtype: gguf.GGMLQuantizationType,
+                 quantize_fn: Callable[[np.ndarray, gguf.GGMLQuantizationType], np.ndarray] = gguf.quants.quantize,
+                 name: str = "") -> np.ndarray:
+        if isinstance(data, gguf.LazyNumpyTensor):
+            # this only computes the resulting meta (and raises QuantError when the type can't be used)
+            meta = quantize_fn(data, qtype)
+            return cast(np.ndarray, new_lazy(
+                gguf.LazyNumpyTensor,
+                gguf.LazyNumpyTensor.meta_with_dtype_and_shape(meta.dtype, meta.shape),
+                self.quantize,
+                args=(data, qtype),
+                kwargs={"quantize_fn": quantize_fn, "name": name},
+            ))
+
+        if qtype in self.uncached_qtypes:
+            return quantize_fn(data, qtype)
+
+        key = self.key(name, data, qtype)
+        path = self.cache_dir / key[:2] / f"{key}.npy"
+        try:
+            # copy-on-write, because the writer byteswaps big-endian outputs in place
+            cached = np.load(path, mmap_mode="c", allow_pickle=False)
+            # the modification time is used to find the least recently used entries
+            os.utime(path)
+            logger.debug(f"{name}: reusing cached {qtype.name} data from {path}")
+            return cached
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning(f"{name}: ignoring invalid cache entry {path}: {e}")
+
+        quantized = quantize_fn(data, qtype)
+
+        if not self.make_room(quantized.nbytes):
+            logger.debug(f"{name}: not caching {qtype.name} data larger than --cache-max-size")
+            return quantized
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so that other conversions never see partial entries
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, quantized, allow_pickle=False)
+        os.replace(tmp_path, path)
+        return quantized
+
+    # Keeps the cache within max_size while it is being written, by evicting entries before adding new ones.
+    # Scanning the cache for every entry would be slow, so its size is estimated in each process,
+    # and measured again when the estimate goes over the limit, or after max_size / 16 bytes were written.
+    # Conversions writing to the same cache concurrently can still go over the limit by that much each.
+    def make_room(self, nbytes: int) -> bool:
+        if self.max_size <= 0:
+            return True
+        if nbytes > self.max_size:
+            return False
+        with _quant_cache_lock:
+            usage = _quant_cache_usage.get(self.cache_dir)
+            if usage is None or usage[0] + nbytes > self.max_size or usage[1] + nbytes > self.max_size // 16:
+                usage = _quant_cache_usage[self.cache_dir] = [self.evict(reserve=nbytes), 0]
+            usage[0] += nbytes
+            usage[1] += nbytes
+        return True
+
+    # remove the least recently used entries until the cache fits in max_size, with `reserve` bytes to spare,
+    # and return the size of what is left
+    def evict(self, reserve: int = 0) -> int:
+        if self.max_size <= 0:
+            return 0
+        entries: list[tuple[float, int, Path]] = []
+        for path in self.cache_dir.glob("*/*.npy"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        n_removed = 0
+        for _, size, path in sorted(entries):
+            if total_size + reserve <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+            n_removed += 1
+        if n_removed > 0:
+            logger.info(f"Removed {n_removed} least recently used entries from {self.cache_dir}")
+        return total_size
+
+
+# what set_vocab did: the calls made to the GGUFWriter, and the changes to the attributes and hparams of the model
+@dataclass
+class VocabRecord:
+    calls: list[tuple[str, tuple[Any, ...], dict[str, Any]]]
+    attrs: dict[str, Any]
+    hparams: dict[str, Any]
+
+
+class _VocabNotCacheable(Exception):
+    pass
+
+
+# forwards everything to the GGUFWriter, recording the add_* calls
+class _RecordingWriter:
+    def __init__(self, writer: gguf.GGUFWriter, calls: list[tuple[str, tuple[Any, ...], dict[str, Any]]]):
+        self._writer = writer
+        self._calls = calls
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._writer, name)
+        if not name.startswith("add_") or not callable(attr):
+            return attr
+
+        def record(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            return attr(*args, **kwargs)
+        return record
+
+
+# on-disk cache of what set_vocab writes, keyed by the hashes of the tokenizer files,
+# so that converting fine-tunes sharing the tokenizer of a converted model
+# doesn't need to load the tokenizer again (nor import transformers or sentencepiece).
+# The token lists are stored in one packed bytes blob with their offsets, the other lists as numpy arrays.
+class VocabCache:
+    # bump when the same tokenizer files would not give the same vocab anymore
+    version: int = 1
+
+    # files of the model directory which can't change the vocab
+    # (config.json is part of the key through the hparams, without the ignored ones)
+    ignored_files = (
+        "*.safetensors", "*.bin", "*.pt", "*.pth", "*.ckpt", "*.gguf", "*.h5", "*.msgpack", "*.onnx",
+        "*.index.json", "*.md", "LICENSE*", "config.json", "generation_config.json", "trainer_state.json", "*_results.json",
+    )
+    # keys of config.json which differ between otherwise identical models
+    ignored_hparams = ("torch_dtype", "transformers_version")
+
+    cache_dir: Path | None
+    recorded: VocabRecord | None
+
+    def __init__(self, cache_dir: Path | None):
+        self.cache_dir = cache_dir
+        self.recorded = None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def script_digest() -> str:
+        # the conversion code itself decides what ends up in the vocab
+        h = sha256(Path(__file__).read_bytes())
+        h.update(PRE_TOKENIZERS_PATH.read_bytes())
+        return h.hexdigest()
+
+    def key(self, model: Model) -> str:
+        hparams = {k: v for k, v in model.hparams.items() if k not in self.ignored_hparams}
+        h = sha256(json.dumps([self.version, self.script_digest(), type(model).__name__, hparams], sort_keys=True, default=str).encode())
+        # tokenizer.json, tokenizer.model, tokenizer_config.json and added_tokens.json,
+        # but also vocab.json, merges.txt, *.tiktoken, remote tokenizer code, etc.
+        for path in sorted(model.dir_model.iterdir()):
+            if not path.is_file() or path.name.startswith(".") or path.name in model.part_names:
+                continue
+            if any(path.match(pattern) for pattern in self.ignored_files):
+                continue
+            file_hash = sha256()
+            with open(path, "rb") as f:
+                while chunk := f.read(1 << 20):
+                    file_hash.update(chunk)
+            h.update(f"{path.name}\0{file_hash.hexdigest()}\0".encode())
+        return h.hexdigest()
+
+    def set_vocab(self, model: Model):
+        if self.recorded is not None:
+            self.replay(model, self.recorded)
+            return
+
+        path: Path | None = None
+        if self.cache_dir is not None:
+            path = self.cache_dir / f"{self.key(model)}.npz"
+            try:
+                self.recorded = self.load(path)
+                logger.info(f"Reusing cached vocab from {path}")
+                os.utime(path)
+                self.replay(model, self.recorded)
+                return
+            except FileNotFoundError:
+                pass
+            except (ValueError, KeyError, zipfile.BadZipFile) as e:
+                logger.warning(f"Ignoring invalid vocab cache entry {path}: {e}")
+
+        self.recorded = self.record(model)
+
+        if path is not None:
+            try:
+                self.save(path, self.recorded)
+            except _VocabNotCacheable as e:
+                logger.info(f"Not caching the vocab: {e}")
+
+    @staticmethod
+    def record(model: Model) -> VocabRecord:
+        calls: list[tuple[str, tuple[Any, ...], dict[str, Any]]] = []
+        attrs = dict(vars(model))
+        hparams = copy.deepcopy(model.hparams)
+        writer = model.gguf_writer
+        model.gguf_writer = cast(gguf.GGUFWriter, _RecordingWriter(writer, calls))
+        try:
+            model.set_vocab()
+        finally:
+            model.gguf_writer = writer
+        return VocabRecord(
+            calls=calls,
+            attrs={k: v for k, v in vars(model).items() if k not in attrs or attrs[k] is not v},
+            hparams={k: v for k, v in model.hparams.items() if k not in hparams or hparams[k] != v},
+        )
+
+    @staticmethod
+    def replay(model: Model, recorded: VocabRecord):
+        for name, value in recorded.attrs.items():
+            setattr(model, name, value)
+        model.hparams.update(recorded.hparams)
+        for name, args, kwargs in recorded.calls:
+            getattr(model.gguf_writer, name)(*args, **kwargs)
+
+    @staticmethod
+    def save(path: Path, recorded: VocabRecord):
+        arrays: dict[str, np.ndarray] = {}
+        blob = bytearray()
+
+        def encode(value: Any) -> Any:
+            if isinstance(value, (list, tuple)) and len(value) > 0:
+                if all(isinstance(v, str) for v in value) or all(isinstance(v, (bytes, bytearray)) for v in value):
+                    is_str = isinstance(value[0], str)
+                    offsets = np.empty(len(value) + 1, dtype=np.int64)
+                    offsets[0] = len(blob)
+                    for i, v in enumerate(value):
+                        blob.extend(v.encode("utf-8", "surrogatepass") if is_str else v)
+                        offsets[i + 1] = len(blob)
+                    name = f"a{len(arrays)}"
+                    arrays[name] = offsets
+                    return {"str" if is_str else "bytes": name}
+                if not any(isinstance(v, bool) for v in value):
+                    if all(isinstance(v, int) for v in value):
+                        array = np.array(value, dtype=np.int64)
+                    elif all(isinstance(v, float) for v in value):
+                        array = np.array(value, dtype=np.float64)
+                    else:
+                        array = None
+                    if array is not None:
+                        name = f"a{len(arrays)}"
+                        arrays[name] = array
+                        return {"array": name}
+            try:
+                decoded = json.loads(json.dumps(value))
+            except (TypeError, ValueError):
+                decoded = None
+            if decoded != value and not (isinstance(value, tuple) and decoded == list(value)):
+                raise _VocabNotCacheable(f"can't store {type(value).__name__} values")
+            return {"json": value}
+
+        manifest = {
+            "calls": [[name, [encode(v) for v in args], {k: encode(v) for k, v in kwargs.items()}] for name, args, kwargs in recorded.calls],
+            "attrs": {k: encode(v) for k, v in recorded.attrs.items()},
+            "hparams": {k: encode(v) for k, v in recorded.hparams.items()},
+        }
+        arrays["manifest"] = np.frombuffer(json.dumps(manifest).encode(), dtype=np.uint8)
+        arrays["blob"] = np.frombuffer(bytes(blob), dtype=np.uint8)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so that other conversions never see partial entries
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **cast(Any, arrays))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: Path) -> VocabRecord:
+        with np.load(path, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        blob = arrays.pop("blob").tobytes()
+        manifest = json.loads(arrays.pop("manifest").tobytes())
+
+        def decode(value: dict[str, Any]) -> Any:
+            if "json" in value:
+                return value["json"]
+            if "array" in value:
+                return arrays[value["array"]].tolist()
+            offsets = arrays[value.get("str", value.get("bytes"))].tolist()
+            items = [blob[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+            if "str" in value:
+                return [item.decode("utf-8", "surrogatepass") for item in items]
+            return items
+
+        return VocabRecord(
+            calls=[(name, tuple(decode(v) for v in args), {k: decode(v) for k, v in kwargs.items()}) for name, args, kwargs in manifest["calls"]],
+            attrs={k: decode(v) for k, v in manifest["attrs"].items()},
+            hparams={k: decode(v) for k, v in manifest["hparams"].items()},
+        )
+
+
+# Quantizing a whole tensor at once with gguf.quants.quantize allocates several float32 temporaries of its size.
+# Instead, the blocks of these types are quantized in tiles of about TILE_SIZE elements,
+# converted to float32 in scratch buffers which are reused across tensors (one set per thread).
+# Blocks are independent, so the result is identical.
+TILE_SIZE = 1 << 18
+_tiled_qtypes = (
+    gguf.GGMLQuantizationType.Q8_0,
+    gguf.GGMLQuantizationType.TQ1_0,
+    gguf.GGMLQuantizationType.TQ2_0,
+)
+_tile_scratch = threading.local()
+
+
+@functools.lru_cache(maxsize=None)
+def _tile_executor(n_threads: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="gguf-quantize")
+
+
+def _scratch_buffers(n: int, size: int) -> list[np.ndarray]:
+    buffers: list[np.ndarray] | None = getattr(_tile_scratch, "buffers", None)
+    if buffers is None or len(buffers) < n or buffers[0].size < size:
+        buffers = [np.empty(size, dtype=np.float32) for _ in range(n)]
+        _tile_scratch.buffers = buffers
+    return buffers
+
+
+# Same as Q8_0.quantize_blocks from gguf-py (and so bit-exact with ggml-quants.c), but in-place
+def _quantize_q8_0_tile(blocks: np.ndarray, a: np.ndarray, b: np.ndarray, out: np.ndarray):
+    d = np.abs(blocks, out=a).max(axis=1, keepdims=True) / np.float32(127)
+    with np.errstate(divide="ignore", over="ignore"):
+        id = np.where(d == 0, np.float32(0), np.float32(1) / d)
+    np.multiply(blocks, id, out=blocks)
+    # roundf, like np_roundf
+    with np.errstate(invalid="ignore"):
+        np.abs(blocks, out=a)
+        np.floor(a, out=b)
+        np.subtract(a, b, out=a)
+        np.multiply(a, 2, out=a)
+        np.floor(a, out=a)
+        np.add(a, b, out=a)
+        np.sign(blocks, out=b)
+        np.multiply(a, b, out=a)
+        out[:, :2] = d.astype(np.float16).view(np.uint8)
+        np.copyto(out[:, 2:].view(np.int8), a, casting="unsafe")
+
+
+def _quantize_tile(blocks: np.ndarray, qtype: gguf.GGMLQuantizationType, out: np.ndarray):
+    block_size = blocks.shape[1]
+    scratch, a, b = _scratch_buffers(3, max(TILE_SIZE, blocks.size))
+    tile = scratch[:blocks.size].reshape(blocks.shape)
+    if blocks.dtype == np.uint16:
+        # raw bfloat16 bits
+        tile_bits = tile.view(np.uint32)
+        np.copyto(tile_bits, blocks)
+        np.left_shift(tile_bits, 16, out=tile_bits)
+    else:
+        np.copyto(tile, blocks, casting="same_kind")
+
+    if qtype == gguf.GGMLQuantizationType.Q8_0:
+        _quantize_q8_0_tile(tile, a[:blocks.size].reshape(-1, block_size), b[:blocks.size].reshape(-1, block_size), out)
+    else:
+        out[...] = gguf.quants.quantize(tile, qtype)
+
+
+# Quantizes float32, float16 or raw bfloat16 (uint16) data,
+# tiled and optionally multithreaded (numpy releases the GIL) for the types in _tiled_qtypes.
+def quantize_tensor(data: np.ndarray, qtype: gguf.GGMLQuantizationType, n_threads: int = 1) -> np.ndarray:
+    if isinstance(data, gguf.LazyNumpyTensor):
+        # this only computes the resulting meta (and raises QuantError when the type can't be used)
+        meta = gguf.quants.quantize(data.astype(np.float32), qtype)
+        return cast(np.ndarray, new_lazy(
+            gguf.LazyNumpyTensor,
+            gguf.LazyNumpyTensor.meta_with_dtype_and_shape(meta.dtype, meta.shape),
+            quantize_tensor,
+            args=(data, qtype, n_threads),
+        ))
+    if qtype not in _tiled_qtypes:
+        return gguf.quants.quantize(bf16_to_f32(data) if data.dtype == np.uint16 else data, qtype)
+
+    block_size, type_size = gguf.GGML_QUANT_SIZES[qtype]
+    if len(data.shape) == 0 or data.shape[-1] % block_size != 0:
+        raise gguf.QuantError(f"Quantized tensor row size ({data.shape[-1] if data.shape else 1}) is not a multiple of {qtype.name} block size ({block_size})")
+
+    out = np.empty(gguf.quant_shape_to_byte_shape(data.shape, qtype), dtype=np.uint8)
+    blocks = data.reshape(-1, block_size)
+    out_blocks = out.reshape(-1, type_size)
+    tile_blocks = max(1, TILE_SIZE // block_size)
+    tiles = [slice(i, i + tile_blocks) for i in range(0, len(blocks), tile_blocks)]
+
+    def quantize_tile(tile: slice):
+        _quantize_tile(blocks[tile], qtype, out_blocks[tile])
+
+    if n_threads > 1 and len(tiles) > 1:
+        # list() propagates the exceptions
+        list(_tile_executor(n_threads).map(quantize_tile, tiles))
+    else:
+        for tile in tiles:
+            quantize_tile(tile)
+    return out
+
+
+@dataclass
+class QuantizeJob:
+    data: np.ndarray | None
+    qtype: gguf.GGMLQuantizationType
+    quantize: Callable[[np.ndarray, gguf.GGMLQuantizationType], np.ndarray]
+    # the materialized tensor and its quantized result, accounted for in the memory budget while in flight
+    nbytes: int = 0
+    future: Future[np.ndarray] | None = None
+
+
+# quantize tensors on worker processes, in submission order
+class TensorQuantizePool:
+    n_workers: int
+    max_in_flight: int
+
+    def __init__(self, n_workers: int, max_in_flight: int = 0, budget: MemoryBudget | None = None):
+        self.n_workers = n_workers
+        self.max_in_flight = max_in_flight if max_in_flight > 0 else 2 * n_workers
+        self.budget = budget
+        self._jobs: list[QuantizeJob | None] = []
+        self._n_dispatched = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    def submit(self, data: np.ndarray, qtype: gguf.GGMLQuantizationType,
+               quantize: Callable[[np.ndarray, gguf.GGMLQuantizationType], np.ndarray] = gguf.quants.quantize) -> np.ndarray:
+        # this only computes the resulting meta (and raises QuantError when the type can't be used)
+        meta = quantize(gguf.LazyNumpyTensor.from_eager(data), qtype)
+
+        # the placeholder is evaluated by the GGUFWriter, in the same order the tensors were submitted
+        index = len(self._jobs)
+        self._jobs.append(QuantizeJob(data=data, qtype=qtype, quantize=quantize, nbytes=data.nbytes + meta.nbytes))
+        return cast(np.ndarray, gguf.LazyNumpyTensor(
+            meta=gguf.LazyNumpyTensor.meta_with_dtype_and_shape(meta.dtype, meta.shape),
+            args=(index,),
+            func=self._result,
+        ))
+
+    # the jobs up to `needed` are dispatched in any case, the ones after it only while they fit in the memory budget
+    def _dispatch(self, end: int, needed: int):
+        if self._executor is None:
+            # fork is not safe with the threads torch may have started
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        while self._n_dispatched < min(end, len(self._jobs)):
+            job = self._jobs[self._n_dispatched]
+            assert job is not None and job.data is not None
+            if self.budget is not None:
+                if self._n_dispatched <= needed:
+                    self.budget.reserve(job.nbytes)
+                elif not self.budget.try_acquire(job.nbytes):
+                    break
+            # lazy tensors can't be sent to other processes (they reference open files), so materialize them here
+            data = gguf.LazyNumpyTensor.to_eager(job.data)
+            job.data = None
+            job.future = self._executor.submit(job.quantize, data, job.qtype)
+            self._n_dispatched += 1
+
+    def _result(self, index: int) -> np.ndarray:
+        # keep at most max_in_flight materialized tensors around
+        self._dispatch(index + self.max_in_flight, index)
+        job = self._jobs[index]
+        assert job is not None and job.future is not None
+        self._jobs[index] = None
+        result = job.future.result()
+        if self.budget is not None:
+            # the writer is done with the result right after this
+            self.budget.release(job.nbytes)
+        return result
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+# read -> quantize -> write, with each stage on its own thread and bounded queues in between,
+# so that reading the model, converting tensors and writing the output all overlap
+class TensorStreamPipeline(TensorQuantizePool):
+    _STOP = None
+
+    def __init__(self, n_workers: int, max_in_flight: int = 0, budget: MemoryBudget | None = None):
+        super().__init__(n_workers, max_in_flight, budget)
+        self._read_queue: queue.Queue[Any] = queue.Queue(maxsize=self.max_in_flight)
+        self._done_queue: queue.Queue[Any] = queue.Queue(maxsize=self.max_in_flight)
+        self._threads: list[threading.Thread] = []
+
+    def _start(self):
+        if self.n_workers > 1:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=multiprocessing.get_context("spawn"))
+        # all tensors have been submitted by the time the writer asks for the first one
+        self._threads = [
+            threading.Thread(target=self._read_stage, name="gguf-read", daemon=True),
+            threading.Thread(target=self._convert_stage, name="gguf-convert", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _read_stage(self):
+        try:
+            for index, job in enumerate(self._jobs):
+                assert job is not None and job.data is not None
+                if self.budget is not None:
+                    self.budget.acquire(job.nbytes)
+                data = gguf.LazyNumpyTensor.to_eager(job.data)
+                job.data = None
+                self._read_queue.put((index, data))
+            self._read_queue.put(self._STOP)
+        except BaseException as e:
+            self._read_queue.put(e)
+
+    def _convert_stage(self):
+        try:
+            while (item := self._read_queue.get()) is not self._STOP:
+                if isinstance(item, BaseException):
+                    self._done_queue.put(item)
+                    return
+                index, data = item
+                job = self._jobs[index]
+                assert job is not None
+                if self._executor is not None:
+                    # futures are passed along, so up to max_in_flight tensors are quantized in parallel
+                    self._done_queue.put((index, self._executor.submit(job.quantize, data, job.qtype)))
+                else:
+                    self._done_queue.put((index, job.quantize(data, job.qtype)))
+                del item, data
+        except BaseException as e:
+            self._done_queue.put(e)
+
+    def _result(self, index: int) -> np.ndarray:
+        if not self._threads:
+            self._start()
+        item = self._done_queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        done_index, result = item
+        assert done_index == index, "streamed tensors must be written in the order they were submitted"
+        job = self._jobs[index]
+        assert job is not None
+        self._jobs[index] = None
+        result = result.result() if isinstance(result, Future) else result
+        if self.budget is not None:
+            self.budget.release(job.nbytes)
+        return result
+
+    def close(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        super().close()
+
+
+# the shard writer threads would otherwise materialize as many tensors as there are shards
+DEFAULT_SPLIT_PARALLEL_MAX_MEMORY = "4G"
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Convert a huggingface model to a GGML compatible file")
@@ -4290,8 +5566,9 @@ def parse_args() -> argparse.Namespace:
         help="path to write to; default: based on input. {ftype} will be replaced by the outtype.",
     )
     parser.add_argument(
-        "--outtype", type=str, choices=["f32", "f16", "bf16", "q8_0", "tq1_0", "tq2_0", "auto"], default="f16",
-        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, tq1_0 or tq2_0 for ternary, and auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type",
+        "--outtype", type=str, default="f16",
+        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, tq1_0 or tq2_0 for ternary, and auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type. "
+             "Multiple comma-separated formats (e.g. f16,q8_0,bf16) write one file per format from a single pass over the model, and require --outfile to be a directory or to contain {ftype}",
     )
     parser.add_argument(
         "--bigendian", action="store_true",
@@ -4333,10 +5610,52 @@ def parse_args() -> argparse.Namespace:
         "--no-tensor-first-split", action="store_true",
         help="do not add tensors to the first split (disabled by default)"
     )
+    parser.add_argument(
+        "--split-parallel", action="store_true",
+        help="write the shards of a split output in parallel, with one writer thread per shard",
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="keep a journal of the tensors written next to each output file, to continue an interrupted conversion from it when running the same command again (the journals of a finished conversion are removed, so it would be written again)",
+    )
     parser.add_argument(
         "--metadata", type=Path,
         help="Specify the path for an authorship metadata override file"
     )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="number of worker processes used to quantize tensors (the output is identical to the single-threaded one)",
+    )
+    parser.add_argument(
+        "--max-tensors-in-flight", type=int, default=0,
+        help="with --threads, max number of materialized tensors kept in memory at once (default: 2 * threads)",
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="overlap reading, converting and writing tensors, with bounded queues between the stages",
+    )
+    parser.add_argument(
+        "--quantize-threads", type=int, default=1,
+        help="number of threads used to quantize each tensor to q8_0, tq1_0 or tq2_0 (per worker process with --threads)",
+    )
+    parser.add_argument(
+        "--profile-report", type=Path, default=None,
+        help="write the time and bytes spent in each stage of the conversion, and the slowest tensors, to this JSON file",
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path, default=None,
+        help="directory where quantized tensors and vocabs are cached, to reuse them in later conversions of models sharing weights or tokenizers",
+    )
+    parser.add_argument(
+        "--max-memory", type=str, default=None,
+        help="max size of the tensors materialized at once N(M|G), including the quantized results and the converted tensors reused for another name (0 for no limit, the default, "
+             f"except with --split-parallel where it is {DEFAULT_SPLIT_PARALLEL_MAX_MEMORY}). "
+             "The conversion waits for tensors to be written before reading more, and only spills buffers which can't wait to a temporary file next to the output",
+    )
+    parser.add_argument(
+        "--cache-max-size", type=str, default="64G",
+        help="max size of the --cache-dir N(M|G), the least recently used tensors are removed first (0 for no limit)",
+    )
 
     return parser.parse_args()
 
@@ -4388,6 +5707,54 @@ def main() -> None:
         logger.error("Error: Cannot use temp file when splitting")
         sys.exit(1)
 
+    if args.split_parallel:
+        if not is_split:
+            logger.error("Error: --split-parallel requires --split-max-tensors or --split-max-size")
+            sys.exit(1)
+        # the quantized tensors of the worker processes must be used in the order they were submitted
+        if args.threads > 1 or args.stream:
+            logger.error("Error: Cannot use --threads or --stream when writing splits in parallel")
+            sys.exit(1)
+
+    max_memory = args.max_memory
+    if max_memory is None:
+        max_memory = DEFAULT_SPLIT_PARALLEL_MAX_MEMORY if args.split_parallel else "0"
+
+    if args.resume:
+        if args.use_temp_file:
+            logger.error("Error: Cannot use temp file when resuming")
+            sys.exit(1)
+        # the worker processes would still quantize the tensors which are already written
+        if args.threads > 1 or args.stream:
+            logger.error("Error: Cannot use --threads or --stream when resuming")
+            sys.exit(1)
+        # eager tensors are all converted before the journals are read, so only writing them would be saved
+        if args.no_lazy:
+            logger.error("Error: Cannot use --no-lazy when resuming")
+            sys.exit(1)
+
+    if args.use_temp_file and args.stream:
+        logger.error("Error: Cannot use temp file when streaming")
+        sys.exit(1)
+
+    outtypes = args.outtype.split(",")
+    for outtype in outtypes:
+        if outtype not in ftype_map:
+            logger.error(f"Error: Unknown --outtype {outtype!r}, must be one of {', '.join(ftype_map)}")
+            sys.exit(1)
+    # "auto" is checked once it is resolved, in Model.__init__
+    if len(set(ftype_map[outtype] for outtype in outtypes)) != len(outtypes):
+        logger.error(f"Error: Duplicated --outtype in {args.outtype!r}")
+        sys.exit(1)
+
+    if len(outtypes) > 1:
+        if args.use_temp_file:
+            logger.error("Error: Cannot use temp file when writing multiple outtypes")
+            sys.exit(1)
+        if args.outfile is not None and not args.outfile.is_dir() and "{ftype}" not in args.outfile.name.lower():
+            logger.error("Error: --outfile must be a directory or contain {ftype} when writing multiple outtypes")
+            sys.exit(1)
+
     if args.outfile is not None:
         fname_out = args.outfile
     else:
@@ -4397,8 +5764,10 @@ def main() -> None:
 
     hparams = Model.load_hparams(dir_model)
 
+    profiler = StageProfiler() if args.profile_report is not None else None
+
     with torch.inference_mode():
-        output_type = ftype_map[args.outtype]
+        output_type = ftype_map[outtypes[0]]
         model_architecture = hparams["architectures"][0]
 
         try:
@@ -4413,7 +5782,14 @@ def main() -> None:
                                      metadata_override=args.metadata, model_name=args.model_name,
                                      split_max_tensors=args.split_max_tensors,
                                      split_max_size=split_str_to_n_bytes(args.split_max_size), dry_run=args.dry_run,
-                                     small_first_shard=args.no_tensor_first_split)
+                                     small_first_shard=args.no_tensor_first_split,
+                                     threads=args.threads, max_tensors_in_flight=args.max_tensors_in_flight,
+                                     stream=args.stream, cache_dir=args.cache_dir,
+                                     cache_max_size=split_str_to_n_bytes(args.cache_max_size),
+                                     quantize_threads=args.quantize_threads,
+                                     extra_ftypes=[ftype_map[outtype] for outtype in outtypes[1:]],
+                                     profiler=profiler, parallel_split=args.split_parallel,
+                                     max_memory=split_str_to_n_bytes(max_memory), resume=args.resume)
 
         if args.vocab_only:
             logger.info("Exporting model vocab...")
@@ -4422,8 +5798,13 @@ def main() -> None:
         else:
             logger.info("Exporting model...")
             model_instance.write()
-            out_path = f"{model_instance.fname_out.parent}{os.sep}" if is_split else model_instance.fname_out
-            logger.info(f"Model successfully exported to {out_path}")
+            for output in model_instance.outputs:
+                out_path = f"{output.fname_out.parent}{os.sep}" if is_split else output.fname_out
+                logger.info(f"Model successfully exported to {out_path}")
+
+        if profiler is not None:
+            profiler.write_report(args.profile_report)
+            logger.info(f"Profile report written to {args.profile_report}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Conversion benchmark for convert_hf_to_gguf.py
+#
+# Generates synthetic HF-style checkpoints (config.json and sharded safetensors with random weights)
+# for a few representative architectures and sizes, converts each of them end-to-end in a separate process,
+# and reports the throughput, the peak RSS and the time spent in each stage of the conversion as JSON.
+#
+# The tokenizer is not part of the synthetic checkpoints, so set_vocab is skipped in the benchmarked process.
+#
+# Usage:
+#
+#   python3 convert_hf_to_gguf_bench.py --arch llama qwen2moe --size small --outtype q8_0 --output bench.json
+#
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import numpy as np
+
+logger = logging.getLogger("hf-to-gguf-bench")
+
+
+###### SYNTHETIC CHECKPOINTS ######
+
+@dataclass
+class ModelSize:
+    hidden_size: int
+    intermediate_size: int
+    n_layers: int
+    n_heads: int
+    n_kv_heads: int
+    vocab_size: int
+    n_experts: int
+
+
+SIZES: dict[str, ModelSize] = {
+    "tiny":   ModelSize(hidden_size=256,  intermediate_size=688,  n_layers=2,  n_heads=4,  n_kv_heads=2, vocab_size=4096,  n_experts=8),
+    "small":  ModelSize(hidden_size=1024, intermediate_size=2816, n_layers=8,  n_heads=16, n_kv_heads=4, vocab_size=32000, n_experts=16),
+    "medium": ModelSize(hidden_size=2048, intermediate_size=5632, n_layers=16, n_heads=16, n_kv_heads=4, vocab_size=32000, n_experts=32),
+}
+
+
+def llama_checkpoint(size: ModelSize) -> tuple[dict[str, Any], Iterator[tuple[str, tuple[int, ...]]]]:
+    head_dim = size.hidden_size // size.n_heads
+    config = {
+        "architectures": ["LlamaForCausalLM"],
+        "hidden_size": size.hidden_size,
+        "intermediate_size": size.intermediate_size,
+        "num_hidden_layers": size.n_layers,
+        "num_attention_heads": size.n_heads,
+        "num_key_value_heads": size.n_kv_heads,
+        "vocab_size": size.vocab_size,
+        "max_position_embeddings": 4096,
+        "rms_norm_eps": 1e-5,
+        "rope_theta": 10000.0,
+    }
+
+    def tensors() -> Iterator[tuple[str, tuple[int, ...]]]:
+        yield "model.embed_tokens.weight", (size.vocab_size, size.hidden_size)
+        for bid in range(size.n_layers):
+            prefix = f"model.layers.{bid}"
+            yield f"{prefix}.input_layernorm.weight", (size.hidden_size,)
+            yield f"{prefix}.self_attn.q_proj.weight", (size.hidden_size, size.hidden_size)
+            yield f"{prefix}.self_attn.k_proj.weight", (size.n_kv_heads * head_dim, size.hidden_size)
+            yield f"{prefix}.self_attn.v_proj.weight", (size.n_kv_heads * head_dim, size.hidden_size)
+            yield f"{prefix}.self_attn.o_proj.weight", (size.hidden_size, size.hidden_size)
+            yield f"{prefix}.post_attention_layernorm.weight", (size.hidden_size,)
+            yield f"{prefix}.mlp.gate_proj.weight", (size.intermediate_size, size.hidden_size)
+            yield f"{prefix}.mlp.up_proj.weight", (size.intermediate_size, size.hidden_size)
+            yield f"{prefix}.mlp.down_proj.weight", (size.hidden_size, size.intermediate_size)
+        yield "model.norm.weight", (size.hidden_size,)
+        yield "lm_head.weight", (size.vocab_size, size.hidden_size)
+
+    return config, tensors()
+
+
+def qwen2moe_checkpoint(size: ModelSize) -> tuple[dict[str, Any], Iterator[tuple[str, tuple[int, ...]]]]:
+    head_dim = size.hidden_size // size.n_heads
+    moe_intermediate_size = size.intermediate_size // 4
+    config = {
+        "architectures": ["Qwen2MoeForCausalLM"],
+        "hidden_size": size.hidden_size,
+        "intermediate_size": size.intermediate_size,
+        "moe_intermediate_size": moe_intermediate_size,
+        "shared_expert_intermediate_size": size.intermediate_size,
+        "num_experts": size.n_experts,
+        "num_experts_per_tok": 4,
+        "num_hidden_layers": size.n_layers,
+        "num_attention_heads": size.n_heads,
+        "num_key_value_heads": size.n_kv_heads,
+        "vocab_size": size.vocab_size,
+        "max_position_embeddings": 4096,
+        "rms_norm_eps": 1e-6,
+        "rope_theta": 1000000.0,
+    }
+
+    def tensors() -> Iterator[tuple[str, tuple[int, ...]]]:
+        yield "model.embed_tokens.weight", (size.vocab_size, size.hidden_size)
+        for bid in range(size.n_layers):
+            prefix = f"model.layers.{bid}"
+            yield f"{prefix}.input_layernorm.weight", (size.hidden_size,)
+            for proj, n_out in (("q_proj", size.hidden_size), ("k_proj", size.n_kv_heads * head_dim), ("v_proj", size.n_kv_heads * head_dim)):
+                yield f"{prefix}.self_attn.{proj}.weight", (n_out, size.hidden_size)
+                yield f"{prefix}.self_attn.{proj}.bias", (n_out,)
+            yield f"{prefix}.self_attn.o_proj.weight", (size.hidden_size, size.hidden_size)
+            yield f"{prefix}.post_attention_layernorm.weight", (size.hidden_size,)
+            yield f"{prefix}.mlp.gate.weight", (size.n_experts, size.hidden_size)
+            for xid in range(size.n_experts):
+                yield f"{prefix}.mlp.experts.{xid}.gate_proj.weight", (moe_intermediate_size, size.hidden_size)
+                yield f"{prefix}.mlp.experts.{xid}.up_proj.weight", (moe_intermediate_size, size.hidden_size)
+                yield f"{prefix}.mlp.experts.{xid}.down_proj.weight", (size.hidden_size, moe_intermediate_size)
+            yield f"{prefix}.mlp.shared_expert.gate_proj.weight", (size.intermediate_size, size.hidden_size)
+            yield f"{prefix}.mlp.shared_expert.up_proj.weight", (size.intermediate_size, size.hidden_size)
+            yield f"{prefix}.mlp.shared_expert.down_proj.weight", (size.hidden_size, size.intermediate_size)
+            yield f"{prefix}.mlp.shared_expert_gate.weight", (1, size.hidden_size)
+        yield "model.norm.weight", (size.hidden_size,)
+        yield "lm_head.weight", (size.vocab_size, size.hidden_size)
+
+    return config, tensors()
+
+
+def gptneox_checkpoint(size: ModelSize) -> tuple[dict[str, Any], Iterator[tuple[str, tuple[int, ...]]]]:
+    intermediate_size = 4 * size.hidden_size
+    config = {
+        "architectures": ["GPTNeoXForCausalLM"],
+        "hidden_size": size.hidden_size,
+        "intermediate_size": intermediate_size,
+        "num_hidden_layers": size.n_layers,
+        "num_attention_heads": size.n_heads,
+        "vocab_size": size.vocab_size,
+        "max_position_embeddings": 2048,
+        "rotary_pct": 0.25,
+        "use_parallel_residual": True,
+        "layer_norm_eps": 1e-5,
+    }
+
+    def tensors() -> Iterator[tuple[str, tuple[int, ...]]]:
+        yield "gpt_neox.embed_in.weight", (size.vocab_size, size.hidden_size)
+        for bid in range(size.n_layers):
+            prefix = f"gpt_neox.layers.{bid}"
+            for norm in ("input_layernorm", "post_attention_layernorm"):
+                yield f"{prefix}.{norm}.weight", (size.hidden_size,)
+                yield f"{prefix}.{norm}.bias", (size.hidden_size,)
+            for linear, n_out, n_in in (
+                ("attention.query_key_value", 3 * size.hidden_size, size.hidden_size),
+                ("attention.dense", size.hidden_size, size.hidden_size),
+                ("mlp.dense_h_to_4h", intermediate_size, size.hidden_size),
+                ("mlp.dense_4h_to_h", size.hidden_size, intermediate_size),
+            ):
+                yield f"{prefix}.{linear}.weight", (n_out, n_in)
+                yield f"{prefix}.{linear}.bias", (n_out,)
+        yield "gpt_neox.final_layer_norm.weight", (size.hidden_size,)
+        yield "gpt_neox.final_layer_norm.bias", (size.hidden_size,)
+        yield "embed_out.weight", (size.vocab_size, size.hidden_size)
+
+    return config, tensors()
+
+
+# a dense layout, a MoE layout, and a model with biases and fused qkv
+ARCHITECTURES: dict[str, Callable[[ModelSize], tuple[dict[str, Any], Iterator[tuple[str, tuple[int, ...]]]]]] = {
+    "llama": llama_checkpoint,
+    "qwen2moe": qwen2moe_checkpoint,
+    "gptneox": gptneox_checkpoint,
+}
+
+_dtype_names: dict[str, str] = {
+    "bf16": "BF16",
+    "f16": "F16",
+    "f32": "F32",
+}
+
+
+def random_tensor(rng: np.random.Generator, shape: tuple[int, ...], dtype: str) -> np.ndarray:
+    data = rng.standard_normal(size=shape, dtype=np.float32)
+    data *= 0.02
+    if dtype == "bf16":
+        # truncated, which is good enough for random weights
+        return (data.view(np.uint32) >> 16).astype(np.uint16)
+    if dtype == "f16":
+        return data.astype(np.float16)
+    return data
+
+
+# ref: https://github.com/huggingface/safetensors#format
+def write_safetensors(path: Path, tensors: list[tuple[str, np.ndarray]], dtype: str):
+    # like the safetensors library, which stores the tensors of a file sorted by name
+    # (so e.g. the experts of a MoE layer are not in the order they are defined in the model)
+    tensors = sorted(tensors, key=lambda t: t[0])
+    header: dict[str, Any] = {"__metadata__": {"format": "pt"}}
+    offset = 0
+    for name, data in tensors:
+        header[name] = {"dtype": _dtype_names[dtype], "shape": list(data.shape), "data_offsets": [offset, offset + data.nbytes]}
+        offset += data.nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # the data is aligned to 8 bytes
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    with open(path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for _, data in tensors:
+            data.astype(data.dtype.newbyteorder("<"), copy=False).tofile(f)
+
+
+def make_checkpoint(dir_model: Path, arch: str, size_name: str, dtype: str, shard_size: int, seed: int = 0) -> int:
+    config, tensors = ARCHITECTURES[arch](SIZES[size_name])
+    config["torch_dtype"] = {"bf16": "bfloat16", "f16": "float16", "f32": "float32"}[dtype]
+    rng = np.random.default_rng(seed)
+
+    dir_model.mkdir(parents=True, exist_ok=True)
+    with open(dir_model / "config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+
+    # the shards are written as soon as they are full, and renamed once their count is known
+    shard: list[tuple[str, np.ndarray]] = []
+    shard_names: list[list[str]] = []
+    total_size = 0
+
+    def flush_shard():
+        write_safetensors(dir_model / f"model-{len(shard_names) + 1:05d}.safetensors.tmp", shard, dtype)
+        shard_names.append([name for name, _ in shard])
+        shard.clear()
+
+    for name, shape in tensors:
+        data = random_tensor(rng, shape, dtype)
+        if len(shard) > 0 and sum(d.nbytes for _, d in shard) + data.nbytes > shard_size:
+            flush_shard()
+        shard.append((name, data))
+        total_size += data.nbytes
+    flush_shard()
+
+    weight_map: dict[str, str] = {}
+    for i, names in enumerate(shard_names):
+        part_name = f"model-{i + 1:05d}-of-{len(shard_names):05d}.safetensors"
+        os.replace(dir_model / f"model-{i + 1:05d}.safetensors.tmp", dir_model / part_name)
+        for name in names:
+            weight_map[name] = part_name
+
+    with open(dir_model / "model.safetensors.index.json", "w", encoding="utf-8") as f:
+        json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+
+    return total_size
+
+
+###### BENCHMARKED PROCESS ######
+
+# Runs convert_hf_to_gguf.main(), which writes the per-stage times with --profile-report
+def run_child(convert_args: list[str]) -> None:
+    sys.path.insert(0, str(Path(__file__).parent))
+    import convert_hf_to_gguf
+    from convert_hf_to_gguf import Model
+
+    # the model directory is the last argument, see run_benchmark
+    dir_model = Path(convert_args[-1])
+    model_class = Model.from_model_architecture(Model.load_hparams(dir_model)["architectures"][0])
+
+    # the synthetic checkpoints have no tokenizer
+    model_class.set_vocab = lambda self: None  # type: ignore[method-assign]
+
+    sys.argv = ["convert_hf_to_gguf.py", *convert_args]
+    convert_hf_to_gguf.main()
+
+
+###### BENCHMARK DRIVER ######
+
+def run_benchmark(dir_model: Path, dir_out: Path, source_size: int, convert_args: list[str]) -> dict[str, Any]:
+    report_path = dir_out / "profile.json"
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--child", "--", *convert_args,
+           "--profile-report", str(report_path), "--outfile", str(dir_out / "model.gguf"), str(dir_model)]
+    logger.debug(f"running {cmd}")
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    # wait4 gives the resource usage of this process alone
+    _, status, rusage = os.wait4(proc.pid, 0)
+    wall_time = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"conversion failed with exit code {proc.returncode}: {' '.join(cmd)}")
+
+    with open(report_path, "r", encoding="utf-8") as f:
+        profile = json.load(f)
+
+    output_size = sum(p.stat().st_size for p in dir_out.glob("*.gguf"))
+    convert_time = profile["wall_time"]
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS
+    peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    return {
+        "wall_time": wall_time,
+        "convert_time": convert_time,
+        "source_mb_per_s": source_size / 1e6 / convert_time,
+        "output_size": output_size,
+        "peak_rss": peak_rss,
+        "stages": {stage: stats["seconds"] for stage, stats in profile["stages"].items()},
+        "slowest_tensors": [(t["name"], t["seconds"]) for t in profile["slowest_tensors"]],
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark convert_hf_to_gguf.py on synthetic checkpoints")
+    parser.add_argument(
+        "--arch", type=str, nargs="+", choices=list(ARCHITECTURES), default=list(ARCHITECTURES),
+        help="architectures of the synthetic checkpoints",
+    )
+    parser.add_argument(
+        "--size", type=str, nargs="+", choices=list(SIZES), default=["tiny", "small"],
+        help="sizes of the synthetic checkpoints",
+    )
+    parser.add_argument(
+        "--dtype", type=str, choices=list(_dtype_names), default="bf16",
+        help="type of the weights in the synthetic checkpoints",
+    )
+    parser.add_argument(
+        "--outtype", type=str, nargs="+", default=["f16", "q8_0"],
+        help="--outtype values to benchmark",
+    )
+    parser.add_argument(
+        "--shard-size", type=int, default=512 * 1000 * 1000,
+        help="max size in bytes of each safetensors shard of the synthetic checkpoints",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=1,
+        help="number of conversions of each checkpoint and outtype",
+    )
+    parser.add_argument(
+        "--no-lazy", action="store_true",
+        help="benchmark the conversion with --no-lazy",
+    )
+    parser.add_argument(
+        "--convert-args", type=str, default="",
+        help="extra arguments for convert_hf_to_gguf.py, e.g. \"--threads 4\"",
+    )
+    parser.add_argument(
+        "--work-dir", type=Path, default=None,
+        help="directory for the synthetic checkpoints and outputs (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--keep", action="store_true",
+        help="keep the synthetic checkpoints and outputs in --work-dir",
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None,
+        help="file to write the JSON report to (default: stdout)",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true",
+        help="increase output verbosity",
+    )
+    parser.add_argument(
+        "--child", action="store_true",
+        help=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        "convert_args_child", nargs=argparse.REMAINDER,
+        help=argparse.SUPPRESS,
+    )
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.child:
+        convert_args = args.convert_args_child
+        if convert_args[:1] == ["--"]:
+            convert_args = convert_args[1:]
+        run_child(convert_args)
+        return
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    work_dir = args.work_dir if args.work_dir is not None else Path(tempfile.mkdtemp(prefix="hf-to-gguf-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    results: list[dict[str, Any]] = []
+    try:
+        for arch in args.arch:
+            for size_name in args.size:
+                dir_model = work_dir / f"{arch}-{size_name}-{args.dtype}"
+                logger.info(f"Generating {dir_model.name}")
+                if dir_model.is_dir():
+                    shutil.rmtree(dir_model)
+                source_size = make_checkpoint(dir_model, arch, size_name, args.dtype, args.shard_size)
+
+                for outtype in args.outtype:
+                    for run in range(args.repeat):
+                        dir_out = work_dir / f"{dir_model.name}-{outtype}-{run}"
+                        dir_out.mkdir(exist_ok=True)
+                        convert_args = ["--outtype", outtype, *args.convert_args.split()]
+                        if args.no_lazy:
+                            convert_args.append("--no-lazy")
+
+                        logger.info(f"Converting {dir_model.name} to {outtype} (run {run + 1}/{args.repeat})")
+                        result = run_benchmark(dir_model, dir_out, source_size, convert_args)
+                        results.append({
+                            "arch": arch,
+                            "size": size_name,
+                            "dtype": args.dtype,
+                            "outtype": outtype,
+                            "lazy": not args.no_lazy,
+                            "convert_args": args.convert_args,
+                            "run": run,
+                            "source_size": source_size,
+                            **result,
+                        })
+                        logger.info(f"{dir_model.name} -> {outtype}: {result['source_mb_per_s']:.1f} MB/s, peak RSS {result['peak_rss'] / 1e6:.0f} MB")
+                        if not args.keep:
+                            shutil.rmtree(dir_out)
+
+                if not args.keep:
+                    shutil.rmtree(dir_model)
+    finally:
+        if not args.keep and args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = json.dumps({"python": sys.version.split()[0], "results": results}, indent=2)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)  # noqa: NP100
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 # This script downloads the tokenizer models of the specified models from Huggingface and
-# generates the get_vocab_base_pre() function for convert_hf_to_gguf.py
+# generates convert_hf_to_gguf_pre_tokenizers.json, the registry of pre-tokenizers used by
+# get_vocab_base_pre() in convert_hf_to_gguf.py
 #
 # This is necessary in order to analyze the type of pre-tokenizer used by the model and
 # provide the necessary information to llama.cpp via the GGUF header in order to implement
@@ -17,7 +18,7 @@
 #
 #   python3 convert_hf_to_gguf_update.py <huggingface_token>
 #
-# - Copy-paste the generated get_vocab_base_pre() function into convert_hf_to_gguf.py
+# - Commit the updated convert_hf_to_gguf_pre_tokenizers.json
 # - Update llama.cpp with the new pre-tokenizer if necessary
 #
 # TODO: generate tokenizer tests for llama.cpp
@@ -26,7 +27,6 @@
 import logging
 import os
 import pathlib
-import re
 
 import requests
 import sys
@@ -35,6 +35,7 @@ import shutil
 
 from hashlib import sha256
 from enum import IntEnum, auto
+from typing import cast
 from transformers import AutoTokenizer
 
 logging.basicConfig(level=logging.DEBUG)
@@ -88,6 +89,7 @@ models = [
     {"name": "smaug-bpe",      "tokt": TOKENIZER_TYPE.BPE, "repo": "https://huggingface.co/abacusai/Smaug-Llama-3-70B-Instruct", },
     {"name": "poro-chat",      "tokt": TOKENIZER_TYPE.BPE, "repo": "https://huggingface.co/LumiOpen/Poro-34B-chat", },
     {"name": "jina-v2-code",   "tokt": TOKENIZER_TYPE.BPE, "repo": "https://huggingface.co/jinaai/jina-embeddings-v2-base-code", },
+    {"name": "chatglm-bpe",    "tokt": TOKENIZER_TYPE.BPE, "repo": "https://huggingface.co/THUDM/glm-4-9b-chat", },
     {"name": "viking",         "tokt": TOKENIZER_TYPE.BPE, "repo": "https://huggingface.co/LumiOpen/Viking-7B", }, # Also used for Viking 13B and 33B
     {"name": "gemma",          "tokt": TOKENIZER_TYPE.SPM, "repo": "https://huggingface.co/google/gemma-2b", },
     {"name": "gemma-2",        "tokt": TOKENIZER_TYPE.SPM, "repo": "https://huggingface.co/google/gemma-2-9b", },
@@ -159,9 +161,17 @@ for model in models:
         logger.error(f"Failed to download model {model['name']}. Error: {e}")
 
 
-# generate the source code for the convert_hf_to_gguf.py:get_vocab_base_pre() function:
+# generate the registry of pre-tokenizers for convert_hf_to_gguf.py:get_vocab_base_pre()
 
-src_ifs = ""
+registry_pth = pathlib.Path("convert_hf_to_gguf_pre_tokenizers.json")
+
+# keep the entries of the models which can't be loaded this time
+old_entries = {}
+if registry_pth.is_file():
+    with open(registry_pth, "r", encoding="utf-8") as f:
+        old_entries = {entry["name"]: entry for entry in json.load(f)["models"]}
+
+entries = []
 for model in models:
     name = model["name"]
     tokt = model["tokt"]
@@ -172,6 +182,8 @@ for model in models:
     # Skip if the tokenizer folder does not exist or there are other download issues previously
     if not os.path.exists(f"models/tokenizers/{name}"):
         logger.warning(f"Directory for tokenizer {name} not found. Skipping...")
+        if name in old_entries:
+            entries.append(old_entries[name])
         continue
 
     # create the tokenizer
@@ -182,6 +194,8 @@ for model in models:
             tokenizer = AutoTokenizer.from_pretrained(f"models/tokenizers/{name}")
     except OSError as e:
         logger.error(f"Error loading tokenizer for model {name}. The model may not exist or is not accessible with the provided token. Error: {e}")
+        if name in old_entries:
+            entries.append(old_entries[name])
         continue  # Skip to the next model if the tokenizer can't be loaded
 
     chktok = tokenizer.encode(CHK_TXT)
@@ -193,76 +207,31 @@ for model in models:
     logger.info(f"chktok: {chktok}")
     logger.info(f"chkhsh: {chkhsh}")
 
+    entry = {"name": name, "tokt": cast(TOKENIZER_TYPE, tokt).name, "repo": model["repo"], "chkhsh": chkhsh}
+
     # print the "pre_tokenizer" content from the tokenizer.json
     with open(f"models/tokenizers/{name}/tokenizer.json", "r", encoding="utf-8") as f:
         cfg = json.load(f)
         normalizer = cfg["normalizer"]
         logger.info("normalizer: " + json.dumps(normalizer, indent=4))
+        entry["normalizer"] = normalizer
         pre_tokenizer = cfg["pre_tokenizer"]
         logger.info("pre_tokenizer: " + json.dumps(pre_tokenizer, indent=4))
+        entry["pre_tokenizer"] = pre_tokenizer
         if "ignore_merges" in cfg["model"]:
             logger.info("ignore_merges: " + json.dumps(cfg["model"]["ignore_merges"], indent=4))
+            entry["ignore_merges"] = cfg["model"]["ignore_merges"]
 
     logger.info("")
 
-    src_ifs += f"        if chkhsh == \"{chkhsh}\":\n"
-    src_ifs += f"            # ref: {model['repo']}\n"
-    src_ifs += f"            res = \"{name}\"\n"
-
-src_func = f"""
-    def get_vocab_base_pre(self, tokenizer) -> str:
-        # encoding this string and hashing the resulting tokens would (hopefully) give us a unique identifier that
-        # is specific for the BPE pre-tokenizer used by the model
-        # we will use this unique identifier to write a "tokenizer.ggml.pre" entry in the GGUF file which we can
-        # use in llama.cpp to implement the same pre-tokenizer
-
-        chktxt = {repr(CHK_TXT)}
-
-        chktok = tokenizer.encode(chktxt)
-        chkhsh = sha256(str(chktok).encode()).hexdigest()
-
-        logger.debug(f"chktok: {{chktok}}")
-        logger.debug(f"chkhsh: {{chkhsh}}")
-
-        res = None
-
-        # NOTE: if you get an error here, you need to update the convert_hf_to_gguf_update.py script
-        #       or pull the latest version of the model from Huggingface
-        #       don't edit the hashes manually!
-{src_ifs}
-        if res is None:
-            logger.warning("\\n")
-            logger.warning("**************************************************************************************")
-            logger.warning("** WARNING: The BPE pre-tokenizer was not recognized!")
-            logger.warning("**          There are 2 possible reasons for this:")
-            logger.warning("**          - the model has not been added to convert_hf_to_gguf_update.py yet")
-            logger.warning("**          - the pre-tokenization config has changed upstream")
-            logger.warning("**          Check your model files and convert_hf_to_gguf_update.py and update them accordingly.")
-            logger.warning("** ref:     https://github.com/ggerganov/llama.cpp/pull/6920")
-            logger.warning("**")
-            logger.warning(f"** chkhsh:  {{chkhsh}}")
-            logger.warning("**************************************************************************************")
-            logger.warning("\\n")
-            raise NotImplementedError("BPE pre-tokenizer was not recognized - update get_vocab_base_pre()")
-
-        logger.debug(f"tokenizer.ggml.pre: {{repr(res)}}")
-        logger.debug(f"chkhsh: {{chkhsh}}")
-
-        return res
-"""
-
-convert_py_pth = pathlib.Path("convert_hf_to_gguf.py")
-convert_py = convert_py_pth.read_text(encoding="utf-8")
-convert_py = re.sub(
-    r"(# Marker: Start get_vocab_base_pre)(.+?)( +# Marker: End get_vocab_base_pre)",
-    lambda m: m.group(1) + src_func + m.group(3),
-    convert_py,
-    flags=re.DOTALL | re.MULTILINE,
-)
-
-convert_py_pth.write_text(convert_py, encoding="utf-8")
-
-logger.info("+++ convert_hf_to_gguf.py was updated")
+    entries.append(entry)
+
+# when models share a hash, get_vocab_base_pre() uses the last one
+with open(registry_pth, "w", encoding="utf-8") as f:
+    json.dump({"chktxt": CHK_TXT, "models": entries}, f, indent=4, ensure_ascii=False)
+    f.write("\n")
+
+logger.info(f"+++ {registry_pth} was updated")
 
 # generate tests for each tokenizer model
 
@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
 from __future__ import annotations
 
+import contextlib
+import copy
+import errno
+import glob
+import json
 import logging
 import argparse
+import multiprocessing
 import os
 import struct
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
+from hashlib import sha256
 from pathlib import Path
+from typing import Any
 
 import numpy as np
 
@@ -15,6 +25,8 @@ if 'NO_LOCAL_GGUF' not in os.environ:
     sys.path.insert(1, str(Path(__file__).parent / 'gguf-py'))
 import gguf
 
+from convert_profile import StageProfiler
+
 logger = logging.getLogger("ggml-to-gguf")
 
 
@@ -65,7 +77,7 @@ class Hyperparameters:
             self.n_layer,
             self.n_rot,
             ftype,
-        ) = struct.unpack('<7I', data[offset:offset + (4 * 7)])
+        ) = struct.unpack_from('<7I', data, offset)
         try:
             self.ftype = GGMLFType(ftype)
         except ValueError:
@@ -76,6 +88,12 @@ class Hyperparameters:
         return f'<Hyperparameters: n_vocab={self.n_vocab}, n_embd={self.n_embd}, n_mult={self.n_mult}, n_head={self.n_head}, n_layer={self.n_layer}, n_rot={self.n_rot}, n_ff={self.n_ff}, ftype={self.ftype.name}>'
 
 
+# the fixed-width fields, unpacked in place from a memoryview of the file
+_u32 = struct.Struct('<I')
+_f32 = struct.Struct('<f')
+_tensor_header = struct.Struct('<3I')
+
+
 class Vocab:
     def __init__(self, load_scores = True):
         self.items = []
@@ -83,53 +101,91 @@ class Vocab:
 
     def load(self, data, offset, n_vocab):
         orig_offset = offset
+        buf = memoryview(data)
+        items = self.items
         for _ in range(n_vocab):
-            itemlen = struct.unpack('<I', data[offset:offset + 4])[0]
+            itemlen = _u32.unpack_from(buf, offset)[0]
             assert itemlen < 4096, 'Absurd vocab item length'
             offset += 4
-            item_text = bytes(data[offset:offset + itemlen])
+            item_text = bytes(buf[offset:offset + itemlen])
             offset += itemlen
             if self.load_scores:
-                item_score = struct.unpack('<f', data[offset:offset + 4])[0]
+                item_score = _f32.unpack_from(buf, offset)[0]
                 offset += 4
             else:
                 item_score = 0.0
-            self.items.append((item_text, item_score))
+            items.append((item_text, item_score))
         return offset - orig_offset
 
 
 class Tensor:
+    def __init__(self, name, dims, dtype, start_offset, len_bytes):
+        self.name = name
+        self.dims: tuple[int, ...] = dims
+        self.dtype = dtype
+        self.start_offset = start_offset
+        self.len_bytes = len_bytes
+
+
+# The tensor table of the file, as one array per field instead of a Tensor per tensor.
+# Tensor objects are only made when they are accessed.
+class TensorTable:
+    # columns of the table
+    NAME_OFFSET, NAME_LEN, N_DIMS, DTYPE, START, LENGTH = range(6)
+    DIMS = slice(6, 10)
+
     def __init__(self, use_padding = True):
-        self.name = None
-        self.dims: tuple[int, ...] = ()
-        self.dtype = None
-        self.start_offset = 0
-        self.len_bytes = np.int64(0)
         self.use_padding = use_padding
+        self.table = np.zeros((0, 10), dtype = np.int64)
+        self.names: list[bytes] = []
 
     def load(self, data, offset):
         orig_offset = offset
-        (n_dims, name_len, dtype) = struct.unpack('<3I', data[offset:offset + 12])
-        assert n_dims >= 0 and n_dims <= 4, f'Invalid tensor dimensions {n_dims}'
-        assert name_len < 4096, 'Absurd tensor name length'
-        quant = gguf.GGML_QUANT_SIZES.get(dtype)
-        assert quant is not None, 'Unknown tensor type'
-        (blksize, tysize) = quant
-        offset += 12
-        self.dtype= gguf.GGMLQuantizationType(dtype)
-        self.dims = struct.unpack(f'<{n_dims}I', data[offset:offset + (4 * n_dims)])
-        offset += 4 * n_dims
-        self.name = bytes(data[offset:offset + name_len])
-        offset += name_len
-        pad = ((offset + 31) & ~31) - offset if self.use_padding else 0
-        offset += pad
-        n_elems = np.prod(self.dims)
-        n_bytes = np.int64(np.int64(n_elems) * np.int64(tysize)) // np.int64(blksize)
-        self.start_offset = offset
-        self.len_bytes = n_bytes
-        offset += n_bytes
+        buf = memoryview(data)
+        rows = []
+        while offset < len(buf):
+            (n_dims, name_len, dtype) = _tensor_header.unpack_from(buf, offset)
+            assert n_dims >= 0 and n_dims <= 4, f'Invalid tensor dimensions {n_dims}'
+            assert name_len < 4096, 'Absurd tensor name length'
+            quant = gguf.GGML_QUANT_SIZES.get(dtype)
+            assert quant is not None, 'Unknown tensor type'
+            (blksize, tysize) = quant
+            offset += 12
+            dims = struct.unpack_from(f'<{n_dims}I', buf, offset)
+            offset += 4 * n_dims
+            name_offset = offset
+            offset += name_len
+            pad = ((offset + 31) & ~31) - offset if self.use_padding else 0
+            offset += pad
+            n_elems = 1
+            for dim in dims:
+                n_elems *= dim
+            n_bytes = n_elems * tysize // blksize
+            rows.append((name_offset, name_len, n_dims, dtype, offset, n_bytes, *dims, *((0,) * (4 - n_dims))))
+            offset += n_bytes
+        self.table = np.array(rows, dtype = np.int64).reshape(-1, 10)
+        self.names = [bytes(buf[o:o + n]) for (o, n) in self.table[:, [self.NAME_OFFSET, self.NAME_LEN]].tolist()]
         return offset - orig_offset
 
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        row = self.table[idx].tolist()
+        return Tensor(
+            name = self.names[idx],
+            dims = tuple(row[self.DIMS][:row[self.N_DIMS]]),
+            dtype = gguf.GGMLQuantizationType(row[self.DTYPE]),
+            start_offset = row[self.START],
+            len_bytes = row[self.LENGTH])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def total_bytes(self):
+        return int(self.table[:, self.LENGTH].sum())
+
 
 class GGMLModel:
 
@@ -140,7 +196,7 @@ class GGMLModel:
         self.hyperparameters = None
         self.vocab = None
         self.tensor_map = {}
-        self.tensors = []
+        self.tensors = TensorTable()
 
     def validate_header(self, data, offset):
         magic = bytes(data[offset:offset + 4])
@@ -150,7 +206,7 @@ class GGMLModel:
             self.file_format = GGMLFormat.GGML
             self.format_version = 1
             return 4
-        version = struct.unpack('<I', data[offset + 4:offset + 8])[0]
+        version = struct.unpack_from('<I', data, offset + 4)[0]
         if magic == b'fmgg':
             if version != 1:
                 raise ValueError(f'Cannot handle unexpected GGMF file version {version}')
@@ -185,13 +241,9 @@ class GGMLModel:
         self.validate_conversion(hp.ftype)
         vocab = Vocab(load_scores = self.file_format > GGMLFormat.GGML)
         offset += vocab.load(data, offset, hp.n_vocab)
-        tensors: list[Tensor] = []
-        tensor_map = {}
-        while offset < len(data):
-            tensor = Tensor(use_padding = self.file_format > GGMLFormat.GGMF)
-            offset += tensor.load(data, offset)
-            tensor_map[tensor.name] = len(tensors)
-            tensors.append(tensor)
+        tensors = TensorTable(use_padding = self.file_format > GGMLFormat.GGMF)
+        offset += tensors.load(data, offset)
+        tensor_map = {name: idx for (idx, name) in enumerate(tensors.names)}
         self.hyperparameters = hp
         self.vocab = vocab
         self.tensors = tensors
@@ -200,12 +252,52 @@ class GGMLModel:
         return offset
 
 
+# Copying regions of the input file to the output, in the kernel when possible
+# (copy_file_range can even share the blocks on filesystems like btrfs and xfs).
+# A method which isn't supported for these files is not tried again.
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+_unsupported_copy_errnos = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP}
+_copy_methods = {'copy_file_range': hasattr(os, 'copy_file_range'), 'sendfile': hasattr(os, 'sendfile')}
+
+
+def copy_file_region(src_fd, dst_fd, offset, count):
+    # writes at the current position of dst_fd
+    while count > 0:
+        n = 0
+        try:
+            if _copy_methods['copy_file_range']:
+                n = os.copy_file_range(src_fd, dst_fd, count, offset)
+            elif _copy_methods['sendfile']:
+                n = os.sendfile(dst_fd, src_fd, offset, count)
+            else:
+                chunk = os.pread(src_fd, min(count, COPY_BUFFER_SIZE), offset)
+                view = memoryview(chunk)
+                while len(view) > 0:
+                    view = view[os.write(dst_fd, view):]
+                n = len(chunk)
+        except OSError as e:
+            method = next((m for (m, supported) in _copy_methods.items() if supported), None)
+            if method is None or e.errno not in _unsupported_copy_errnos:
+                raise
+            logger.debug(f'{method} is not supported here ({e}), falling back')
+            _copy_methods[method] = False
+            continue
+        if n == 0:
+            raise ValueError('Unexpected end of the input file')
+        offset += n
+        count -= n
+
+
 class GGMLToGGUF:
-    def __init__(self, ggml_model, data, cfg, params_override = None, vocab_override = None, special_vocab = None):
+    def __init__(self, ggml_model, data, cfg, params_override = None, vocab_override = None, special_vocab = None, profiler = None, passthrough = True, source_hash = None):
         hp = ggml_model.hyperparameters
         self.model = ggml_model
         self.data = data
         self.cfg = cfg
+        self.profiler = profiler
+        self.source_hash = source_hash
+        # the tensors are never modified, so their data can be copied between the files as-is
+        self.passthrough = passthrough
         self.params_override = params_override
         self.vocab_override = vocab_override
         self.special_vocab = special_vocab
@@ -225,25 +317,52 @@ class GGMLToGGUF:
         self.n_kv_head = n_kv_head
         self.name_map = gguf.get_tensor_name_map(gguf.MODEL_ARCH.LLAMA, ggml_model.hyperparameters.n_layer)
 
+    def profile(self, stage, tensor = None, nbytes = 0):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(stage, tensor, nbytes)
+
     def save(self):
         logger.info('* Preparing to save GGUF file')
         gguf_writer = gguf.GGUFWriter(
             self.cfg.output,
             gguf.MODEL_ARCH_NAMES[gguf.MODEL_ARCH.LLAMA],
             use_temp_file = False)
-        self.add_params(gguf_writer)
-        self.add_vocab(gguf_writer)
-        if self.special_vocab is not None:
-            self.special_vocab.add_to_gguf(gguf_writer)
+        with self.profile('metadata'):
+            self.add_params(gguf_writer)
+        with self.profile('vocab'):
+            self.add_vocab(gguf_writer)
+            if self.special_vocab is not None:
+                self.special_vocab.add_to_gguf(gguf_writer)
         self.add_tensors(gguf_writer)
-        logger.info("    gguf: write header")
-        gguf_writer.write_header_to_file()
-        logger.info("    gguf: write metadata")
-        gguf_writer.write_kv_data_to_file()
-        logger.info("    gguf: write tensors")
-        gguf_writer.write_tensors_to_file()
+        nbytes = self.model.tensors.total_bytes()
+        with self.profile('write', nbytes = nbytes):
+            logger.info("    gguf: write header")
+            gguf_writer.write_header_to_file()
+            logger.info("    gguf: write metadata")
+            gguf_writer.write_kv_data_to_file()
+            logger.info("    gguf: write tensors")
+            if self.passthrough:
+                self.write_tensors_passthrough(gguf_writer)
+            else:
+                gguf_writer.write_tensors_to_file()
         gguf_writer.close()
 
+    # same as GGUFWriter.write_tensors_to_file, but with the data copied from the input file
+    def write_tensors_passthrough(self, gguf_writer):
+        gguf_writer.write_ti_data_to_file()
+        assert gguf_writer.fout is not None and len(gguf_writer.fout) == 1
+        fout = gguf_writer.fout[0]
+        gguf_writer.write_padding(fout, fout.tell())
+        with open(self.cfg.input, 'rb') as fin:
+            for tensor in self.model.tensors:
+                # the copy bypasses the buffer of fout
+                fout.flush()
+                copy_file_region(fin.fileno(), fout.fileno(), tensor.start_offset, tensor.len_bytes)
+                gguf_writer.write_padding(fout, tensor.len_bytes)
+        fout.flush()
+        gguf_writer.state = gguf.WriterState.WEIGHTS
+
     def add_params(self, gguf_writer):
         hp = self.model.hyperparameters
         cfg = self.cfg
@@ -261,6 +380,8 @@ class GGMLToGGUF:
             gguf_writer.add_name(name)
         gguf_writer.add_description(desc)
         gguf_writer.add_file_type(int(hp.ftype))
+        if self.source_hash is not None:
+            gguf_writer.add_string(KEY_SOURCE_SHA256, self.source_hash)
         if self.params_override is not None:
             po = self.params_override
             assert po.n_embd == hp.n_embd, 'Model hyperparams mismatch'
@@ -350,12 +471,70 @@ class GGMLToGGUF:
                 temp = tempdims[1]
                 tempdims[1] = tempdims[0]
                 tempdims[0] = temp
+            tensor_data = data[tensor.start_offset:tensor.start_offset + tensor.len_bytes]
+            if self.passthrough:
+                # only the tensor info, with the same arguments as add_tensor would use
+                gguf_writer.add_tensor_info(
+                    mapped_name,
+                    tempdims,
+                    tensor_data.dtype,
+                    tensor_data.nbytes,
+                    raw_dtype = tensor.dtype)
+                continue
+            if self.profiler is not None:
+                tensor_data = self.profile_read(tensor_data, mapped_name)
             gguf_writer.add_tensor(
                 mapped_name,
-                data[tensor.start_offset:tensor.start_offset + tensor.len_bytes],
+                tensor_data,
                 raw_shape = tempdims,
                 raw_dtype = tensor.dtype)
 
+    # The tensors are otherwise only read from the mapped file when written,
+    # so this makes them lazy tensors which are copied to memory in a stage of their own
+    def profile_read(self, tensor_data, name):
+        def read(tensor_data):
+            with self.profile('read', name, tensor_data.nbytes):
+                return np.array(tensor_data)
+        return gguf.LazyNumpyTensor(
+            meta = gguf.LazyNumpyTensor.meta_with_dtype_and_shape(tensor_data.dtype, tensor_data.shape),
+            args = (tensor_data,),
+            func = read)
+
+
+# sha256 of the GGML file a GGUF file was converted from (in batch mode), to skip it when converting it again
+KEY_SOURCE_SHA256 = 'ggml.source.sha256'
+
+
+def file_sha256(path):
+    h = sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(COPY_BUFFER_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def converted_source_sha256(path):
+    try:
+        reader = gguf.GGUFReader(path, 'r')
+    except (OSError, ValueError):
+        return None
+    field = reader.fields.get(KEY_SOURCE_SHA256)
+    if field is None:
+        return None
+    return bytes(field.parts[field.data[0]]).decode('utf-8')
+
+
+# the format of a GGML file and whether it can be converted, from its header alone
+def probe_file(path):
+    with open(path, 'rb') as f:
+        header = f.read(64)
+    model = GGMLModel()
+    offset = model.validate_header(header, 0)
+    hp = Hyperparameters()
+    hp.load(header, offset)
+    model.validate_conversion(hp.ftype)
+    return f'{model.file_format.name}v{model.format_version}', hp.ftype.name
+
 
 def handle_metadata(cfg, hp):
     import examples.convert_legacy_llama as convert
@@ -388,9 +567,9 @@ def handle_metadata(cfg, hp):
 def handle_args():
     parser = argparse.ArgumentParser(description = 'Convert GGML models to GGUF')
     parser.add_argument('--input', '-i', type = Path, required = True,
-                        help = 'Input GGMLv3 filename')
+                        help = 'Input GGMLv3 filename, or a directory or glob pattern (quoted) to convert several files')
     parser.add_argument('--output', '-o', type = Path, required = True,
-                        help ='Output GGUF filename')
+                        help ='Output GGUF filename, or the output directory when converting several files')
     parser.add_argument('--name',
                         help = 'Set model name')
     parser.add_argument('--desc',
@@ -408,20 +587,24 @@ def handle_args():
     parser.add_argument("--vocabtype", default="spm,hfft",
                         help="vocab format - only meaningful with --model-metadata-dir and/or --vocab-dir (default: spm,hfft)")
     parser.add_argument("--verbose", action="store_true", help="increase output verbosity")
+    parser.add_argument("--no-passthrough", action="store_true",
+                        help="write the tensors through the GGUF writer instead of copying them directly from the input file")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of files converted at the same time when converting several files")
+    parser.add_argument("--batch-report", type=Path,
+                        help="write the status of each file converted to this JSON file, when converting several files")
+    parser.add_argument("--profile-report", type=Path,
+                        help="write the time and bytes spent in each stage of the conversion, and the slowest tensors, to this JSON file")
     return parser.parse_args()
 
 
-def main():
-    cfg = handle_args()
-    logging.basicConfig(level=logging.DEBUG if cfg.verbose else logging.INFO)
-    logger.info(f'* Using config: {cfg}')
-    logger.warning('=== WARNING === Be aware that this conversion script is best-effort. Use a native GGUF model if possible. === WARNING ===')
-    if cfg.model_metadata_dir is None and (cfg.gqa == 1 or cfg.eps == '5.0e-06'):
-        logger.info('- Note: If converting LLaMA2, specifying "--eps 1e-5" is required. 70B models also need "--gqa 8".')
+def convert(cfg, source_hash = None):
+    profiler = StageProfiler() if cfg.profile_report is not None else None
     data = np.memmap(cfg.input, mode = 'r')
     model = GGMLModel()
     logger.info('* Scanning GGML input file')
-    offset = model.load(data, 0)  # noqa
+    with profiler.stage('scan') if profiler is not None else contextlib.nullcontext():
+        offset = model.load(data, 0)  # noqa
     logger.info(f'* GGML model hyperparameters: {model.hyperparameters}')
     vocab_override = None
     params_override = None
@@ -440,10 +623,135 @@ def main():
         model, data, cfg,
         params_override = params_override,
         vocab_override = vocab_override,
-        special_vocab = special_vocab
+        special_vocab = special_vocab,
+        profiler = profiler,
+        passthrough = not cfg.no_passthrough,
+        source_hash = source_hash,
     )
     converter.save()
     logger.info(f'* Successful completion. Output saved to: {cfg.output}')
+    if profiler is not None:
+        profiler.write_report(cfg.profile_report)
+        logger.info(f'* Profile report written to: {cfg.profile_report}')
+
+
+# the input files when --input is a directory or a glob pattern, None for a single file
+GGML_MAGICS = (b'lmgg', b'fmgg', b'tjgg')
+
+
+def has_ggml_magic(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) in GGML_MAGICS
+    except OSError:
+        return False
+
+
+# The GGML files of a directory or glob, and the other files found there (e.g. converted or partially converted
+# GGUF files, batch reports or READMEs), or None when the input is a single file
+def find_inputs(input_path):
+    if input_path.is_dir():
+        paths = [path for path in input_path.iterdir() if path.is_file()]
+    elif glob.has_magic(str(input_path)):
+        paths = [Path(path) for path in glob.glob(str(input_path)) if os.path.isfile(path)]
+    else:
+        return None
+    inputs = sorted(path for path in paths if has_ggml_magic(path))
+    others = sorted(set(paths) - set(inputs))
+    return (inputs, others)
+
+
+def _init_batch_worker(verbose):
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+
+
+def convert_batch_file(cfg, input_path, output_path):
+    result: dict[str, Any] = {'input': str(input_path), 'output': str(output_path)}
+    start = time.perf_counter()
+    try:
+        (result['format'], result['ftype']) = probe_file(input_path)
+        source_hash = file_sha256(input_path)
+        result['sha256'] = source_hash
+        if output_path.is_file() and converted_source_sha256(output_path) == source_hash:
+            logger.info(f'* {input_path.name}: {output_path} is up to date, skipping')
+            result['status'] = 'skipped'
+            result['reason'] = 'up to date'
+        else:
+            logger.info(f'* {input_path.name}: converting {result["format"]} {result["ftype"]} file to {output_path}')
+            file_cfg = copy.copy(cfg)
+            file_cfg.input = input_path
+            # written under another name first, so that an interrupted conversion is never taken for an up to date one
+            file_cfg.output = output_path.with_name(f'{output_path.name}.{os.getpid()}.tmp')
+            try:
+                convert(file_cfg, source_hash = source_hash)
+                os.replace(file_cfg.output, output_path)
+            finally:
+                if file_cfg.output.exists():
+                    file_cfg.output.unlink()
+            result['status'] = 'ok'
+    except Exception as e:
+        logger.error(f'* {input_path.name}: conversion failed: {e}')
+        result['status'] = 'error'
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def convert_batch(cfg, inputs, others = ()):
+    output_dir = cfg.output
+    output_dir.mkdir(parents = True, exist_ok = True)
+    outputs = [output_dir / f'{path.stem}.gguf' for path in inputs]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError('Several input files would be converted to the same output file')
+    logger.info(f'* Converting {len(inputs)} file(s) to {output_dir} with {cfg.jobs} job(s)')
+    if cfg.jobs <= 1:
+        results = [convert_batch_file(cfg, input_path, output_path) for (input_path, output_path) in zip(inputs, outputs)]
+    else:
+        with ProcessPoolExecutor(max_workers = cfg.jobs, mp_context = multiprocessing.get_context('spawn'),
+                                 initializer = _init_batch_worker, initargs = (cfg.verbose,)) as executor:
+            futures = [executor.submit(convert_batch_file, cfg, input_path, output_path) for (input_path, output_path) in zip(inputs, outputs)]
+            results = []
+            for (input_path, output_path, future) in zip(inputs, outputs, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # e.g. a worker killed by the OOM killer
+                    results.append({'input': str(input_path), 'output': str(output_path), 'status': 'error', 'error': f'{type(e).__name__}: {e}'})
+    if len(others) > 0:
+        logger.info(f'* Skipped {len(others)} file(s) which are not GGML files')
+        for path in others:
+            logger.debug(f'  {path}')
+            results.append({'input': str(path), 'status': 'skipped', 'reason': 'not a GGML file'})
+    counts = {status: sum(result['status'] == status for result in results) for status in ('ok', 'skipped', 'error')}
+    logger.info(f'* Batch done: {counts["ok"]} converted, {counts["skipped"]} skipped, {counts["error"]} failed')
+    for result in results:
+        if result['status'] == 'error':
+            logger.error(f'  {result["input"]}: {result["error"]}')
+    if cfg.batch_report is not None:
+        with open(cfg.batch_report, 'w', encoding = 'utf-8') as f:
+            json.dump({'files': results}, f, indent = 2)
+            f.write('\n')
+        logger.info(f'* Batch report written to: {cfg.batch_report}')
+    return counts['error'] == 0
+
+
+def main():
+    cfg = handle_args()
+    logging.basicConfig(level=logging.DEBUG if cfg.verbose else logging.INFO)
+    logger.info(f'* Using config: {cfg}')
+    logger.warning('=== WARNING === Be aware that this conversion script is best-effort. Use a native GGUF model if possible. === WARNING ===')
+    if cfg.model_metadata_dir is None and (cfg.gqa == 1 or cfg.eps == '5.0e-06'):
+        logger.info('- Note: If converting LLaMA2, specifying "--eps 1e-5" is required. 70B models also need "--gqa 8".')
+    found = find_inputs(cfg.input)
+    if found is None:
+        convert(cfg)
+        return
+    if cfg.profile_report is not None:
+        logger.error('--profile-report can only be used when converting a single file')
+        sys.exit(1)
+    (inputs, others) = found
+    if not convert_batch(cfg, inputs, others):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -4,11 +4,19 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+import contextlib
+import copy
+import functools
 import logging
 import argparse
+import math
+import multiprocessing
 import os
+import re
 import sys
 import json
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from math import prod
 from pathlib import Path
 from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, Sequence, SupportsIndex, cast
@@ -23,7 +31,8 @@ if 'NO_LOCAL_GGUF' not in os.environ:
 import gguf
 
 # reuse model definitions from convert_hf_to_gguf.py
-from convert_hf_to_gguf import LazyTorchTensor, Model
+from convert_hf_to_gguf import LazyTorchTensor, Model, SafetensorsFile, tensor_nbytes
+from convert_profile import StageProfiler
 
 logger = logging.getLogger("lora-to-gguf")
 
@@ -228,6 +237,214 @@ def get_base_tensor_name(lora_tensor_name: str) -> str:
     return base_name
 
 
+# the A and B tensors of the adapter, paired by the name of the base tensor they apply to
+# (from the names alone, the tensors are only read when they are converted)
+def get_lora_tensors(lora_model: SafetensorsFile | dict[str, Tensor], lazy: bool) -> dict[str, PartialLoraTensor]:
+    tensor_map: dict[str, PartialLoraTensor] = {}
+
+    for name in lora_model.keys():
+        base_name = get_base_tensor_name(name)
+        is_lora_a = ".lora_A.weight" in name
+        is_lora_b = ".lora_B.weight" in name
+        if not is_lora_a and not is_lora_b:
+            if ".base_layer.weight" in name:
+                continue
+            logger.error(f"Unexpected name '{name}': Not a lora_A or lora_B tensor")
+            sys.exit(1)
+
+        tensor: Tensor
+        if isinstance(lora_model, SafetensorsFile):
+            if lazy:
+                tensor = LazyTorchTensor.from_safetensors_file(lora_model, name)
+            else:
+                tensor = LazyTorchTensor.load_from_safetensors_file(lora_model, name)
+        else:
+            tensor = lora_model[name]
+            if lazy:
+                tensor = LazyTorchTensor.from_eager(tensor)
+
+        if base_name in tensor_map:
+            if is_lora_a:
+                tensor_map[base_name].A = tensor
+            else:
+                tensor_map[base_name].B = tensor
+        else:
+            if is_lora_a:
+                tensor_map[base_name] = PartialLoraTensor(A=tensor)
+            else:
+                tensor_map[base_name] = PartialLoraTensor(B=tensor)
+
+    for name, tensor in tensor_map.items():
+        assert tensor.A is not None
+        assert tensor.B is not None
+
+    return tensor_map
+
+
+# scaling of B @ A, like in PEFT (alpha / r, or alpha / sqrt(r) with rsLoRA)
+def get_lora_scale(base_name: str, rank: int, lparams: dict[str, Any]) -> float:
+    module_name = base_name[:-len(".weight")] if base_name.endswith(".weight") else base_name
+    alpha = float(lparams["lora_alpha"])
+    for pattern, pattern_alpha in (lparams.get("alpha_pattern") or {}).items():
+        if re.match(rf".*\.{pattern}$", module_name):
+            alpha = float(pattern_alpha)
+            break
+    return alpha / math.sqrt(rank) if lparams.get("use_rslora", False) else alpha / rank
+
+
+# Best approximation of B @ A with a lower rank (Eckart-Young), without forming the product:
+# with B = Qb Rb and A^T = Qa Ra, B @ A = Qb (Rb Ra^T) Qa^T, and only the small core Rb Ra^T needs an SVD.
+# The rank is the smallest one keeping at least the given fraction of the energy (sum of squared singular values),
+# capped by max_rank (when > 0). Also returns the relative (Frobenius) error of the approximation.
+def reduce_lora_rank(lora_a: Tensor, lora_b: Tensor, max_rank: int = 0, energy: float = 1.0) -> tuple[Tensor, Tensor, float]:
+    a = lora_a.to(torch.float32)
+    b = lora_b.to(torch.float32)
+    qb, rb = torch.linalg.qr(b)
+    qa, ra = torch.linalg.qr(a.T)
+    u, s, vh = torch.linalg.svd(rb @ ra.T, full_matrices=False)
+
+    s2 = s * s
+    total = float(s2.sum())
+    rank = s.shape[0]
+    if energy < 1.0 and total > 0:
+        kept = torch.cumsum(s2, dim=0) / total
+        rank = int(torch.count_nonzero(kept < energy)) + 1
+    if max_rank > 0:
+        rank = min(rank, max_rank)
+    rank = max(1, min(rank, s.shape[0]))
+    error = math.sqrt(max(0.0, float(s2[rank:].sum())) / total) if total > 0 else 0.0
+
+    # the singular values are split evenly between the factors, to keep their magnitudes similar
+    sqrt_s = s[:rank].sqrt()
+    new_b = (qb @ u[:, :rank]) * sqrt_s
+    new_a = sqrt_s[:, None] * (vh[:rank] @ qa.T)
+    return new_a.to(lora_a.dtype), new_b.to(lora_b.dtype), error
+
+
+# Evaluates a lazy tensor without keeping the result (nor the intermediate tensors) in the lazy tensors like to_eager does,
+# for tensors which are evaluated again when they are written.
+def to_eager_uncached(t: Any) -> Any:
+    if not isinstance(t, gguf.LazyBase):
+        return t
+    if t._data is not None:
+        return t._data
+    assert t._func is not None
+    return t._func(*gguf.LazyBase._recurse_apply(t._args, to_eager_uncached), **t._kwargs)
+
+
+# The A and B tensors of a LoRA pair reduced to a known rank, as lazy tensors.
+# The reduction is done when the first of them is evaluated, and the other one is kept until it is evaluated too.
+class ReducedLoraPair:
+    def __init__(self, lora_a: Tensor, lora_b: Tensor, rank: int, scale_b: float = 1.0):
+        self.rank = rank
+        self.scale_b = scale_b
+        self._inputs: tuple[Tensor, Tensor] | None = (lora_a, lora_b)
+        self._outputs: list[Tensor | None] | None = None
+
+    def _take(self, index: int) -> Tensor:
+        if self._outputs is None:
+            assert self._inputs is not None
+            lora_a, lora_b = LazyTorchTensor.to_eager(self._inputs)
+            self._inputs = None
+            new_a, new_b, _ = reduce_lora_rank(lora_a, lora_b, self.rank)
+            if self.scale_b != 1.0:
+                new_b = new_b * self.scale_b
+            self._outputs = [new_a, new_b]
+        output = self._outputs[index]
+        assert output is not None
+        self._outputs[index] = None
+        return output
+
+    def lazy_tensors(self) -> tuple[Tensor, Tensor]:
+        assert self._inputs is not None
+        lora_a, lora_b = self._inputs
+        meta_a = LazyTorchTensor.meta_with_dtype_and_shape(lora_a.dtype, (self.rank, lora_a.shape[1]))
+        meta_b = LazyTorchTensor.meta_with_dtype_and_shape(lora_b.dtype, (lora_b.shape[0], self.rank))
+        return (
+            cast(torch.Tensor, LazyTorchTensor(meta=meta_a, args=(0,), func=self._take)),
+            cast(torch.Tensor, LazyTorchTensor(meta=meta_b, args=(1,), func=self._take)),
+        )
+
+
+# metadata about the reduced ranks (--lora-rank, --lora-energy), in the order of the tensors
+KEY_REDUCED_TENSORS = "adapter.lora.reduced.tensors"
+KEY_REDUCED_RANKS = "adapter.lora.reduced.ranks"
+KEY_REDUCED_ERRORS = "adapter.lora.reduced.errors"
+
+
+# max number of elements of the tiles of B @ A computed at once when merging
+MERGE_TILE_SIZE = 1 << 22
+
+
+# W + scale * (B @ A), computed in tiles of rows of W,
+# so that at most one tile of the product exists at a time
+def merge_lora_delta(weight: Tensor, lora_a: Tensor, lora_b: Tensor, scale: float, fan_in_fan_out: bool = False) -> Tensor:
+    if weight.ndim != 2:
+        raise ValueError(f"Can't merge LoRA into a tensor with {weight.ndim} dimensions")
+    lora_a = lora_a.to(torch.float32)
+    lora_b = lora_b.to(torch.float32)
+    # with fan_in_fan_out, W is stored transposed, and so is the product
+    left, right = (lora_a.T, lora_b.T) if fan_in_fan_out else (lora_b, lora_a)
+    assert (left.shape[0], right.shape[1]) == tuple(weight.shape)
+
+    merged = torch.empty_like(weight)
+    n_rows = max(1, MERGE_TILE_SIZE // weight.shape[1])
+    for start in range(0, weight.shape[0], n_rows):
+        end = min(start + n_rows, weight.shape[0])
+        tile = torch.matmul(left[start:end], right)
+        tile.mul_(scale).add_(weight[start:end].to(torch.float32))
+        merged[start:end] = tile
+    return merged
+
+
+# merges the adapter into lazy base tensors, in submission order on worker threads,
+# keeping at most max_in_flight merged tensors ahead of the ones being written
+class LoraMergePool:
+    n_threads: int
+    max_in_flight: int
+
+    def __init__(self, n_threads: int, max_in_flight: int = 0):
+        self.n_threads = n_threads
+        self.max_in_flight = max_in_flight if max_in_flight > 0 else 2 * n_threads
+        self._jobs: list[tuple[Tensor, Tensor, Tensor, float, bool] | None] = []
+        self._futures: list[Future[Tensor] | None] = []
+        self._executor: ThreadPoolExecutor | None = None
+
+    def submit(self, weight: Tensor, lora_a: Tensor, lora_b: Tensor, scale: float, fan_in_fan_out: bool = False) -> Tensor:
+        if not isinstance(weight, LazyTorchTensor):
+            return merge_lora_delta(weight, lora_a, lora_b, scale, fan_in_fan_out)
+        meta = LazyTorchTensor.meta_with_dtype_and_shape(weight.dtype, weight.shape)
+        if self.n_threads <= 1:
+            return cast(torch.Tensor, LazyTorchTensor(meta=meta, args=(weight, lora_a, lora_b, scale, fan_in_fan_out), func=merge_lora_delta))
+        index = len(self._jobs)
+        self._jobs.append((weight, lora_a, lora_b, scale, fan_in_fan_out))
+        return cast(torch.Tensor, LazyTorchTensor(meta=meta, args=(index,), func=self._result))
+
+    @staticmethod
+    def _merge(weight: Tensor, lora_a: Tensor, lora_b: Tensor, scale: float, fan_in_fan_out: bool) -> Tensor:
+        with torch.inference_mode():
+            weight, lora_a, lora_b = (LazyTorchTensor.to_eager(t) for t in (weight, lora_a, lora_b))
+            return merge_lora_delta(weight, lora_a, lora_b, scale, fan_in_fan_out)
+
+    def _result(self, index: int) -> Tensor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.n_threads, thread_name_prefix="lora-merge")
+        while len(self._futures) < min(index + self.max_in_flight, len(self._jobs)):
+            job = self._jobs[len(self._futures)]
+            assert job is not None
+            self._jobs[len(self._futures)] = None
+            self._futures.append(self._executor.submit(self._merge, *job))
+        future = self._futures[index]
+        assert future is not None
+        self._futures[index] = None
+        return future.result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Convert a huggingface PEFT LoRA adapter to a GGML compatible file")
@@ -255,36 +472,418 @@ def parse_args() -> argparse.Namespace:
         "--dry-run", action="store_true",
         help="only print out what will be done, without writing any new files",
     )
+    parser.add_argument(
+        "--profile-report", type=Path, default=None,
+        help="write the time and bytes spent in each stage of the conversion, and the slowest tensors, to this JSON file",
+    )
+    parser.add_argument(
+        "--merge", action="store_true",
+        help="merge the adapter into the base model, and write the merged model instead of the adapter",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="number of tensors merged at the same time with --merge",
+    )
+    parser.add_argument(
+        "--lora-rank", type=int, default=0,
+        help="reduce the rank of each LoRA tensor to at most this (with the best approximation of B·A of that rank)",
+    )
+    parser.add_argument(
+        "--lora-energy", type=float, default=1.0,
+        help="reduce the rank of each LoRA tensor to the lowest one keeping this fraction of the energy of B·A (e.g. 0.99)",
+    )
+    parser.add_argument(
+        "--batch", type=Path, default=None,
+        help="convert all the adapters listed in this JSON lines file against the same base model, "
+             "one {\"lora_path\": ..., \"outfile\": ...} object per line (outfile is optional)",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of adapters converted at the same time in batch mode, each in its own process",
+    )
+    parser.add_argument(
+        "--batch-report", type=Path, default=None,
+        help="write the status, timings and output size of each adapter converted in batch mode to this JSON file",
+    )
     parser.add_argument(
         "--base", type=Path, required=True,
         help="directory containing base model file",
     )
     parser.add_argument(
-        "lora_path", type=Path,
+        "lora_path", type=Path, nargs="?",
         help="directory containing LoRA adapter file",
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if (args.lora_path is None) == (args.batch is None):
+        parser.error("either lora_path or --batch is required, but not both")
+    if args.batch is not None and args.outfile is not None:
+        parser.error("--outfile can't be used with --batch, set the outfile of each adapter in the batch file instead")
+    if args.batch is not None and args.profile_report is not None:
+        parser.error("--profile-report can only be used when converting a single adapter (see --batch-report)")
+    if not 0.0 < args.lora_energy <= 1.0:
+        parser.error("--lora-energy must be in (0, 1]")
+    if args.merge and (args.lora_rank > 0 or args.lora_energy < 1.0):
+        parser.error("--lora-rank and --lora-energy can't be used with --merge")
+    return args
+
+
+ftype_map: dict[str, gguf.LlamaFileType] = {
+    "f32": gguf.LlamaFileType.ALL_F32,
+    "f16": gguf.LlamaFileType.MOSTLY_F16,
+    "bf16": gguf.LlamaFileType.MOSTLY_BF16,
+    "q8_0": gguf.LlamaFileType.MOSTLY_Q8_0,
+    "auto": gguf.LlamaFileType.GUESSED,
+}
+
+
+def load_adapter(dir_lora: Path, profiler: StageProfiler | None = None) -> SafetensorsFile | dict[str, Tensor]:
+    input_model = dir_lora / "adapter_model.safetensors"
+    if os.path.exists(input_model):
+        # only the header is read here, the tensors are read from the mapped file when they are converted
+        return SafetensorsFile(input_model, profiler)
+    return torch.load(dir_lora / "adapter_model.bin", map_location="cpu", weights_only=True)
+
+
+@functools.lru_cache(maxsize=None)
+def load_base_hparams(dir_base_model: Path) -> dict[str, Any]:
+    return Model.load_hparams(dir_base_model)
+
+
+# The LoRA model class for a base model.
+# It only depends on the base model, so it's built once for all the adapters of a batch.
+@functools.lru_cache(maxsize=None)
+def lora_model_class(dir_base_model: Path) -> Callable[..., Model]:
+    model_class = Model.from_model_architecture(load_base_hparams(dir_base_model)["architectures"][0])
+
+    class LoraModel(model_class):
+        model_arch = model_class.model_arch
+
+        lora_alpha: float
+        adapter: SafetensorsFile | dict[str, Tensor]
+        max_rank: int
+        energy: float
+        # name -> (original rank, reduced rank, relative error)
+        reduced: dict[str, tuple[int, int, float]]
+
+        def __init__(self, *args, dir_lora_model: Path, lora_alpha: float, adapter: SafetensorsFile | dict[str, Tensor],
+                     max_rank: int = 0, energy: float = 1.0, **kwargs):
+            # get_tensors can be used by the base __init__ (to guess the output type)
+            self.adapter = adapter
+
+            super().__init__(*args, **kwargs)
+
+            self.dir_model_card = dir_lora_model
+            self.lora_alpha = float(lora_alpha)
+            self.max_rank = max_rank
+            self.energy = energy
+            self.reduced = {}
+
+        # the base config is only parsed once, models can modify their copy
+        @staticmethod
+        def load_hparams(dir_model: Path):
+            return copy.deepcopy(load_base_hparams(dir_model))
+
+        def set_type(self):
+            self.gguf_writer.add_type(gguf.GGUFType.ADAPTER)
+            self.gguf_writer.add_string(gguf.Keys.Adapter.TYPE, "lora")
+
+        def set_gguf_parameters(self):
+            self.gguf_writer.add_float32(gguf.Keys.Adapter.LORA_ALPHA, self.lora_alpha)
+            # the tensors are prepared before the metadata, so the reduced ranks are known
+            if len(self.reduced) > 0:
+                self.gguf_writer.add_array(KEY_REDUCED_TENSORS, list(self.reduced.keys()))
+                self.gguf_writer.add_array(KEY_REDUCED_RANKS, [rank for _, rank, _ in self.reduced.values()])
+                self.gguf_writer.add_array(KEY_REDUCED_ERRORS, [error for _, _, error in self.reduced.values()])
+            super().set_gguf_parameters()
+
+        def generate_extra_tensors(self) -> Iterable[tuple[str, Tensor]]:
+            # Never add extra tensors (e.g. rope_freqs) for LoRA adapters
+            return ()
+
+        def get_tensors(self) -> Iterator[tuple[str, Tensor]]:
+            for name, tensor in get_lora_tensors(self.adapter, self.lazy).items():
+                assert tensor.A is not None
+                assert tensor.B is not None
+                yield (name, cast(torch.Tensor, LoraTorchTensor(tensor.A, tensor.B)))
+
+        def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
+            dest = list(super().modify_tensors(data_torch, name, bid))
+            # some archs may have the same tensor for lm_head and output (tie word embeddings)
+            # in this case, adapters targeting lm_head will fail when using llama-export-lora
+            # therefore, we ignore them for now
+            # see: https://github.com/ggerganov/llama.cpp/issues/9065
+            if name == "lm_head.weight" and len(dest) == 0:
+                raise ValueError("lm_head is present in adapter, but is ignored in base model")
+            for dest_name, dest_data in dest:
+                assert isinstance(dest_data, LoraTorchTensor)
+                lora_a, lora_b = dest_data.get_lora_A_B()
+                if self.max_rank > 0 or self.energy < 1.0:
+                    lora_a, lora_b = self.reduce_rank(dest_name, lora_a, lora_b)
+
+                yield (dest_name + ".lora_a", lora_a)
+                yield (dest_name + ".lora_b", lora_b)
+
+        def reduce_rank(self, name: str, lora_a: Tensor, lora_b: Tensor) -> tuple[Tensor, Tensor]:
+            if len(lora_a.shape) != 2:
+                # e.g. stacked experts
+                logger.debug(f"{name}: not reducing the rank of a tensor with {len(lora_a.shape)} dimensions")
+                return lora_a, lora_b
+            # The reduced rank decides the shapes, which are needed before anything is written.
+            # So the pair is reduced here without keeping anything in the lazy tensors,
+            # and reduced again to the same rank when it is written, to only hold one reduced pair at a time.
+            rank = lora_a.shape[0]
+            new_a, new_b, error = reduce_lora_rank(to_eager_uncached(lora_a), to_eager_uncached(lora_b), self.max_rank, self.energy)
+            new_rank = new_a.shape[0]
+            self.reduced[name] = (rank, new_rank, error)
+            logger.debug(f"{name}: rank {rank} -> {new_rank}, relative error {error:.4g}")
+            # llama.cpp scales B @ A by alpha / rank, with the rank of the tensors in the file
+            scale_b = new_rank / rank
+            if self.lazy:
+                return ReducedLoraPair(lora_a, lora_b, new_rank, scale_b).lazy_tensors()
+            if new_rank != rank:
+                new_b = new_b * scale_b
+            return new_a, new_b
+
+        def prepare_tensors(self):
+            super().prepare_tensors()
+            if len(self.reduced) > 0:
+                n_before = sum(rank for rank, _, _ in self.reduced.values())
+                n_after = sum(rank for _, rank, _ in self.reduced.values())
+                max_error = max(error for _, _, error in self.reduced.values())
+                logger.info(f"Reduced the total rank of {len(self.reduced)} tensors from {n_before} to {n_after}, max relative error {max_error:.4g}")
+
+    return LoraModel
+
+
+# The base model class, with the adapter merged into the base tensors (--merge)
+@functools.lru_cache(maxsize=None)
+def lora_merged_model_class(dir_base_model: Path) -> Callable[..., Model]:
+    model_class = Model.from_model_architecture(load_base_hparams(dir_base_model)["architectures"][0])
+
+    class LoraMergedModel(model_class):
+        model_arch = model_class.model_arch
+
+        lora_params: dict[str, Any]
+        adapter: SafetensorsFile | dict[str, Tensor]
+        merge_pool: LoraMergePool
+
+        def __init__(self, *args, lora_params: dict[str, Any], adapter: SafetensorsFile | dict[str, Tensor], merge_threads: int = 1, **kwargs):
+            if lora_params.get("use_dora", False):
+                raise ValueError("Merging DoRA adapters is not supported")
+            # get_tensors can be used by the base __init__ (to guess the output type)
+            self.lora_params = lora_params
+            self.adapter = adapter
+            self.merge_pool = LoraMergePool(merge_threads)
+
+            super().__init__(*args, **kwargs)
+
+        # the base config is only parsed once, models can modify their copy
+        @staticmethod
+        def load_hparams(dir_model: Path):
+            return copy.deepcopy(load_base_hparams(dir_model))
+
+        def get_tensors(self) -> Iterator[tuple[str, Tensor]]:
+            lora_tensors = get_lora_tensors(self.adapter, self.lazy)
+            fan_in_fan_out = bool(self.lora_params.get("fan_in_fan_out", False))
+
+            for name, data in super().get_tensors():
+                lora = lora_tensors.pop(name, None)
+                if lora is not None:
+                    assert lora.A is not None and lora.B is not None
+                    scale = get_lora_scale(name, lora.A.shape[0], self.lora_params)
+                    data = self.merge_pool.submit(data, lora.A, lora.B, scale, fan_in_fan_out)
+                yield name, data
+
+            # e.g. an adapter for lm_head when the base model ties it to the token embeddings
+            if len(lora_tensors) > 0:
+                raise ValueError(f"LoRA tensors without base tensors to merge into: {list(lora_tensors.keys())}")
+
+        def write(self):
+            try:
+                super().write()
+            finally:
+                self.merge_pool.close()
+
+    return LoraMergedModel
+
+
+def convert_lora(dir_base_model: Path, dir_lora: Path, fname_out: Path, ftype: gguf.LlamaFileType, *,
+                 is_big_endian: bool = False, eager: bool = False, dry_run: bool = False,
+                 merge: bool = False, threads: int = 1, max_rank: int = 0, energy: float = 1.0,
+                 profiler: StageProfiler | None = None) -> Model:
+    with profiler.stage("read_adapter") if profiler is not None else contextlib.nullcontext():
+        lora_model = load_adapter(dir_lora, profiler)
+    if profiler is not None and not isinstance(lora_model, SafetensorsFile):
+        profiler.add_bytes("read_adapter", sum(tensor_nbytes(t) for t in lora_model.values()))
+
+    with open(dir_lora / "adapter_config.json", "r") as f:
+        lparams: dict[str, Any] = json.load(f)
+
+    alpha: float = lparams["lora_alpha"]
+
+    model_instance: Model
+    if merge:
+        model_instance = lora_merged_model_class(dir_base_model)(
+            dir_base_model,
+            ftype,
+            fname_out,
+            is_big_endian=is_big_endian,
+            use_temp_file=False,
+            eager=eager,
+            dry_run=dry_run,
+            lora_params=lparams,
+            adapter=lora_model,
+            merge_threads=threads,
+            profiler=profiler,
+        )
+    else:
+        model_instance = lora_model_class(dir_base_model)(
+            dir_base_model,
+            ftype,
+            fname_out,
+            is_big_endian=is_big_endian,
+            use_temp_file=False,
+            eager=eager,
+            dry_run=dry_run,
+            dir_lora_model=dir_lora,
+            lora_alpha=alpha,
+            adapter=lora_model,
+            max_rank=max_rank,
+            energy=energy,
+            profiler=profiler,
+        )
+
+    logger.info("Exporting model...")
+    model_instance.write()
+    logger.info(f"Model successfully exported to {model_instance.fname_out}")
+    return model_instance
 
 
-if __name__ == '__main__':
+@dataclass
+class BatchJob:
+    lora_path: Path
+    outfile: Path
+
+
+def load_batch_manifest(path: Path) -> list[BatchJob]:
+    jobs: list[BatchJob] = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            lora_path = Path(entry["lora_path"])
+            # output in the same directory as the adapter by default
+            jobs.append(BatchJob(lora_path, Path(entry["outfile"]) if entry.get("outfile") else lora_path))
+    return jobs
+
+
+# the options shared by all the adapters of a batch, set in each worker process
+_batch_options: dict[str, Any] = {}
+
+
+def _init_batch_worker(options: dict[str, Any]):
+    global _batch_options
+    _batch_options = options
+    logging.basicConfig(level=logging.DEBUG if options["verbose"] else logging.INFO)
+    # build the base model setup before the first adapter
+    (lora_merged_model_class if options["merge"] else lora_model_class)(options["dir_base_model"])
+
+
+def _convert_batch_job(job: BatchJob) -> dict[str, Any]:
+    options = _batch_options
+    profiler = StageProfiler()
+    summary: dict[str, Any] = {"lora_path": str(job.lora_path), "outfile": str(job.outfile)}
+    start = time.perf_counter()
+    try:
+        with torch.inference_mode():
+            model_instance = convert_lora(options["dir_base_model"], job.lora_path, job.outfile, options["ftype"],
+                                          is_big_endian=options["is_big_endian"], eager=options["eager"],
+                                          dry_run=options["dry_run"], merge=options["merge"], threads=options["threads"],
+                                          max_rank=options["max_rank"], energy=options["energy"], profiler=profiler)
+        summary["status"] = "ok"
+        summary["outfile"] = str(model_instance.fname_out)
+        if model_instance.fname_out.is_file():
+            summary["file_size"] = model_instance.fname_out.stat().st_size
+    except (Exception, SystemExit) as e:
+        logger.exception(f"Failed to convert {job.lora_path}")
+        summary["status"] = "error"
+        summary["error"] = f"{type(e).__name__}: {e}"
+    summary["seconds"] = time.perf_counter() - start
+    summary["stages"] = {stage: {"seconds": stats["seconds"], "bytes": stats["bytes"]} for stage, stats in profiler.report()["stages"].items()}
+    return summary
+
+
+def convert_lora_batch(jobs: Sequence[BatchJob], options: dict[str, Any], n_jobs: int = 1) -> list[dict[str, Any]]:
+    summaries: list[dict[str, Any]] = []
+    if n_jobs <= 1:
+        _init_batch_worker(options)
+        for job in jobs:
+            summaries.append(_convert_batch_job(job))
+        return summaries
+
+    # fork is not safe with the threads torch may have started
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_batch_worker, initargs=(options,)) as executor:
+        futures = [executor.submit(_convert_batch_job, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                summaries.append(future.result())
+            except Exception as e:
+                # e.g. a worker killed by the OOM killer
+                summaries.append({"lora_path": str(job.lora_path), "outfile": str(job.outfile), "status": "error", "error": f"{type(e).__name__}: {e}"})
+    return summaries
+
+
+def main() -> None:
     args = parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
-    ftype_map: dict[str, gguf.LlamaFileType] = {
-        "f32": gguf.LlamaFileType.ALL_F32,
-        "f16": gguf.LlamaFileType.MOSTLY_F16,
-        "bf16": gguf.LlamaFileType.MOSTLY_BF16,
-        "q8_0": gguf.LlamaFileType.MOSTLY_Q8_0,
-        "auto": gguf.LlamaFileType.GUESSED,
-    }
-
     ftype = ftype_map[args.outtype]
 
     dir_base_model: Path = args.base
+
+    # load base model
+    logger.info(f"Loading base model: {dir_base_model.name}")
+    hparams = Model.load_hparams(dir_base_model)
+    try:
+        Model.from_model_architecture(hparams["architectures"][0])
+    except NotImplementedError:
+        logger.error(f"Model {hparams['architectures'][0]} is not supported")
+        sys.exit(1)
+
+    if args.batch is not None:
+        jobs = load_batch_manifest(args.batch)
+        logger.info(f"Converting {len(jobs)} adapters against {dir_base_model.name} with {args.jobs} jobs")
+        start = time.perf_counter()
+        summaries = convert_lora_batch(jobs, {
+            "dir_base_model": dir_base_model,
+            "ftype": ftype,
+            "is_big_endian": args.bigendian,
+            "eager": args.no_lazy,
+            "dry_run": args.dry_run,
+            "merge": args.merge,
+            "threads": args.threads,
+            "max_rank": args.lora_rank,
+            "energy": args.lora_energy,
+            "verbose": args.verbose,
+        }, args.jobs)
+        n_failed = sum(summary["status"] != "ok" for summary in summaries)
+        logger.info(f"Converted {len(summaries) - n_failed}/{len(summaries)} adapters in {time.perf_counter() - start:.1f}s")
+        for summary in summaries:
+            if summary["status"] != "ok":
+                logger.error(f"{summary['lora_path']}: {summary['error']}")
+        if args.batch_report is not None:
+            with open(args.batch_report, "w", encoding="utf-8") as f:
+                json.dump({"base": str(dir_base_model), "adapters": summaries}, f, indent=2)
+                f.write("\n")
+            logger.info(f"Batch report written to {args.batch_report}")
+        if n_failed > 0:
+            sys.exit(1)
+        return
+
     dir_lora: Path = args.lora_path
-    lora_config = dir_lora / "adapter_config.json"
-    input_model = dir_lora / "adapter_model.safetensors"
 
     if args.outfile is not None:
         fname_out = args.outfile
@@ -292,112 +891,17 @@ if __name__ == '__main__':
         # output in the same directory as the model by default
         fname_out = dir_lora
 
-    if os.path.exists(input_model):
-        # lazy import load_file only if lora is in safetensors format.
-        from safetensors.torch import load_file
-
-        lora_model = load_file(input_model, device="cpu")
-    else:
-        input_model = os.path.join(dir_lora, "adapter_model.bin")
-        lora_model = torch.load(input_model, map_location="cpu", weights_only=True)
+    profiler = StageProfiler() if args.profile_report is not None else None
 
-    # load base model
-    logger.info(f"Loading base model: {dir_base_model.name}")
-    hparams = Model.load_hparams(dir_base_model)
     with torch.inference_mode():
-        try:
-            model_class = Model.from_model_architecture(hparams["architectures"][0])
-        except NotImplementedError:
-            logger.error(f"Model {hparams['architectures'][0]} is not supported")
-            sys.exit(1)
+        convert_lora(dir_base_model, dir_lora, fname_out, ftype, is_big_endian=args.bigendian, eager=args.no_lazy,
+                     dry_run=args.dry_run, merge=args.merge, threads=args.threads,
+                     max_rank=args.lora_rank, energy=args.lora_energy, profiler=profiler)
 
-        class LoraModel(model_class):
-            model_arch = model_class.model_arch
-
-            lora_alpha: float
-
-            def __init__(self, *args, dir_lora_model: Path, lora_alpha: float, **kwargs):
-
-                super().__init__(*args, **kwargs)
-
-                self.dir_model_card = dir_lora_model
-                self.lora_alpha = float(lora_alpha)
-
-            def set_type(self):
-                self.gguf_writer.add_type(gguf.GGUFType.ADAPTER)
-                self.gguf_writer.add_string(gguf.Keys.Adapter.TYPE, "lora")
-
-            def set_gguf_parameters(self):
-                self.gguf_writer.add_float32(gguf.Keys.Adapter.LORA_ALPHA, self.lora_alpha)
-                super().set_gguf_parameters()
-
-            def generate_extra_tensors(self) -> Iterable[tuple[str, Tensor]]:
-                # Never add extra tensors (e.g. rope_freqs) for LoRA adapters
-                return ()
-
-            def get_tensors(self) -> Iterator[tuple[str, Tensor]]:
-                tensor_map: dict[str, PartialLoraTensor] = {}
-
-                for name, tensor in lora_model.items():
-                    if self.lazy:
-                        tensor = LazyTorchTensor.from_eager(tensor)
-                    base_name = get_base_tensor_name(name)
-                    is_lora_a = ".lora_A.weight" in name
-                    is_lora_b = ".lora_B.weight" in name
-                    if not is_lora_a and not is_lora_b:
-                        if ".base_layer.weight" in name:
-                            continue
-                        logger.error(f"Unexpected name '{name}': Not a lora_A or lora_B tensor")
-                        sys.exit(1)
-
-                    if base_name in tensor_map:
-                        if is_lora_a:
-                            tensor_map[base_name].A = tensor
-                        else:
-                            tensor_map[base_name].B = tensor
-                    else:
-                        if is_lora_a:
-                            tensor_map[base_name] = PartialLoraTensor(A=tensor)
-                        else:
-                            tensor_map[base_name] = PartialLoraTensor(B=tensor)
-
-                for name, tensor in tensor_map.items():
-                    assert tensor.A is not None
-                    assert tensor.B is not None
-                    yield (name, cast(torch.Tensor, LoraTorchTensor(tensor.A, tensor.B)))
-
-            def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
-                dest = list(super().modify_tensors(data_torch, name, bid))
-                # some archs may have the same tensor for lm_head and output (tie word embeddings)
-                # in this case, adapters targeting lm_head will fail when using llama-export-lora
-                # therefore, we ignore them for now
-                # see: https://github.com/ggerganov/llama.cpp/issues/9065
-                if name == "lm_head.weight" and len(dest) == 0:
-                    raise ValueError("lm_head is present in adapter, but is ignored in base model")
-                for dest_name, dest_data in dest:
-                    assert isinstance(dest_data, LoraTorchTensor)
-                    lora_a, lora_b = dest_data.get_lora_A_B()
-
-                    yield (dest_name + ".lora_a", lora_a)
-                    yield (dest_name + ".lora_b", lora_b)
-
-        with open(lora_config, "r") as f:
-            lparams: dict[str, Any] = json.load(f)
-
-        alpha: float = lparams["lora_alpha"]
-
-        model_instance = LoraModel(
-            dir_base_model,
-            ftype,
-            fname_out,
-            is_big_endian=args.bigendian,
-            use_temp_file=False,
-            eager=args.no_lazy,
-            dry_run=args.dry_run,
-            dir_lora_model=dir_lora,
-            lora_alpha=alpha,
-        )
+    if profiler is not None:
+        profiler.write_report(args.profile_report)
+        logger.info(f"Profile report written to {args.profile_report}")
 
-        logger.info("Exporting model...")
-        model_instance.write()
-        logger.info(f"Model successfully exported to {model_instance.fname_out}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Per-stage profiling shared by the conversion scripts (--profile-report)
+#
+# Stages can be nested (e.g. lazy tensors evaluated while writing), and can run on multiple threads.
+# The time of a stage excludes the time of the stages nested in it on the same thread,
+# so that the stage times add up to the time spent converting.
+
+from __future__ import annotations
+
+import contextlib
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class StageStats:
+    seconds: float = 0.0
+    nbytes: int = 0
+    count: int = 0
+
+
+@dataclass
+class TensorStats:
+    seconds: float = 0.0
+    stages: dict[str, StageStats] = field(default_factory=dict)
+
+
+class StageProfiler:
+    stages: dict[str, StageStats]
+    tensors: dict[str, TensorStats]
+
+    def __init__(self):
+        self.stages = {}
+        self.tensors = {}
+        self._lock = threading.Lock()
+        # per thread stack of the time spent in nested stages
+        self._local = threading.local()
+        self._start = time.perf_counter()
+
+    def _add(self, stage: str, seconds: float, tensor: str | None, nbytes: int):
+        with self._lock:
+            stats = self.stages.setdefault(stage, StageStats())
+            stats.seconds += seconds
+            stats.nbytes += nbytes
+            stats.count += 1
+            if tensor is not None:
+                tensor_stats = self.tensors.setdefault(tensor, TensorStats())
+                tensor_stats.seconds += seconds
+                stage_stats = tensor_stats.stages.setdefault(stage, StageStats())
+                stage_stats.seconds += seconds
+                stage_stats.nbytes += nbytes
+                stage_stats.count += 1
+
+    # for when the amount of data is only known after the stage
+    def add_bytes(self, stage: str, nbytes: int):
+        with self._lock:
+            self.stages.setdefault(stage, StageStats()).nbytes += nbytes
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, tensor: str | None = None, nbytes: int = 0) -> Iterator[None]:
+        nested: list[float] = getattr(self._local, "nested", None) or []
+        self._local.nested = nested
+        nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested_time = nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            self._add(stage, elapsed - nested_time, tensor, nbytes)
+
+    # time spent getting each item, for generators doing their work lazily
+    def iterate(self, stage: str, items: Iterable[T], tensor_name: Callable[[T], str | None] = lambda _: None,
+                nbytes: Callable[[T], int] = lambda _: 0) -> Iterator[T]:
+        it = iter(items)
+        while True:
+            nested: list[float] = getattr(self._local, "nested", None) or []
+            self._local.nested = nested
+            nested.append(0.0)
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                nested.pop()
+                return
+            except BaseException:
+                nested.pop()
+                raise
+            elapsed = time.perf_counter() - start
+            nested_time = nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            self._add(stage, elapsed - nested_time, tensor_name(item), nbytes(item))
+            yield item
+
+    def report(self, top_n: int = 10) -> dict[str, Any]:
+        with self._lock:
+            total = sum(stats.seconds for stats in self.stages.values())
+            slowest = sorted(self.tensors.items(), key=lambda kv: kv[1].seconds, reverse=True)[:top_n]
+            return {
+                "wall_time": time.perf_counter() - self._start,
+                "profiled_time": total,
+                "stages": {
+                    stage: {
+                        "seconds": stats.seconds,
+                        "fraction": stats.seconds / total if total > 0 else 0.0,
+                        "bytes": stats.nbytes,
+                        "mb_per_s": stats.nbytes / 1e6 / stats.seconds if stats.seconds > 0 else None,
+                        "count": stats.count,
+                    }
+                    for stage, stats in sorted(self.stages.items(), key=lambda kv: kv[1].seconds, reverse=True)
+                },
+                "slowest_tensors": [
+                    {
+                        "name": name,
+                        "seconds": stats.seconds,
+                        "stages": {stage: {"seconds": s.seconds, "bytes": s.nbytes} for stage, s in stats.stages.items()},
+                    }
+                    for name, stats in slowest
+                ],
+            }
+
+    def write_report(self, path: Path, top_n: int = 10):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(top_n), f, indent=2)
+            f.write("\n")
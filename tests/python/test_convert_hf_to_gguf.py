@@ -0,0 +1,884 @@
+from __future__ import annotations
+
+import io
+import json
+import re
+import sys
+import threading
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Iterator, cast
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("gguf")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+import gguf  # noqa: E402
+from gguf import GGMLQuantizationType  # noqa: E402
+from gguf.quants import quantize  # noqa: E402
+
+import convert_hf_to_gguf  # noqa: E402
+from convert_hf_to_gguf import (  # noqa: E402
+    LazyTorchTensor, LlamaModel, MemoryBudget, Model, QuantCache, SafetensorsFile, SentencePieceModel, SentencePieceTokenTypes,
+    ShardJournal, TensorDedup, VocabCache, bf16_to_f16, bf16_to_f32, bpe_merge, bpe_merges, load_pre_tokenizers, new_lazy,
+    quantize_bf16, quantize_tensor, write_tensors_to_files,
+)
+from convert_hf_to_gguf_bench import make_checkpoint, write_safetensors  # noqa: E402
+from convert_profile import StageProfiler  # noqa: E402
+
+
+###### conversion ######
+
+# small enough to convert quickly, with rows of 256 elements for the ternary types
+TINY_LLAMA_CONFIG: dict[str, Any] = {
+    "architectures": ["LlamaForCausalLM"],
+    "hidden_size": 256,
+    "intermediate_size": 512,
+    "num_hidden_layers": 2,
+    "num_attention_heads": 4,
+    "num_key_value_heads": 2,
+    "vocab_size": 64,
+    "max_position_embeddings": 256,
+    "rms_norm_eps": 1e-5,
+    "rope_theta": 10000.0,
+    "torch_dtype": "bfloat16",
+}
+
+
+def write_tiny_llama(dir_model: Path) -> Path:
+    from safetensors.torch import save_file
+
+    config = TINY_LLAMA_CONFIG
+    n_embd, n_ff, n_vocab = config["hidden_size"], config["intermediate_size"], config["vocab_size"]
+    n_embd_kv = n_embd // config["num_attention_heads"] * config["num_key_value_heads"]
+    shapes: dict[str, tuple[int, ...]] = {
+        "model.embed_tokens.weight": (n_vocab, n_embd),
+        "model.norm.weight": (n_embd,),
+        "lm_head.weight": (n_vocab, n_embd),
+    }
+    for bid in range(config["num_hidden_layers"]):
+        layer = f"model.layers.{bid}"
+        shapes.update({
+            f"{layer}.input_layernorm.weight": (n_embd,),
+            f"{layer}.post_attention_layernorm.weight": (n_embd,),
+            f"{layer}.self_attn.q_proj.weight": (n_embd, n_embd),
+            f"{layer}.self_attn.k_proj.weight": (n_embd_kv, n_embd),
+            f"{layer}.self_attn.v_proj.weight": (n_embd_kv, n_embd),
+            f"{layer}.self_attn.o_proj.weight": (n_embd, n_embd),
+            f"{layer}.mlp.gate_proj.weight": (n_ff, n_embd),
+            f"{layer}.mlp.up_proj.weight": (n_ff, n_embd),
+            f"{layer}.mlp.down_proj.weight": (n_embd, n_ff),
+        })
+    gen = torch.Generator().manual_seed(0)
+    dir_model.mkdir(parents=True)
+    (dir_model / "config.json").write_text(json.dumps(config))
+    save_file({name: torch.randn(shape, generator=gen).to(torch.bfloat16) for name, shape in shapes.items()}, dir_model / "model.safetensors")
+    return dir_model
+
+
+@pytest.fixture
+def tiny_llama(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    pytest.importorskip("safetensors")
+    # there are no tokenizer files, the vocab isn't what these tests are about
+    monkeypatch.setattr(LlamaModel, "set_vocab", lambda self: None)
+    return write_tiny_llama(tmp_path / "tiny-llama")
+
+
+def convert(dir_model: Path, fname_out: Path, ftype: gguf.LlamaFileType = gguf.LlamaFileType.MOSTLY_Q8_0, **kwargs: Any) -> Path:
+    model_class = Model.from_model_architecture("LlamaForCausalLM")
+    with torch.inference_mode():
+        model = model_class(dir_model, ftype, fname_out, **kwargs)
+        model.write()
+    return model.fname_out
+
+
+@pytest.mark.parametrize("eager", [False, True])
+def test_quantize_pool_matches_serial(tiny_llama: Path, tmp_path: Path, eager: bool) -> None:
+    expected = convert(tiny_llama, tmp_path / "serial.gguf", eager=eager).read_bytes()
+    assert convert(tiny_llama, tmp_path / "pool.gguf", eager=eager, threads=2, max_tensors_in_flight=3).read_bytes() == expected
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_stream_matches_serial(tiny_llama: Path, tmp_path: Path, threads: int) -> None:
+    expected = convert(tiny_llama, tmp_path / "serial.gguf").read_bytes()
+    assert convert(tiny_llama, tmp_path / "stream.gguf", stream=True, threads=threads, max_tensors_in_flight=2).read_bytes() == expected
+
+
+###### SafetensorsFile ######
+
+def test_safetensors_file_matches_safe_open(tmp_path: Path) -> None:
+    pytest.importorskip("safetensors")
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+
+    gen = torch.Generator().manual_seed(0)
+    path = tmp_path / "model.safetensors"
+    save_file({
+        "bf16": torch.randn(3, 5, generator=gen).to(torch.bfloat16),
+        "f16": torch.randn(4, 2, 3, generator=gen).to(torch.float16),
+        "f32": torch.randn(7, generator=gen),
+        "i64": torch.arange(6, dtype=torch.int64).reshape(2, 3),
+        "u8": torch.arange(5, dtype=torch.uint8),
+        "bool": torch.tensor([True, False, True]),
+        "scalar": torch.tensor(1.5),
+        "empty": torch.zeros(0, 4),
+    }, path, metadata={"format": "pt"})
+
+    st_file = SafetensorsFile(path)
+    with safe_open(path, framework="pt") as f:
+        assert st_file.metadata == f.metadata()
+        assert sorted(st_file.keys()) == sorted(f.keys())
+        for name in f.keys():
+            expected = f.get_tensor(name)
+            assert st_file.get_shape(name) == tuple(expected.shape)
+            data = st_file.get_numpy(name)
+            if expected.dtype == torch.bfloat16:
+                # the raw bits
+                assert np.array_equal(data.view(np.int16), expected.view(torch.int16).numpy())
+            else:
+                assert np.array_equal(data, expected.numpy())
+            for tensor in (LazyTorchTensor.load_from_safetensors_file(st_file, name),
+                           LazyTorchTensor.to_eager(LazyTorchTensor.from_safetensors_file(st_file, name))):
+                assert tensor.dtype == expected.dtype
+                assert torch.equal(tensor, expected)
+
+    # the views are writable, without modifying the file
+    data = st_file.get_numpy("f32")
+    data[0] = 42
+    assert st_file.get_numpy("f32")[0] == 42
+    assert SafetensorsFile(path).get_numpy("f32")[0] != 42
+
+
+###### bfloat16 ######
+
+def all_bf16_bits() -> np.ndarray:
+    return np.arange(1 << 16, dtype=np.uint16).reshape(256, 256)
+
+
+def test_bf16_to_f16_all_patterns() -> None:
+    bits = all_bf16_bits()
+    with np.errstate(over="ignore"):
+        expected = bf16_to_f32(bits).astype(np.float16)
+    result = bf16_to_f16(bits)
+    assert result.dtype == np.float16 and result.shape == bits.shape
+    # rounding, subnormals, overflow, infinities and nan payloads
+    assert np.array_equal(result.view(np.uint16), expected.view(np.uint16))
+
+
+@pytest.mark.parametrize("qtype", [GGMLQuantizationType.BF16, GGMLQuantizationType.F16, GGMLQuantizationType.Q8_0])
+def test_quantize_bf16_matches_float32(qtype: GGMLQuantizationType) -> None:
+    bits = all_bf16_bits()
+    if qtype == GGMLQuantizationType.Q8_0:
+        # blocks with infinities or nans don't have a meaningful scale
+        bits = bits[np.isfinite(bf16_to_f32(bits)).all(axis=1)]
+    # the scales of the blocks with the biggest values overflow
+    with np.errstate(over="ignore", invalid="ignore"):
+        expected = quantize(bf16_to_f32(bits), qtype)
+        result = quantize_bf16(bits, qtype)
+        lazy = quantize_bf16(gguf.LazyNumpyTensor.from_eager(bits), qtype)
+        lazy_result = gguf.LazyNumpyTensor.to_eager(lazy)
+    assert result.dtype == expected.dtype and result.shape == expected.shape
+    assert np.array_equal(result.view(np.uint8), expected.view(np.uint8))
+    assert lazy.dtype == expected.dtype and lazy.shape == expected.shape
+    assert np.array_equal(lazy_result.view(np.uint8), expected.view(np.uint8))
+
+
+###### merge_experts ######
+
+def make_model(block_count: int) -> Any:
+    # merge_experts only needs the block count and the memory budget
+    model: Any = object.__new__(Model)
+    model.block_count = block_count
+    model.memory_budget = None
+    return model
+
+
+def expert_data(bid: int, xid: int, wid: str) -> Any:
+    return torch.full((2, 3), float(bid * 1000 + xid * 10 + ["w1", "w2", "w3"].index(wid)))
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+@pytest.mark.parametrize("n_experts", [4, 12])
+def test_merge_experts_sorted_checkpoint_order(lazy: bool, n_experts: int) -> None:
+    model = make_model(block_count=2)
+    pattern = r"model\.layers\.\d+\.block_sparse_moe\.experts\.(\d+)\.(\w+)\.weight"
+    wids = ["w1", "w2", "w3"]
+
+    # safetensors checkpoints store their tensors sorted by name (so "experts.10" comes before "experts.2")
+    names = sorted(
+        f"model.layers.{bid}.block_sparse_moe.experts.{xid}.{wid}.weight"
+        for bid in range(2) for xid in range(n_experts) for wid in wids
+    )
+
+    merged: list[tuple[int, str, Any]] = []
+    for name in names:
+        parts = name.split(".")
+        bid, xid, wid = int(parts[2]), int(parts[5]), parts[6]
+        data = expert_data(bid, xid, wid)
+        if lazy:
+            data = LazyTorchTensor.from_eager(data)
+        for merged_wid, tensor in model.merge_experts(name, data, bid, n_experts, pattern, wids):
+            merged.append((bid, merged_wid, tensor))
+
+    assert sorted((bid, wid) for bid, wid, _ in merged) == [(bid, wid) for bid in range(2) for wid in wids]
+    for bid, wid, tensor in merged:
+        if lazy:
+            tensor = LazyTorchTensor.to_eager(tensor)
+        assert tensor.shape == (n_experts, 2, 3)
+        for xid in range(n_experts):
+            assert torch.equal(tensor[xid], expert_data(bid, xid, wid))
+
+    # nothing is left for the "Unprocessed experts" check
+    assert all(len(experts) == 0 for experts in model._experts)
+
+
+def test_merge_experts_rejects_duplicates() -> None:
+    model = make_model(block_count=1)
+    pattern = r"experts\.(\d+)\.(\w+)"
+    model.merge_experts("experts.0.w1", torch.zeros(2), 0, 2, pattern, ["w1"])
+    with pytest.raises(ValueError, match="Duplicated"):
+        model.merge_experts("experts.0.w1", torch.zeros(2), 0, 2, pattern, ["w1"])
+    with pytest.raises(ValueError, match="Can not map"):
+        model.merge_experts("experts.0.w9", torch.zeros(2), 0, 2, pattern, ["w1"])
+
+
+###### QuantCache ######
+
+def test_quant_cache_bounded_and_writable(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    tensors = [rng.standard_normal((64, 256), dtype=np.float32) for _ in range(8)]
+    entry_size = 64 * 256 // 32 * 34
+    cache = QuantCache(tmp_path, max_size=3 * entry_size + 3 * 1024)
+
+    for i, data in enumerate(tensors):
+        cache.quantize(data, GGMLQuantizationType.Q8_0, name=f"t{i}")
+        assert sum(p.stat().st_size for p in tmp_path.glob("*/*.npy")) <= cache.max_size
+
+    # the most recent entries are kept, and can be byteswapped in place like the writer does for big-endian outputs
+    expected = quantize(tensors[-1], GGMLQuantizationType.Q8_0)
+    cached = cache.quantize(tensors[-1], GGMLQuantizationType.Q8_0, name="t7")
+    assert isinstance(cached, np.memmap)
+    cached.byteswap(inplace=True)
+    # without changing the cache entry
+    assert np.array_equal(cache.quantize(tensors[-1], GGMLQuantizationType.Q8_0, name="t7"), expected)
+
+    # conversions to float types aren't cached
+    n_entries = len(list(tmp_path.glob("*/*.npy")))
+    cache.quantize(tensors[0], GGMLQuantizationType.F16, name="f16")
+    assert len(list(tmp_path.glob("*/*.npy"))) == n_entries
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_quant_cache_conversion_matches_uncached(tiny_llama: Path, tmp_path: Path, threads: int) -> None:
+    expected = convert(tiny_llama, tmp_path / "uncached.gguf").read_bytes()
+    cache_dir = tmp_path / "cache"
+    # the first conversion fills the cache, the second one only reads it
+    for i in range(2):
+        assert convert(tiny_llama, tmp_path / f"cached-{i}.gguf", threads=threads, cache_dir=cache_dir).read_bytes() == expected
+    assert any(cache_dir.glob("*/*.npy"))
+
+
+###### quantize_tensor ######
+
+@pytest.mark.parametrize("qtype", [GGMLQuantizationType.Q8_0, GGMLQuantizationType.TQ1_0, GGMLQuantizationType.TQ2_0])
+@pytest.mark.parametrize("dtype", [np.float32, np.float16, np.uint16])
+@pytest.mark.parametrize("n_threads", [1, 3])
+def test_quantize_tensor_matches_gguf(monkeypatch: pytest.MonkeyPatch, qtype: GGMLQuantizationType, dtype: type, n_threads: int) -> None:
+    # small tiles, to have many of them and a partial one at the end
+    monkeypatch.setattr(convert_hf_to_gguf, "TILE_SIZE", 3 * 256)
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((7, 1024), dtype=np.float32)
+    # blocks of zeros, and values which round half away from zero
+    data[1] = 0
+    data[2, :32] = np.arange(32) - 15.5
+    if dtype == np.uint16:
+        # raw bfloat16 bits
+        data = (data.view(np.uint32) >> 16).astype(np.uint16)
+        expected = quantize(bf16_to_f32(data), qtype)
+    else:
+        data = data.astype(dtype)
+        expected = quantize(data, qtype)
+
+    result = quantize_tensor(data, qtype, n_threads)
+    assert result.dtype == expected.dtype and result.shape == expected.shape
+    assert np.array_equal(result, expected)
+
+    lazy = quantize_tensor(gguf.LazyNumpyTensor.from_eager(data), qtype, n_threads)
+    assert lazy.shape == expected.shape
+    assert np.array_equal(gguf.LazyNumpyTensor.to_eager(lazy), expected)
+
+
+def test_quantize_tensor_rejects_partial_blocks() -> None:
+    with pytest.raises(gguf.QuantError):
+        quantize_tensor(np.zeros((2, 100), dtype=np.float32), GGMLQuantizationType.Q8_0)
+
+
+def test_extra_outtypes_match_single_outputs(tiny_llama: Path, tmp_path: Path) -> None:
+    ftypes = [gguf.LlamaFileType.MOSTLY_Q8_0, gguf.LlamaFileType.MOSTLY_F16, gguf.LlamaFileType.MOSTLY_BF16]
+    convert(tiny_llama, tmp_path / "multi-{ftype}.gguf", ftypes[0], extra_ftypes=ftypes[1:])
+    for ftype in ftypes:
+        expected = convert(tiny_llama, tmp_path / "single-{ftype}.gguf", ftype).read_bytes()
+        assert (tmp_path / f"multi-{ftype.name.partition('_')[2].lower()}.gguf").read_bytes() == expected
+
+
+def test_extra_outtypes_reject_duplicated_auto(tiny_llama: Path, tmp_path: Path) -> None:
+    # the tensors are bfloat16
+    with pytest.raises(ValueError, match="auto"):
+        convert(tiny_llama, tmp_path / "{ftype}.gguf", gguf.LlamaFileType.GUESSED, extra_ftypes=[gguf.LlamaFileType.MOSTLY_BF16])
+
+
+###### benchmark checkpoints ######
+
+@pytest.mark.parametrize("arch", ["llama", "qwen2moe", "gptneox"])
+def test_bench_checkpoint_converts(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, arch: str) -> None:
+    safetensors = pytest.importorskip("safetensors")
+    dir_model = tmp_path / arch
+    # small shards, to have tensors of the same layer in different files
+    make_checkpoint(dir_model, arch, "tiny", "bf16", shard_size=4 * 1024 * 1024)
+    index = json.loads((dir_model / "model.safetensors.index.json").read_text())
+    parts = sorted(set(index["weight_map"].values()))
+    assert len(parts) > 1
+    for part in parts:
+        with safetensors.safe_open(dir_model / part, framework="np") as f:
+            names = list(f.keys())
+        # stored sorted by name, like the safetensors library does (the merge of MoE experts depends on it)
+        assert names == sorted(n for n, p in index["weight_map"].items() if p == part)
+
+    config = json.loads((dir_model / "config.json").read_text())
+    model_class = Model.from_model_architecture(config["architectures"][0])
+    monkeypatch.setattr(model_class, "set_vocab", lambda self: None)
+    with torch.inference_mode():
+        model = model_class(dir_model, gguf.LlamaFileType.MOSTLY_Q8_0, tmp_path / f"{arch}.gguf")
+        model.write()
+    assert model.fname_out.stat().st_size > 0
+
+
+###### profiling ######
+
+@pytest.mark.parametrize("eager", [False, True])
+def test_profile_stages_count_each_tensor_once(tiny_llama: Path, tmp_path: Path, eager: bool) -> None:
+    profiler = StageProfiler()
+    fname_out = convert(tiny_llama, tmp_path / "model.gguf", eager=eager, profiler=profiler)
+    n_tensors = len(gguf.GGUFReader(fname_out).tensors)
+    stages = profiler.report()["stages"]
+    for stage in ("read", "modify_tensors", "quantize"):
+        assert stages[stage]["count"] == n_tensors, stage
+    st_file = SafetensorsFile(tiny_llama / "model.safetensors")
+    assert stages["read"]["bytes"] == sum(st_file.get_numpy(name).nbytes for name in st_file.keys())
+
+
+###### bpe_merge ######
+
+# the merges before bpe_merge, which rescanned all the parts after each merge
+def reference_bpe(mergeable_ranks: dict[bytes, int], token: bytes, max_rank: int | None = None) -> list[bytes]:
+    parts = [bytes([byte]) for byte in token]
+    while True:
+        min_idx = None
+        min_rank = None
+        for i, pair in enumerate(zip(parts[:-1], parts[1:])):
+            rank = mergeable_ranks.get(pair[0] + pair[1])
+            if rank is not None and (min_rank is None or rank < min_rank):
+                min_idx = i
+                min_rank = rank
+        if min_rank is None or (max_rank is not None and min_rank >= max_rank):
+            break
+        assert min_idx is not None
+        parts = parts[:min_idx] + [parts[min_idx] + parts[min_idx + 1]] + parts[min_idx + 2:]
+    return parts
+
+
+def random_ranks(rng: np.random.Generator, n_merges: int) -> dict[bytes, int]:
+    # a small alphabet, to get many overlapping merges
+    ranks = {bytes([b]): i for i, b in enumerate(b"abcd")}
+    tokens = list(ranks)
+    while len(ranks) < 4 + n_merges:
+        token = tokens[rng.integers(len(tokens))] + tokens[rng.integers(len(tokens))]
+        if token not in ranks:
+            ranks[token] = len(ranks)
+            tokens.append(token)
+    return ranks
+
+
+def test_bpe_merge_matches_reference() -> None:
+    rng = np.random.default_rng(0)
+    ranks = random_ranks(rng, 300)
+    for token, rank in ranks.items():
+        assert bpe_merge(ranks, token, max_rank=rank) == reference_bpe(ranks, token, max_rank=rank)
+    for _ in range(200):
+        token = bytes(rng.choice(list(b"abcd"), size=rng.integers(1, 40)).tolist())
+        assert bpe_merge(ranks, token) == reference_bpe(ranks, token)
+    assert bpe_merge(ranks, b"") == []
+
+
+def test_bpe_merges_workers() -> None:
+    ranks = random_ranks(np.random.default_rng(1), 200)
+    assert bpe_merges(ranks, n_workers=2, chunk_size=50) == bpe_merges(ranks)
+
+
+###### VocabCache ######
+
+class VocabModel:
+    n_loads = 0
+
+    def __init__(self, dir_model: Path):
+        self.dir_model = dir_model
+        self.part_names = ["model.safetensors"]
+        self.hparams = json.loads((dir_model / "config.json").read_text())
+        self.gguf_writer = gguf.GGUFWriter(path=None, arch="llama")
+
+    def set_vocab(self):
+        VocabModel.n_loads += 1
+        tokens = (self.dir_model / "tokenizer.txt").read_text(encoding="utf-8").split()
+        self.gguf_writer.add_tokenizer_model("gpt2")
+        self.gguf_writer.add_token_list(tokens)
+        self.gguf_writer.add_token_scores([-float(i) for i in range(len(tokens))])
+        self.gguf_writer.add_token_types([1] * len(tokens))
+        self.gguf_writer.add_bos_token_id(0)
+        self.special_token = tokens[0]
+        self.hparams["vocab_size"] = len(tokens)
+
+
+def write_vocab_model(dir_model: Path, tokens: str) -> Path:
+    dir_model.mkdir(exist_ok=True)
+    (dir_model / "config.json").write_text(json.dumps({"hidden_size": 8, "torch_dtype": "float16"}))
+    (dir_model / "tokenizer.txt").write_text(tokens, encoding="utf-8")
+    (dir_model / "model.safetensors").write_bytes(b"weights")
+    return dir_model
+
+
+def set_cached_vocab(cache: VocabCache, dir_model: Path) -> VocabModel:
+    model = VocabModel(dir_model)
+    cache.set_vocab(cast(Any, model))
+    return model
+
+
+def test_vocab_cache(tmp_path: Path) -> None:
+    cache_dir = tmp_path / "cache"
+    dir_model = write_vocab_model(tmp_path / "model", "<s> hello wörld \U0001f999")
+    VocabModel.n_loads = 0
+
+    expected = set_cached_vocab(VocabCache(cache_dir), dir_model)
+    assert VocabModel.n_loads == 1
+    assert len(list(cache_dir.glob("*.npz"))) == 1
+
+    # another conversion of the same model, or of a fine-tune with another config and other weights
+    (dir_model / "model.safetensors").write_bytes(b"other weights")
+    (dir_model / "README.md").write_text("fine-tuned")
+    (dir_model / "config.json").write_text(json.dumps({"hidden_size": 8, "torch_dtype": "bfloat16"}))
+    model = set_cached_vocab(VocabCache(cache_dir), dir_model)
+    assert VocabModel.n_loads == 1
+    assert model.gguf_writer.kv_data == expected.gguf_writer.kv_data
+    assert model.special_token == "<s>"
+    assert model.hparams["vocab_size"] == 4
+
+    # changed tokenizer files, or hparams
+    (dir_model / "tokenizer.txt").write_text("<s> hello")
+    model = set_cached_vocab(VocabCache(cache_dir), dir_model)
+    assert VocabModel.n_loads == 2
+    assert model.hparams["vocab_size"] == 2
+    (dir_model / "config.json").write_text(json.dumps({"hidden_size": 16}))
+    set_cached_vocab(VocabCache(cache_dir), dir_model)
+    assert VocabModel.n_loads == 3
+    assert len(list(cache_dir.glob("*.npz"))) == 3
+
+
+def test_vocab_cache_without_cache_dir(tmp_path: Path) -> None:
+    dir_model = write_vocab_model(tmp_path / "model", "<s> hello")
+    VocabModel.n_loads = 0
+
+    # the vocab is still only extracted once for all the outputs
+    cache = VocabCache(None)
+    models = [set_cached_vocab(cache, dir_model) for _ in range(2)]
+    assert VocabModel.n_loads == 1
+    assert models[0].gguf_writer.kv_data == models[1].gguf_writer.kv_data
+    assert models[1].special_token == "<s>"
+
+
+def test_vocab_cache_ignores_invalid_entries(tmp_path: Path) -> None:
+    cache_dir = tmp_path / "cache"
+    dir_model = write_vocab_model(tmp_path / "model", "<s> hello")
+    VocabModel.n_loads = 0
+
+    set_cached_vocab(VocabCache(cache_dir), dir_model)
+    (entry,) = cache_dir.glob("*.npz")
+    entry.write_bytes(b"not a zip file")
+    model = set_cached_vocab(VocabCache(cache_dir), dir_model)
+    assert VocabModel.n_loads == 2
+    assert model.hparams["vocab_size"] == 2
+
+
+###### pre-tokenizers ######
+
+def test_pre_tokenizer_registry() -> None:
+    chktxt, pre_tokenizers = load_pre_tokenizers()
+    assert len(chktxt) > 0
+    for chkhsh, pre_tokenizer in pre_tokenizers.items():
+        assert re.fullmatch(r"[0-9a-f]{64}", chkhsh)
+        assert pre_tokenizer["chkhsh"] == chkhsh
+        assert pre_tokenizer["name"] and pre_tokenizer["repo"].startswith("https://")
+    assert pre_tokenizers["0ef9807a4087ebef797fc749390439009c3b9eda9ad1a097abbe738f486c01e5"]["name"] == "llama-bpe"
+
+
+class CharTokenizer:
+    def encode(self, text: str) -> list[int]:
+        return [ord(c) for c in text]
+
+
+@pytest.fixture
+def pre_tokenizers_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    path = tmp_path / "pre_tokenizers.json"
+    monkeypatch.setattr(convert_hf_to_gguf, "PRE_TOKENIZERS_PATH", path)
+    load_pre_tokenizers.cache_clear()
+    yield path
+    load_pre_tokenizers.cache_clear()
+
+
+def test_get_vocab_base_pre(pre_tokenizers_path: Path) -> None:
+    chktxt = "some text"
+    chkhsh = sha256(str(CharTokenizer().encode(chktxt)).encode()).hexdigest()
+    models = [
+        {"name": "first", "tokt": "BPE", "repo": "https://example.com/first", "chkhsh": chkhsh},
+        {"name": "other", "tokt": "BPE", "repo": "https://example.com/other", "chkhsh": "0" * 64},
+        {"name": "last", "tokt": "BPE", "repo": "https://example.com/last", "chkhsh": chkhsh},
+    ]
+    pre_tokenizers_path.write_text(json.dumps({"chktxt": chktxt, "models": models}))
+    model = object.__new__(Model)
+    # like the chain of ifs it replaces, the last model with a hash wins
+    assert model.get_vocab_base_pre(CharTokenizer()) == "last"
+
+    pre_tokenizers_path.write_text(json.dumps({"chktxt": chktxt, "models": models[1:2]}))
+    load_pre_tokenizers.cache_clear()
+    with pytest.raises(NotImplementedError):
+        model.get_vocab_base_pre(CharTokenizer())
+
+
+###### parallel shards ######
+
+def read_shards(fname_out: Path) -> list[tuple[str, bytes]]:
+    return [(path.name, path.read_bytes()) for path in sorted(fname_out.parent.glob(f"{fname_out.stem}-*.gguf"))]
+
+
+@pytest.mark.parametrize("eager", [False, True])
+def test_parallel_shards_match_sequential(tiny_llama: Path, tmp_path: Path, eager: bool) -> None:
+    (tmp_path / "sequential").mkdir()
+    (tmp_path / "parallel").mkdir()
+    convert(tiny_llama, tmp_path / "sequential" / "model.gguf", eager=eager, split_max_tensors=5)
+    expected = read_shards(tmp_path / "sequential" / "model.gguf")
+    assert len(expected) == 5
+
+    convert(tiny_llama, tmp_path / "parallel" / "model.gguf", eager=eager, split_max_tensors=5, parallel_split=True)
+    assert read_shards(tmp_path / "parallel" / "model.gguf") == expected
+
+
+def test_memory_budget_waits_for_releases() -> None:
+    budget = MemoryBudget(100)
+    budget.acquire(60)
+    acquired = threading.Event()
+
+    def acquire() -> None:
+        budget.acquire(60)
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    assert not acquired.wait(0.1)
+    budget.release(60)
+    assert acquired.wait(10)
+    thread.join()
+
+    # a tensor bigger than the whole budget still goes through once nothing else is in use
+    budget.release(60)
+    budget.acquire(1000)
+    assert budget.in_use == 1000
+
+
+###### ShardJournal ######
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupted_tensor(shape: tuple[int, ...]) -> Any:
+    def interrupt() -> np.ndarray:
+        raise Interrupted
+    return new_lazy(gguf.LazyNumpyTensor, gguf.LazyNumpyTensor.meta_with_dtype_and_shape(np.float32, shape), interrupt)
+
+
+# writes the tensors like Model.write does with --resume, and returns the journals
+def write_resumable(path: Path, tensors: dict[str, Any], kv: int = 1, progress: bool = False) -> list[ShardJournal]:
+    writer = gguf.GGUFWriter(path=None, arch="llama")
+    writer.add_uint32("test.kv", kv)
+    for name, data in tensors.items():
+        writer.add_tensor(name, data, raw_shape=data.shape, raw_dtype=GGMLQuantizationType.F32)
+    journals = ShardJournal.prepare(writer, path)
+    writer.write_header_to_file(path=path)
+    writer.write_kv_data_to_file()
+    try:
+        write_tensors_to_files([writer], progress=progress, journals=[journals])
+    finally:
+        for journal in journals:
+            journal.close()
+    writer.close()
+    return journals
+
+
+def read_tensors(path: Path) -> dict[str, np.ndarray]:
+    return {t.name: np.array(t.data) for t in gguf.GGUFReader(path).tensors}
+
+
+@pytest.mark.parametrize("progress", [False, True])
+def test_shard_journal_resume(tmp_path: Path, caplog: pytest.LogCaptureFixture, progress: bool) -> None:
+    path = tmp_path / "model.gguf"
+    rng = np.random.default_rng(0)
+    old = {f"t{i}": rng.standard_normal((4, 8), dtype=np.float32) for i in range(4)}
+    new = {name: data + 1 for name, data in old.items()}
+
+    # interrupted while converting t2
+    with pytest.raises(Interrupted):
+        write_resumable(path, {**old, "t2": interrupted_tensor((4, 8))})
+    with open(path.with_name("model.gguf.journal"), encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert [entry.get("name") for entry in entries] == [None, "t0", "t1"]
+
+    # t1 was damaged on disk after its journal entry was written
+    with open(path, "r+b") as f:
+        f.seek(entries[2]["offset"])
+        f.write(b"\xff\xff\xff\xff")
+
+    # only the missing and damaged tensors are written again, t0 still has the data of the first run
+    journals = write_resumable(path, new, progress=progress)
+    assert all(len(journal.pending) == 0 for journal in journals)
+    result = read_tensors(path)
+    assert np.array_equal(result["t0"], old["t0"])
+    for name in ("t1", "t2", "t3"):
+        assert np.array_equal(result[name], new[name])
+
+    # nothing is left to write
+    write_resumable(path, {name: interrupted_tensor((4, 8)) for name in new})
+
+    # the tensors of a shard with other metadata are all written again
+    write_resumable(path, new, kv=2)
+    assert "the metadata changed since the previous conversion" in caplog.text
+    result = read_tensors(path)
+    assert all(np.array_equal(result[name], new[name]) for name in new)
+
+    # the journals of a finished conversion are removed, so its shards are written again
+    journals[0].close(remove=True)
+    caplog.clear()
+    write_resumable(path, new)
+    assert "exists but has no journal" in caplog.text
+
+
+###### MemoryBudget ######
+
+def test_memory_budget_acquire() -> None:
+    budget = MemoryBudget(100)
+    assert budget.try_acquire(60)
+    assert not budget.try_acquire(60)
+    # needed right away, whether it fits or not
+    budget.reserve(60)
+    assert (budget.in_use, budget.peak) == (120, 120)
+    budget.release(60)
+    budget.release(60)
+
+    # waits until the tensors in flight are released
+    budget.acquire(80)
+    waiting = threading.Thread(target=budget.acquire, args=(50,))
+    waiting.start()
+    waiting.join(0.1)
+    assert waiting.is_alive()
+    budget.release(80)
+    waiting.join(10)
+    assert not waiting.is_alive()
+    assert budget.in_use == 50
+    budget.release(50)
+
+    # a tensor bigger than the budget still goes through alone
+    budget.acquire(500)
+    assert budget.peak == 500
+    budget.release(500)
+    assert budget.in_use == 0
+
+    unbounded = MemoryBudget(0)
+    assert unbounded.try_acquire(1 << 40)
+
+
+def test_memory_budget_spills_buffers(tmp_path: Path) -> None:
+    budget = MemoryBudget(1024, spill_dir=tmp_path)
+    in_memory = budget.empty((16, 16), torch.float32)
+    assert (budget.scratch, budget.spilled) == (1024, 0)
+
+    spilled = budget.empty((16, 16), torch.float32)
+    assert (budget.scratch, budget.spilled) == (1024, 1024)
+    spilled[...] = 1
+    assert spilled.sum() == 256
+    if sys.platform != "win32":
+        assert list(tmp_path.iterdir()) == []
+
+    # the buffers are released once garbage collected
+    del in_memory
+    assert budget.scratch == 0
+    assert budget.try_acquire(1024)
+
+
+@pytest.mark.parametrize("parallel_split", [False, True])
+def test_max_memory_output_unchanged(tiny_llama: Path, tmp_path: Path, parallel_split: bool) -> None:
+    (tmp_path / "unbounded").mkdir()
+    (tmp_path / "bounded").mkdir()
+    convert(tiny_llama, tmp_path / "unbounded" / "model.gguf", split_max_tensors=5)
+    expected = read_shards(tmp_path / "unbounded" / "model.gguf")
+
+    # less than the biggest tensor
+    convert(tiny_llama, tmp_path / "bounded" / "model.gguf", split_max_tensors=5, parallel_split=parallel_split, max_memory=64 * 1024)
+    assert read_shards(tmp_path / "bounded" / "model.gguf") == expected
+
+
+@pytest.mark.parametrize("args, max_bytes", [
+    ([], 0),
+    (["--split-max-tensors", "5", "--split-parallel"], 4 * 1000 ** 3),
+    (["--split-max-tensors", "5", "--split-parallel", "--max-memory", "0"], 0),
+    (["--max-memory", "1M"], 1000 ** 2),
+])
+def test_max_memory_default(tiny_llama: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, args: list[str], max_bytes: int) -> None:
+    budgets: list[MemoryBudget] = []
+    monkeypatch.setattr(Model, "write", lambda self: budgets.append(self.memory_budget))
+    monkeypatch.setattr(sys, "argv", ["convert_hf_to_gguf.py", str(tiny_llama), "--outfile", str(tmp_path / "model.gguf"), *args])
+    convert_hf_to_gguf.main()
+    assert [budget.max_bytes for budget in budgets] == [max_bytes]
+
+
+###### TensorDedup ######
+
+def test_tensor_dedup(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    embed = rng.standard_normal((1024, 64)).astype(np.float16)
+    # only differs in a byte which isn't sampled
+    almost = embed.copy()
+    almost[300, 0] += 1
+    write_safetensors(tmp_path / "model.safetensors", [
+        ("embed_tokens.weight", embed), ("lm_head.weight", embed.copy()), ("almost.weight", almost),
+        ("other.weight", rng.standard_normal((1024, 64)).astype(np.float16)),
+    ], "f16")
+    st_file = SafetensorsFile(tmp_path / "model.safetensors")
+
+    dedup = TensorDedup()
+    tensors = {name: torch.from_numpy(st_file.get_numpy(name)) for name in st_file.keys()}
+
+    dedup.next_source()
+    assert dedup.find("token_embd.weight", tensors["embed_tokens.weight"], (st_file, "embed_tokens.weight")) is None
+    dedup.store("token_embd.weight", 0, GGMLQuantizationType.Q8_0, GGMLQuantizationType.Q8_0, np.zeros(4, dtype=np.uint8))
+    # modify_tensors returning the same tensor for two names, as for tied embeddings
+    assert dedup.find("output.weight", tensors["embed_tokens.weight"], None) == "token_embd.weight"
+
+    for name in ("almost.weight", "other.weight"):
+        dedup.next_source()
+        assert dedup.find(name, tensors[name], (st_file, name)) is None
+
+    dedup.next_source()
+    same_as = dedup.find("output.weight", tensors["lm_head.weight"], (st_file, "lm_head.weight"))
+    assert same_as == "token_embd.weight"
+    assert dedup.reuse(same_as, 0, GGMLQuantizationType.Q8_0, embed.nbytes) is not None
+    # other outputs and types are converted again
+    assert dedup.reuse(same_as, 1, GGMLQuantizationType.Q8_0, embed.nbytes) is None
+    assert dedup.reuse(same_as, 0, GGMLQuantizationType.F16, embed.nbytes) is None
+    assert dedup.n_reused == 2
+    assert dedup.nbytes_saved == embed.nbytes
+
+    # modified tensors are never compared by value
+    dedup.next_source()
+    assert dedup.find("modified.weight", tensors["lm_head.weight"] * 1, None) is None
+
+
+def test_tensor_dedup_holds_reused_results() -> None:
+    budget = MemoryBudget(1 << 20)
+    dedup = TensorDedup(budget)
+    result = gguf.LazyNumpyTensor.from_eager(np.zeros((16, 64), dtype=np.float32)) * 2
+    dedup.store("token_embd.weight", 0, GGMLQuantizationType.F32, GGMLQuantizationType.F32, result)
+    assert budget.scratch == 0
+
+    # held once, however many times it is reused
+    for _ in range(2):
+        reused = dedup.reuse("token_embd.weight", 0, GGMLQuantizationType.F32, result.nbytes)
+        assert reused is not None and reused[1] is result
+    assert budget.scratch == result.nbytes
+    assert budget.peak == result.nbytes
+
+    del dedup, reused, result
+    assert budget.scratch == 0
+
+
+def test_tied_embeddings_converted_once(tiny_llama: Path, tmp_path: Path, caplog: pytest.LogCaptureFixture) -> None:
+    from safetensors.torch import load_file, save_file
+
+    path = tiny_llama / "model.safetensors"
+    tensors = load_file(path)
+    tensors["lm_head.weight"] = tensors["model.embed_tokens.weight"].clone()
+    save_file(tensors, path)
+
+    with caplog.at_level("INFO"):
+        reader = gguf.GGUFReader(convert(tiny_llama, tmp_path / "model.gguf"))
+    # lm_head.weight comes first in the file
+    assert "token_embd.weight: same data as output.weight" in caplog.text
+    assert "Found 1 duplicated tensors" in caplog.text
+    data = {t.name: np.array(t.data) for t in reader.tensors}
+    assert np.array_equal(data["output.weight"], data["token_embd.weight"])
+
+
+###### SentencePieceModel ######
+
+def train_sentencepiece(tmp_path: Path, **kwargs: Any) -> Path:
+    spm = pytest.importorskip("sentencepiece")
+    sentences = [f"the {w} jumps over the lazy dog number {i} ünïcödé 日本語" for i, w in enumerate(["quick", "brown", "fox", "cat"] * 50)]
+    model = io.BytesIO()
+    spm.SentencePieceTrainer.train(sentence_iterator=iter(sentences), model_writer=model, vocab_size=400,
+                                   user_defined_symbols=["<tool>"], control_symbols=["<ctl>"], byte_fallback=True,
+                                   minloglevel=2, **kwargs)
+    path = tmp_path / "tokenizer.model"
+    path.write_bytes(model.getvalue())
+    return path
+
+
+# what the vocab loops did with SentencePieceProcessor before SentencePieceModel
+def processor_vocab(path: Path, vocab_size: int) -> tuple[list[bytes], list[float], list[int]]:
+    from sentencepiece import SentencePieceProcessor
+
+    tokenizer = SentencePieceProcessor()
+    tokenizer.LoadFromFile(str(path))
+    tokens = [f"[PAD{i}]".encode("utf-8") for i in range(vocab_size)]
+    scores = [-10000.0] * vocab_size
+    toktypes = [int(SentencePieceTokenTypes.UNUSED)] * vocab_size
+    for token_id in range(tokenizer.vocab_size()):
+        toktype = SentencePieceTokenTypes.NORMAL
+        if tokenizer.IsUnknown(token_id):
+            toktype = SentencePieceTokenTypes.UNKNOWN
+        elif tokenizer.IsControl(token_id):
+            toktype = SentencePieceTokenTypes.CONTROL
+        elif tokenizer.IsUnused(token_id):
+            toktype = SentencePieceTokenTypes.UNUSED
+        elif tokenizer.IsByte(token_id):
+            toktype = SentencePieceTokenTypes.BYTE
+        tokens[token_id] = tokenizer.IdToPiece(token_id).encode("utf-8")
+        scores[token_id] = tokenizer.GetScore(token_id)
+        toktypes[token_id] = int(toktype)
+    return tokens, scores, toktypes
+
+
+@pytest.mark.parametrize("model_type", ["unigram", "bpe"])
+def test_sentencepiece_model_load(tmp_path: Path, model_type: str) -> None:
+    path = train_sentencepiece(tmp_path, model_type=model_type, add_dummy_prefix=False)
+    model = SentencePieceModel.load(path)
+
+    assert model.vocab_size == 400
+    assert model.model_type == {"unigram": 1, "bpe": 2}[model_type]
+    assert model.add_dummy_prefix is False
+    assert model.remove_extra_whitespaces is True
+    assert len(model.precompiled_charsmap) > 0
+
+    for vocab_size in (400, 410):
+        tokens, scores, toktypes = model.vocab(vocab_size)
+        assert (tokens, scores, [int(t) for t in toktypes]) == processor_vocab(path, vocab_size)
+    assert SentencePieceTokenTypes.BYTE in toktypes and SentencePieceTokenTypes.CONTROL in toktypes
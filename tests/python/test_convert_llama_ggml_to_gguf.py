@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import errno
+import json
+import os
+import struct
+import sys
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pytest
+
+pytest.importorskip("gguf")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+import gguf  # noqa: E402
+
+import convert_llama_ggml_to_gguf  # noqa: E402
+from convert_llama_ggml_to_gguf import (  # noqa: E402
+    TensorTable, Vocab, converted_source_sha256, copy_file_region, file_sha256, find_inputs, main,
+)
+
+
+def tensor_header(name: bytes, dims: tuple[int, ...], dtype: int) -> bytes:
+    return struct.pack("<3I", len(dims), len(name), dtype) + struct.pack(f"<{len(dims)}I", *dims) + name
+
+
+# a tiny GGJTv3 llama model with float32 tensors, returns the names and sizes of its tensors
+def write_ggjt(path: Path, n_vocab: int = 8, n_embd: int = 64, n_ff: int = 128, n_head: int = 4) -> dict[str, int]:
+    data = bytearray(b"tjgg" + struct.pack("<I", 3))
+    data += struct.pack("<7I", n_vocab, n_embd, 256, n_head, 1, n_embd // n_head, 0)
+    for i in range(n_vocab):
+        text = f"t{i}".encode()
+        data += struct.pack("<I", len(text)) + text + struct.pack("<f", -float(i))
+    # in the ggml order of the dimensions
+    shapes: dict[str, tuple[int, ...]] = {
+        "tok_embeddings.weight": (n_embd, n_vocab),
+        "norm.weight": (n_embd,),
+        "output.weight": (n_embd, n_vocab),
+        "layers.0.attention_norm.weight": (n_embd,),
+        "layers.0.ffn_norm.weight": (n_embd,),
+        **{f"layers.0.attention.{w}.weight": (n_embd, n_embd) for w in ("wq", "wk", "wv", "wo")},
+        "layers.0.feed_forward.w1.weight": (n_embd, n_ff),
+        "layers.0.feed_forward.w2.weight": (n_ff, n_embd),
+        "layers.0.feed_forward.w3.weight": (n_embd, n_ff),
+    }
+    rng = np.random.default_rng(0)
+    for name, dims in shapes.items():
+        data += tensor_header(name.encode(), dims, 0)
+        data += bytes(-len(data) % 32)
+        data += rng.standard_normal(int(np.prod(dims)), dtype=np.float32).tobytes()
+    path.write_bytes(data)
+    return {name: int(np.prod(dims)) * 4 for name, dims in shapes.items()}
+
+
+def test_profile_report(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    tensor_sizes = write_ggjt(tmp_path / "model.bin")
+    # the tensors are only read separately from the writes when they go through the writer
+    extra_args = ["--no-passthrough"]
+    for name, args in (("plain", []), ("profiled", ["--profile-report", str(tmp_path / "profile.json")])):
+        argv = ["-i", str(tmp_path / "model.bin"), "-o", str(tmp_path / f"{name}.gguf"), *extra_args, *args]
+        monkeypatch.setattr(sys, "argv", ["convert_llama_ggml_to_gguf.py", *argv])
+        main()
+
+    # profiling doesn't change the output
+    assert (tmp_path / "profiled.gguf").read_bytes() == (tmp_path / "plain.gguf").read_bytes()
+    stages = json.loads((tmp_path / "profile.json").read_text())["stages"]
+    assert stages["read"]["count"] == len(tensor_sizes)
+    assert stages["read"]["bytes"] == sum(tensor_sizes.values())
+    for stage in ("scan", "metadata", "vocab", "write"):
+        assert stages[stage]["count"] == 1, stage
+
+
+@pytest.mark.parametrize("use_padding", [False, True])
+def test_tensor_table(use_padding: bool) -> None:
+    tensors = [
+        (b"tok_embeddings.weight", (64, 10), gguf.GGMLQuantizationType.F16),
+        (b"norm.weight", (64,), gguf.GGMLQuantizationType.F32),
+        (b"layers.0.attention.wq.weight", (64, 64), gguf.GGMLQuantizationType.Q8_0),
+        (b"scalar", (), gguf.GGMLQuantizationType.F32),
+    ]
+    # the table doesn't start at the beginning of the file, and the padding depends on the absolute offset
+    data = bytearray(b"vocab")
+    expected = []
+    for name, dims, dtype in tensors:
+        data += tensor_header(name, dims, dtype)
+        if use_padding:
+            data += bytes(-len(data) % 32)
+        block_size, type_size = gguf.GGML_QUANT_SIZES[dtype]
+        n_bytes = int(np.prod(dims)) * type_size // block_size
+        expected.append((name, dims, dtype, len(data), n_bytes))
+        data += bytes(range(256)) * (n_bytes // 256) + bytes(n_bytes % 256)
+
+    table = TensorTable(use_padding=use_padding)
+    assert table.load(memoryview(bytes(data)), 5) == len(data) - 5
+    assert len(table) == len(tensors)
+    assert table.names == [name for name, _, _, _, _ in expected]
+    assert [(t.name, t.dims, t.dtype, t.start_offset, t.len_bytes) for t in table] == expected
+    assert table.total_bytes() == sum(n_bytes for _, _, _, _, n_bytes in expected)
+
+
+@pytest.mark.parametrize("load_scores", [False, True])
+def test_vocab(load_scores: bool) -> None:
+    items = [(b"", 0.0), (b"hello", -1.5), ("wörld".encode(), 2.0)]
+    data = bytearray(b"hp")
+    for text, score in items:
+        data += struct.pack("<I", len(text)) + text
+        if load_scores:
+            data += struct.pack("<f", score)
+    data += b"tensors"
+
+    vocab = Vocab(load_scores=load_scores)
+    assert vocab.load(bytes(data), 2, len(items)) == len(data) - 2 - len(b"tensors")
+    assert vocab.items == (items if load_scores else [(text, 0.0) for text, _ in items])
+
+
+def copy_region(tmp_path: Path, data: bytes, offset: int, count: int) -> bytes:
+    (tmp_path / "src.bin").write_bytes(data)
+    with open(tmp_path / "src.bin", "rb") as fsrc, open(tmp_path / "dst.bin", "wb") as fdst:
+        # the region is written at the current position of the output
+        fdst.write(b"header")
+        fdst.flush()
+        copy_file_region(fsrc.fileno(), fdst.fileno(), offset, count)
+    return (tmp_path / "dst.bin").read_bytes()
+
+
+@pytest.mark.parametrize("methods", [
+    {"copy_file_range": True, "sendfile": True},
+    {"copy_file_range": False, "sendfile": True},
+    {"copy_file_range": False, "sendfile": False},
+])
+def test_copy_file_region(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, methods: dict[str, bool]) -> None:
+    methods = {method: supported and hasattr(os, method) for method, supported in methods.items()}
+    monkeypatch.setattr(convert_llama_ggml_to_gguf, "_copy_methods", methods)
+    # in many chunks
+    monkeypatch.setattr(convert_llama_ggml_to_gguf, "COPY_BUFFER_SIZE", 4096)
+    data = np.random.default_rng(0).bytes(100_000)
+    assert copy_region(tmp_path, data, 1000, 50_000) == b"header" + data[1000:51_000]
+
+    with pytest.raises(ValueError, match="end of the input file"):
+        copy_region(tmp_path, data, 90_000, 20_000)
+
+
+def test_copy_file_region_falls_back(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(convert_llama_ggml_to_gguf, "_copy_methods", {"copy_file_range": True, "sendfile": False})
+    n_calls = 0
+
+    def unsupported(*args: Any) -> int:
+        nonlocal n_calls
+        n_calls += 1
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "copy_file_range", unsupported, raising=False)
+    data = np.random.default_rng(0).bytes(10_000)
+    assert copy_region(tmp_path, data, 0, 10_000) == b"header" + data
+    # and it isn't tried again
+    assert copy_region(tmp_path, data, 100, 200) == b"header" + data[100:300]
+    assert n_calls == 1
+
+    def failing(*args: Any) -> int:
+        raise OSError(errno.EIO, "Input/output error")
+
+    monkeypatch.setattr(convert_llama_ggml_to_gguf, "_copy_methods", {"copy_file_range": True, "sendfile": False})
+    monkeypatch.setattr(os, "copy_file_range", failing, raising=False)
+    with pytest.raises(OSError):
+        copy_region(tmp_path, data, 0, 10_000)
+
+
+def test_passthrough_matches_writer(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    write_ggjt(tmp_path / "model.bin")
+    for name, args in (("writer", ["--no-passthrough"]), ("passthrough", [])):
+        monkeypatch.setattr(sys, "argv", ["convert_llama_ggml_to_gguf.py", "-i", str(tmp_path / "model.bin"), "-o", str(tmp_path / f"{name}.gguf"), *args])
+        main()
+    assert (tmp_path / "passthrough.gguf").read_bytes() == (tmp_path / "writer.gguf").read_bytes()
+
+
+def test_find_inputs_only_keeps_ggml_files(tmp_path: Path) -> None:
+    for name in ("a.bin", "b.ggml"):
+        (tmp_path / name).write_bytes(b"tjgg" + struct.pack("<I", 3))
+    (tmp_path / "old.bin").write_bytes(b"lmgg")
+    # a converted file, an interrupted conversion, a batch report and a README
+    (tmp_path / "a.gguf").write_bytes(b"GGUF" + struct.pack("<I", 3))
+    (tmp_path / "b.gguf.1234.tmp").write_bytes(b"GGUF")
+    (tmp_path / "report.json").write_text("{}")
+    (tmp_path / "README").write_text("")
+    (tmp_path / "subdir").mkdir()
+
+    inputs = [tmp_path / name for name in ("a.bin", "b.ggml", "old.bin")]
+    others = [tmp_path / name for name in ("README", "a.gguf", "b.gguf.1234.tmp", "report.json")]
+    assert find_inputs(tmp_path) == (inputs, others)
+    assert find_inputs(tmp_path / "*.b*") == (inputs[:1] + inputs[2:], [])
+    assert find_inputs(tmp_path / "a.bin") is None
+
+
+def test_batch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    dir_in = tmp_path / "in"
+    dir_in.mkdir()
+    tensor_sizes = write_ggjt(dir_in / "a.bin")
+    write_ggjt(dir_in / "b.bin", n_vocab=16)
+    # a truncated file
+    (dir_in / "broken.bin").write_bytes((dir_in / "a.bin").read_bytes()[:100])
+    (dir_in / "README").write_text("")
+    report_path = tmp_path / "report.json"
+    monkeypatch.setattr(sys, "argv", ["convert_llama_ggml_to_gguf.py", "-i", str(dir_in), "-o", str(tmp_path / "out"), "--batch-report", str(report_path)])
+
+    def run() -> dict[str, dict[str, Any]]:
+        # a failed file fails the batch, after converting the other ones
+        with pytest.raises(SystemExit):
+            main()
+        return {Path(result["input"]).name: result for result in json.loads(report_path.read_text())["files"]}
+
+    results = run()
+    assert {name: result["status"] for name, result in results.items()} == {"a.bin": "ok", "b.bin": "ok", "broken.bin": "error", "README": "skipped"}
+    assert sorted(path.name for path in (tmp_path / "out").iterdir()) == ["a.gguf", "b.gguf"]
+    for name in ("a", "b"):
+        assert converted_source_sha256(tmp_path / "out" / f"{name}.gguf") == file_sha256(dir_in / f"{name}.bin")
+        assert len(gguf.GGUFReader(tmp_path / "out" / f"{name}.gguf").tensors) == len(tensor_sizes)
+
+    # only the changed files are converted again
+    write_ggjt(dir_in / "b.bin", n_vocab=32)
+    results = run()
+    assert results["a.bin"]["status"] == "skipped" and results["a.bin"]["reason"] == "up to date"
+    assert results["b.bin"]["status"] == "ok"
+    assert results["README"]["reason"] == "not a GGML file"
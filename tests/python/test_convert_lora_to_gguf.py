@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import json
+import sys
+from pathlib import Path
+from typing import Any, cast
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("gguf")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+import gguf  # noqa: E402
+
+import convert_lora_to_gguf  # noqa: E402
+from convert_hf_to_gguf import LazyTorchTensor, LlamaModel, SafetensorsFile, tensor_nbytes  # noqa: E402
+from convert_lora_to_gguf import (  # noqa: E402
+    BatchJob, LoraMergePool, LoraTorchTensor, ReducedLoraPair, convert_lora_batch, get_lora_scale, get_lora_tensors,
+    load_batch_manifest, merge_lora_delta, parse_args, reduce_lora_rank, to_eager_uncached,
+)
+
+
+def test_tensor_nbytes_of_lora_tensors() -> None:
+    a = torch.zeros(4, 256)
+    b = torch.zeros(128, 4)
+    # only A and B are read and converted, not the product they stand for
+    assert tensor_nbytes(cast(Any, LoraTorchTensor(a, b))) == a.nbytes + b.nbytes
+    assert tensor_nbytes(cast(Any, LoraTorchTensor(LazyTorchTensor.from_eager(a), LazyTorchTensor.from_eager(b)))) == a.nbytes + b.nbytes
+
+
+def write_adapter(dir_lora: Path, rank: int = 4, seed: int = 0) -> dict[str, Any]:
+    from safetensors.torch import save_file
+
+    gen = torch.Generator().manual_seed(seed)
+    tensors: dict[str, Any] = {}
+    for bid in range(2):
+        for proj, n_out in (("q_proj", 256), ("v_proj", 128)):
+            prefix = f"base_model.model.model.layers.{bid}.self_attn.{proj}"
+            tensors[f"{prefix}.lora_A.weight"] = torch.randn(rank, 256, generator=gen)
+            tensors[f"{prefix}.lora_B.weight"] = torch.randn(n_out, rank, generator=gen)
+    dir_lora.mkdir(parents=True)
+    save_file(tensors, dir_lora / "adapter_model.safetensors")
+    (dir_lora / "adapter_config.json").write_text(json.dumps({"r": rank, "lora_alpha": 8, "peft_type": "LORA"}))
+    return tensors
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_lora_tensors_are_paired_from_the_names(tmp_path: Path, lazy: bool) -> None:
+    pytest.importorskip("safetensors")
+    tensors = write_adapter(tmp_path / "lora")
+    st_file = SafetensorsFile(tmp_path / "lora" / "adapter_model.safetensors")
+
+    pairs = get_lora_tensors(st_file, lazy)
+    assert sorted(pairs) == sorted(f"model.layers.{bid}.self_attn.{proj}.weight" for bid in range(2) for proj in ("q_proj", "v_proj"))
+    for name, pair in pairs.items():
+        assert pair.A is not None and pair.B is not None
+        if lazy:
+            # nothing is read before the tensors are converted
+            assert isinstance(pair.A, LazyTorchTensor) and pair.A._data is None
+            assert isinstance(pair.B, LazyTorchTensor) and pair.B._data is None
+        prefix = f"base_model.model.{name.removesuffix('.weight')}"
+        assert torch.equal(LazyTorchTensor.to_eager(pair.A), tensors[f"{prefix}.lora_A.weight"])
+        assert torch.equal(LazyTorchTensor.to_eager(pair.B), tensors[f"{prefix}.lora_B.weight"])
+
+
+@pytest.fixture
+def base_model(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    # an adapter only needs the config of its base model, and no vocab
+    monkeypatch.setattr(LlamaModel, "set_vocab", lambda self: None)
+    dir_model = tmp_path / "base"
+    dir_model.mkdir()
+    (dir_model / "config.json").write_text(json.dumps({
+        "architectures": ["LlamaForCausalLM"], "hidden_size": 256, "intermediate_size": 512, "num_hidden_layers": 2,
+        "num_attention_heads": 4, "num_key_value_heads": 2, "vocab_size": 64, "max_position_embeddings": 256,
+        "rms_norm_eps": 1e-5, "rope_theta": 10000.0,
+    }))
+    return dir_model
+
+
+def batch_options(dir_base_model: Path, **kwargs: Any) -> dict[str, Any]:
+    options = {
+        "dir_base_model": dir_base_model, "ftype": gguf.LlamaFileType.MOSTLY_F16, "is_big_endian": False, "eager": False,
+        "dry_run": False, "merge": False, "threads": 1, "max_rank": 0, "energy": 1.0, "verbose": False,
+    }
+    options.update(kwargs)
+    return options
+
+
+def test_load_batch_manifest(tmp_path: Path) -> None:
+    manifest = tmp_path / "batch.jsonl"
+    manifest.write_text('{"lora_path": "a", "outfile": "a.gguf"}\n\n{"lora_path": "b"}\n')
+    assert load_batch_manifest(manifest) == [BatchJob(Path("a"), Path("a.gguf")), BatchJob(Path("b"), Path("b"))]
+
+
+def test_lora_batch(base_model: Path, tmp_path: Path) -> None:
+    pytest.importorskip("safetensors")
+    write_adapter(tmp_path / "a")
+    write_adapter(tmp_path / "b", seed=1)
+    jobs = [
+        BatchJob(tmp_path / "a", tmp_path / "a.gguf"),
+        BatchJob(tmp_path / "missing", tmp_path / "missing.gguf"),
+        BatchJob(tmp_path / "b", tmp_path / "b.gguf"),
+    ]
+    summaries = convert_lora_batch(jobs, batch_options(base_model))
+
+    assert [summary["status"] for summary in summaries] == ["ok", "error", "ok"]
+    assert "FileNotFoundError" in summaries[1]["error"]
+    for summary in (summaries[0], summaries[2]):
+        assert summary["file_size"] == Path(summary["outfile"]).stat().st_size
+        assert summary["stages"]["write"]["bytes"] > 0
+
+    # each adapter gets its own tensors, with the shared base model setup
+    a = gguf.GGUFReader(tmp_path / "a.gguf")
+    b = gguf.GGUFReader(tmp_path / "b.gguf")
+    assert [t.name for t in a.tensors] == [t.name for t in b.tensors]
+    assert not all(np.array_equal(ta.data, tb.data) for ta, tb in zip(a.tensors, b.tensors))
+
+
+@pytest.mark.parametrize("args", [
+    ["--batch", "batch.jsonl", "--outfile", "out.gguf"],
+    ["--batch", "batch.jsonl", "--profile-report", "report.json"],
+    ["--batch", "batch.jsonl", "lora"],
+    [],
+])
+def test_lora_batch_args(monkeypatch: pytest.MonkeyPatch, args: list[str]) -> None:
+    monkeypatch.setattr(sys, "argv", ["convert_lora_to_gguf.py", "--base", "base", *args])
+    with pytest.raises(SystemExit):
+        parse_args()
+
+
+@pytest.mark.parametrize("fan_in_fan_out", [False, True])
+def test_merge_lora_delta(monkeypatch: pytest.MonkeyPatch, fan_in_fan_out: bool) -> None:
+    # tiles of 3 rows, with a partial one at the end
+    monkeypatch.setattr(convert_lora_to_gguf, "MERGE_TILE_SIZE", 3 * 40)
+    gen = torch.Generator().manual_seed(0)
+    a = torch.randn(4, 40, generator=gen)
+    b = torch.randn(10, 4, generator=gen)
+    # with fan_in_fan_out, the weight is stored transposed
+    weight = torch.randn(10, 40, generator=gen)
+    if fan_in_fan_out:
+        weight = weight.T.contiguous()
+
+    merged = merge_lora_delta(weight, a, b, 0.5, fan_in_fan_out)
+    delta = (b @ a).T if fan_in_fan_out else b @ a
+    torch.testing.assert_close(merged, weight + 0.5 * delta)
+
+    # the result has the type of the base tensor
+    merged = merge_lora_delta(weight.to(torch.bfloat16), a.to(torch.bfloat16), b.to(torch.bfloat16), 0.5, fan_in_fan_out)
+    assert merged.dtype == torch.bfloat16
+
+    with pytest.raises(ValueError):
+        merge_lora_delta(weight[None], a, b, 0.5)
+
+
+@pytest.mark.parametrize("n_threads", [1, 3])
+def test_lora_merge_pool(n_threads: int) -> None:
+    gen = torch.Generator().manual_seed(0)
+    jobs = [(torch.randn(8, 16, generator=gen), torch.randn(2, 16, generator=gen), torch.randn(8, 2, generator=gen), float(i)) for i in range(5)]
+    pool = LoraMergePool(n_threads, max_in_flight=2)
+    try:
+        merged = [pool.submit(LazyTorchTensor.from_eager(weight), a, b, scale) for weight, a, b, scale in jobs]
+        # nothing is merged before it is written
+        assert all(isinstance(t, LazyTorchTensor) for t in merged)
+        for t, job in zip(merged, jobs):
+            assert torch.equal(LazyTorchTensor.to_eager(t), merge_lora_delta(*job))
+    finally:
+        pool.close()
+
+
+def test_get_lora_scale() -> None:
+    lparams: dict[str, Any] = {"lora_alpha": 16, "alpha_pattern": {"v_proj": 4}}
+    assert get_lora_scale("model.layers.0.self_attn.q_proj.weight", 8, lparams) == 2.0
+    assert get_lora_scale("model.layers.0.self_attn.v_proj.weight", 8, lparams) == 0.5
+    assert get_lora_scale("model.layers.0.self_attn.q_proj.weight", 4, {**lparams, "use_rslora": True}) == 8.0
+
+
+@pytest.mark.parametrize("max_rank, energy", [(4, 1.0), (0, 0.9), (0, 1.0)])
+def test_reduce_lora_rank_matches_svd(max_rank: int, energy: float) -> None:
+    gen = torch.Generator().manual_seed(0)
+    a = torch.randn(16, 64, generator=gen) * torch.linspace(1, 0.01, 16)[:, None]
+    b = torch.randn(32, 16, generator=gen)
+    new_a, new_b, error = reduce_lora_rank(a, b, max_rank, energy)
+    rank = new_a.shape[0]
+    assert new_b.shape == (32, rank)
+
+    # the best approximation of that rank is the truncated SVD of the product
+    u, s, vh = torch.linalg.svd(b @ a, full_matrices=False)
+    expected = (u[:, :rank] * s[:rank]) @ vh[:rank]
+    assert torch.allclose(new_b @ new_a, expected, atol=1e-4)
+    assert error == pytest.approx(float(torch.linalg.norm(b @ a - expected) / torch.linalg.norm(b @ a)), abs=1e-4)
+
+    # the smallest rank keeping the requested energy
+    kept = torch.cumsum(s * s, dim=0) / (s * s).sum()
+    if max_rank > 0:
+        assert rank == max_rank
+    elif energy < 1.0:
+        assert kept[rank - 1] >= energy > kept[rank - 2]
+    else:
+        assert rank == 16
+
+
+def test_reduced_lora_pair_is_lazy() -> None:
+    gen = torch.Generator().manual_seed(0)
+    a = torch.randn(16, 64, generator=gen) * torch.linspace(1, 0.01, 16)[:, None]
+    b = torch.randn(32, 16, generator=gen)
+    lazy_a = LazyTorchTensor.from_eager(a).T.contiguous().T
+    lazy_b = LazyTorchTensor.from_eager(b) * 1.0
+
+    # finding the rank doesn't keep anything in the lazy tensors
+    first_a, _, _ = reduce_lora_rank(to_eager_uncached(lazy_a), to_eager_uncached(lazy_b), energy=0.9)
+    rank = first_a.shape[0]
+    assert 1 < rank < 16
+    assert lazy_a._data is None and lazy_b._data is None
+
+    new_a, new_b = ReducedLoraPair(lazy_a, lazy_b, rank, scale_b=rank / 16).lazy_tensors()
+    assert new_a.shape == (rank, 64)
+    assert new_b.shape == (32, rank)
+
+    expected_a, expected_b, _ = reduce_lora_rank(a, b, max_rank=rank)
+    assert torch.equal(LazyTorchTensor.to_eager(new_a), expected_a)
+    assert torch.equal(LazyTorchTensor.to_eager(new_b), expected_b * (rank / 16))
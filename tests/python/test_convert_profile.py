@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from convert_profile import StageProfiler  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(time, "perf_counter", clock)
+    return clock
+
+
+def test_nested_stages_are_exclusive(clock: FakeClock) -> None:
+    profiler = StageProfiler()
+    with profiler.stage("write", nbytes=100):
+        clock.now += 1
+        with profiler.stage("quantize", "t0", 10):
+            clock.now += 2
+            with profiler.stage("read", "t0", 10):
+                clock.now += 4
+        clock.now += 8
+    with profiler.stage("quantize", "t1", 30):
+        clock.now += 16
+
+    report = profiler.report()
+    assert report["wall_time"] == 31
+    assert report["profiled_time"] == 31
+    assert {stage: (stats["seconds"], stats["bytes"], stats["count"]) for stage, stats in report["stages"].items()} == {
+        "quantize": (18, 40, 2),
+        "write": (9, 100, 1),
+        "read": (4, 10, 1),
+    }
+    # sorted by time
+    assert list(report["stages"]) == ["quantize", "write", "read"]
+    assert report["stages"]["quantize"]["mb_per_s"] == 40 / 1e6 / 18
+    assert [t["name"] for t in report["slowest_tensors"]] == ["t1", "t0"]
+    assert report["slowest_tensors"][1]["stages"] == {"quantize": {"seconds": 2, "bytes": 10}, "read": {"seconds": 4, "bytes": 10}}
+    assert len(profiler.report(top_n=1)["slowest_tensors"]) == 1
+
+
+def test_iterate_times_each_item(clock: FakeClock) -> None:
+    profiler = StageProfiler()
+
+    def items() -> Iterator[int]:
+        for i in range(3):
+            clock.now += 1
+            with profiler.stage("inner"):
+                clock.now += 10
+            yield i
+        clock.now += 100
+
+    with profiler.stage("outer"):
+        for i in profiler.iterate("read", items(), tensor_name=lambda i: f"t{i}", nbytes=lambda i: 8):
+            clock.now += 1000
+
+    stages = profiler.report()["stages"]
+    # the time after the last item counts too
+    assert (stages["read"]["seconds"], stages["read"]["bytes"], stages["read"]["count"]) == (3, 24, 3)
+    assert stages["inner"]["seconds"] == 30
+    assert stages["outer"]["seconds"] == 3100
+    assert profiler.tensors["t2"].stages["read"].nbytes == 8
+
+
+def test_stages_of_other_threads_are_not_nested(clock: FakeClock) -> None:
+    profiler = StageProfiler()
+
+    def work():
+        with profiler.stage("quantize"):
+            clock.now += 2
+
+    with profiler.stage("write"):
+        clock.now += 1
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+
+    stages = profiler.report()["stages"]
+    assert stages["write"]["seconds"] == 3
+    assert stages["quantize"]["seconds"] == 2
+
+
+def test_write_report(tmp_path: Path) -> None:
+    profiler = StageProfiler()
+    with profiler.stage("read", "t0", 8):
+        pass
+    profiler.add_bytes("read", 8)
+    profiler.write_report(tmp_path / "report.json")
+    with open(tmp_path / "report.json", encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["stages"]["read"]["bytes"] == 16
+    assert report["stages"]["read"]["count"] == 1
+    assert report["slowest_tensors"][0]["name"] == "t0"